@@ -0,0 +1,20 @@
+from django.db import connection
+
+def insert_rows(model, fields, rows):
+    """
+    Insert plain value rows with one executemany, for rows that have nothing
+    for the ORM to compute (links, gallery rows, precomputed tables),
+    building a model instance for each of them cost more than the insert itself.
+    """
+
+    if not rows:
+        return
+
+    quote_name = connection.ops.quote_name
+    columns = [model._meta.get_field(field).column for field in fields]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {quote_name(model._meta.db_table)} ({", ".join(map(quote_name, columns))}) '
+            f'VALUES ({", ".join(["%s"] * len(columns))})',
+            rows
+        )
@@ -1,11 +1,13 @@
-from product.models import Category, Product, Review
-from django.test import TestCase
+from product.models import Category, Gallery, Product, Review, IMAGE_TYPE_CHOICES
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from random import randint
 
+# The catalog response cache outlive each test, enable it explicitly on tests that need it
+@override_settings(CATALOG_CACHE={'ENABLED': False}, MEDIA_CLEANUP={'BACKGROUND': False, 'GRACE_PERIOD': 0})
 class VirtueleTestBase(TestCase):
     random_word_list = ['apostils', 'estivate', 'rioted', 'doze', 'lexicalizing', 'driftier', 'reinjection', 'musician', 'endosperms', 'cummerbunds', 'masculinizing', 'fabbest', 'semicolonialism', 'fabulous', 'clearstory', 'rared', 'lawmaking', 'confronts', 'conquians', 'morulae', 'pinto', 'dropkicker', 'antisex', 'euryokous', 'outyell', 'reinvigorations', 'brainstormers', 'ogrish', 'grails', 'heaume', 'apollos', 'morselling', 'gausses', 'exostoses', 'degreed', 'castellans', 'gridlocking', 'twirling', 'ordures', 'glum', 'capitulate', 'skill', 'brigandines', 'hustles', 'monolayers', 'forceless', 'felsic', 'procurator', 'fetas', 'conventionalist', 'bitchier', 'hypothecators', 'sniffishnesses', 'resembling', 'wastefully', 'audaciousnesses', 'handfasting', 'woodnotes', 'checkreins', 'corduroys', 'airstrip', 'torturing', 'testify', 'frenziedly', 'iguanian', 'gluten', 'opuntia', 'renitent', 'caprocks', 'nonenergy', 'centralities', 'inamoratas', 'mischanneled', 'morale', 'psychologises', 'abridgment', 'cerebrating', 'tautness', 'stigmatizes', 'endothecium', 'doux', 'contusing', 'dystrophy', 'desirableness', 'hewers', 'putschists', 'financiered', 'roturiers', 'emotionalizes', 'stonewaller', 'measles', 'chertier', 'lignites', 'cosmopolitism', 'bridesmaids', 'sashing', 'denouncements', 'intellect', 'prototyping', 'sociologese']
     
@@ -70,6 +72,19 @@ class VirtueleTestBase(TestCase):
                                   rating=randint(1, 5),
                                   review=' '.join([self.random_word_list[randint(0, 99)] for i in range(10)]).capitalize())
 
+    def gallery_factory(self, product: list=None, n=3):
+        if not product:
+            product = [product for product in Product.objects.all()]
+
+        for product in product:
+            for i in range(n):
+                # Width and height are set so the image file itself is never opened
+                Gallery.objects.create(product=product,
+                                       image_type=IMAGE_TYPE_CHOICES[randint(0, 3)][0],
+                                       image=f'{product.slug}-{i}.jpg',
+                                       width=2000,
+                                       height=2000)
+
     def category_factory(self, n=5):
         for i in range(n):
             Category.objects.create(name=' '.join([self.random_word_list[randint(0, 99)] for i in range(2)]).title())
@@ -0,0 +1,81 @@
+from rest_framework.exceptions import ParseError
+
+def parse_field_paths(value):
+    """
+    Turn comma separated dotted paths into a tree,
+    e.g. 'name,product.name,product.slug' into {'name': {}, 'product': {'name': {}, 'slug': {}}}.
+    """
+
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+
+    return tree
+
+def get_sparse_fields(request):
+    """
+    Read the ?fields= and ?expand= query parameters into keyword arguments
+    for a SparseFieldsMixin serializer and its prepare_queryset().
+    """
+
+    fields = request.GET.get('fields')
+    return {
+        'fields': parse_field_paths(fields) if fields else None,
+        'expand': parse_field_paths(request.GET.get('expand', '')),
+    }
+
+def get_nested_sparse_fields(fields, expand, name):
+    # The part of the trees after 'name.', a nested field picked without any child keep its default fields
+    return {
+        'fields': (fields or {}).get(name) or None,
+        'expand': (expand or {}).get(name, {}),
+    }
+
+class SparseFieldsMixin:
+    """
+    Only build the serializer fields picked by the client.
+
+    fields is the tree of returned fields, None return every field except Meta.expandable_fields.
+    expand is the tree of Meta.expandable_fields to add on top of it.
+    Only Meta.nested_fields accept dotted children, they are passed down with get_nested_options().
+
+    Fields that aren't built are never read, so prepare_queryset() should only load what
+    the picked fields need.
+    """
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        self.sparse_fields = fields
+        self.sparse_expand = expand or {}
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def select_fields(cls, fields=None, expand=None):
+        expandable = getattr(cls.Meta, 'expandable_fields', ())
+        nested = getattr(cls.Meta, 'nested_fields', ())
+
+        selected = set(fields) if fields is not None else {name for name in cls.Meta.fields if name not in expandable}
+        selected.update(expand or {})
+
+        unknown = selected - set(cls.Meta.fields)
+        if unknown:
+            raise ParseError(f'Unknown field {", ".join(sorted(unknown))}, valid fields are {", ".join(cls.Meta.fields)}')
+
+        flat = {name for tree in [fields or {}, expand or {}] for name, children in tree.items() if children and name not in nested}
+        if flat:
+            raise ParseError(f'Field {", ".join(sorted(flat))} has no nested field to pick')
+
+        return [name for name in cls.Meta.fields if name in selected]
+
+    @classmethod
+    def prepare_queryset(cls, queryset, fields=None, expand=None):
+        return queryset
+
+    def get_field_names(self, declared_fields, info):
+        selected = self.select_fields(self.sparse_fields, self.sparse_expand)
+        return [name for name in super().get_field_names(declared_fields, info) if name in selected]
+
+    def get_nested_options(self, name):
+        return get_nested_sparse_fields(self.sparse_fields, self.sparse_expand, name)
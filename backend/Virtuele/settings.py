@@ -77,6 +77,31 @@ else:
         'default': config('DATABASE_URL', cast=db_url)
     }
 
+# Use django.core.cache.backends.filebased.FileBasedCache with a directory,
+# or a Redis cache backend with a redis:// location on production
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='virtuele'),
+    }
+}
+
+# The catalog version must be seen by every worker, so the catalog cache is only on by default with a shared cache
+CATALOG_CACHE = {
+    'ENABLED': config('CATALOG_CACHE_ENABLED', cast=bool, default=CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'),
+    'TIMEOUT': config('CATALOG_CACHE_TIMEOUT', cast=int, default=60),
+    'STALE_TIMEOUT': config('CATALOG_CACHE_STALE_TIMEOUT', cast=int, default=60 * 60 * 24),
+    'REFRESH_TIMEOUT': 30,
+    'BACKGROUND_REFRESH': True,
+}
+
+# Facet index changes are only seen by every worker through a shared cache, otherwise each worker rebuild its index periodically
+FACET_INDEX = {
+    'SHARED_CHANGES': config('FACET_INDEX_SHARED_CHANGES', cast=bool, default=CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'),
+    'REBUILD_INTERVAL': config('FACET_INDEX_REBUILD_INTERVAL', cast=int, default=60),
+    'BACKGROUND_REBUILD': True,
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -120,6 +145,31 @@ else:
     STATIC_ROOT = '/serve/static'
     MEDIA_ROOT = '/serve/media'
 
+# Uploaded files are named by their content hash and deleted once nothing refer to them
+DEFAULT_FILE_STORAGE = 'Virtuele.storage.ContentAddressedStorage'
+
+MEDIA_CLEANUP = {
+    'BACKGROUND': True,
+    'GRACE_PERIOD': 60 * 10,
+}
+
+# Gallery images are resized into variants by a pool of worker processes
+IMAGE_VARIANTS = {
+    'BACKGROUND': True,
+    'WORKERS': config('IMAGE_VARIANT_WORKERS', cast=int, default=2),
+}
+
+# Carts of anonymous visitors are only kept in the cache, point CACHE_BACKEND to a shared cache (e.g. Redis) in production
+GUEST_CART = {
+    'TTL': config('GUEST_CART_TTL', cast=int, default=60 * 60 * 24 * 7),
+}
+
+# Units reserved at charge time go back to stock after TTL seconds if the payment never completes,
+# it should outlive the Midtrans payment expiry
+STOCK_RESERVATION = {
+    'TTL': config('STOCK_RESERVATION_TTL', cast=int, default=60 * 60 * 25),
+}
+
 AUTH_USER_MODEL = 'user.User'
 
 REST_FRAMEWORK = {
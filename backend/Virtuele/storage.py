@@ -0,0 +1,161 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import connection, models, transaction
+from django.dispatch import Signal
+
+MEDIA_CLEANUP_DEFAULTS = {
+    # Delete released files from a background thread after the transaction is committed
+    'BACKGROUND': True,
+    # Seconds a file saved, or saved again, is kept even when nothing refer to it yet,
+    # it covers the time between the save and the commit of the row referring to it
+    'GRACE_PERIOD': 60 * 10,
+}
+
+# Sent after an unreferenced file is deleted, so files derived from it can be deleted too
+file_deleted = Signal()
+
+cleanup_executor = ThreadPoolExecutor(max_workers=1)
+
+def get_media_cleanup_setting(name):
+    return getattr(settings, 'MEDIA_CLEANUP', {}).get(name, MEDIA_CLEANUP_DEFAULTS[name])
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that name every file by the SHA-256 of its content,
+    sharded into two levels of directories (ab/cd/abcd...ef.jpg) so a directory never hold many files.
+    The upload_to directory is kept as a prefix (media/avatar/ab/cd/abcd...ef.jpg),
+    the uploaded file name is ignored except for the extension.
+    Saving a content that is already stored reuse the existing file.
+    """
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+
+        digest = digest.hexdigest()
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(directory, digest[:2], digest[2:4], f'{digest}{extension}')
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = self.get_content_name(name, content)
+        try:
+            # Reusing a file renew its grace period, so a cleanup running before the new row is committed keeps it
+            os.utime(self.path(name))
+            return name
+        except FileNotFoundError:
+            return self._save(name, content)
+
+    def _save(self, name, content):
+        # Write under a unique name then move it in place,
+        # the same content saved concurrently is simply replaced by an identical file
+        temporary_name = super()._save(f'tmp/{uuid.uuid4().hex}', content)
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        os.replace(self.path(temporary_name), self.path(name))
+        return name
+
+    def delete_unless_recent(self, name, grace_period):
+        """
+        Delete the file unless it was saved in the last grace_period seconds, return whether it is gone.
+        The file is first moved aside, so a save() either renewed it before the move and it is put back,
+        or run after the move and write the file again.
+        """
+
+        path = self.path(name)
+        trash = self.path(f'tmp/{uuid.uuid4().hex}')
+        os.makedirs(os.path.dirname(trash), exist_ok=True)
+
+        try:
+            if time.time() - os.path.getmtime(path) < grace_period:
+                return False
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return True
+
+        if time.time() - os.path.getmtime(trash) < grace_period:
+            os.replace(trash, path)
+            return False
+
+        os.remove(trash)
+        return True
+
+def get_file_fields():
+    return [
+        (model, field.name)
+        for model in apps.get_models()
+        for field in model._meta.get_fields() if isinstance(field, models.FileField)
+    ]
+
+def get_referenced_names(names):
+    # One UNION query over every file field for the whole batch
+    querysets = [model._base_manager.filter(**{f'{field}__in': names}).values_list(field, flat=True) for model, field in get_file_fields()]
+    if not querysets:
+        return set()
+
+    return set(querysets[0].union(*querysets[1:]))
+
+def delete_unreferenced_files(names):
+    """
+    Delete the files nothing refer to anymore,
+    return the names kept because they were saved within the grace period.
+    """
+
+    grace_period = get_media_cleanup_setting('GRACE_PERIOD')
+    names = set(names)
+
+    recent = []
+    for name in names - get_referenced_names(names):
+        if not default_storage.delete_unless_recent(name, grace_period):
+            recent.append(name)
+            continue
+
+        file_deleted.send(sender=ContentAddressedStorage, name=name)
+
+    return recent
+
+def delete_unreferenced_files_in_background(names):
+    try:
+        recent = delete_unreferenced_files(names)
+    finally:
+        connection.close()
+
+    # Checked again once their grace period is over, they may still be unreferenced
+    if recent:
+        timer = threading.Timer(get_media_cleanup_setting('GRACE_PERIOD'), cleanup_executor.submit, [delete_unreferenced_files_in_background, recent])
+        timer.daemon = True
+        timer.start()
+
+def release_files(names):
+    """
+    Delete the stored files once nothing refer to them anymore.
+    Stored files can be shared by many rows, so they are checked after the transaction is committed.
+    """
+
+    names = [name for name in names if name]
+    if not names:
+        return
+
+    def cleanup():
+        if get_media_cleanup_setting('BACKGROUND'):
+            cleanup_executor.submit(delete_unreferenced_files_in_background, names)
+        else:
+            delete_unreferenced_files(names)
+
+    transaction.on_commit(cleanup)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from cart.models import Cart, ProductCart, Transaction
+from cart.models import ArchivedCart, Cart, ProductCart, Transaction
 
 @admin.register(ProductCart)
 class ProductCartAdmin(admin.ModelAdmin):
@@ -9,6 +9,10 @@ class ProductCartAdmin(admin.ModelAdmin):
 class CartAdmin(admin.ModelAdmin):
     readonly_fields = ('total',)
 
+@admin.register(ArchivedCart)
+class ArchivedCartAdmin(admin.ModelAdmin):
+    readonly_fields = ('cart_id', 'user', 'created', 'archived', 'total', 'lines')
+
 @admin.register(Transaction)
 class OrderHistoryAdmin(admin.ModelAdmin):
     pass
\ No newline at end of file
@@ -0,0 +1,175 @@
+import contextlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+
+from cart.models import OutOfStock, ProductCart, update_cart_items
+from product.models import Product, Stock
+from product.serializers import ProductSerializer
+
+GUEST_CART_DEFAULTS = {
+    # Cache alias holding the guest carts, it should be a shared cache (e.g. Redis) in production
+    'CACHE': 'default',
+    # Seconds a guest cart is kept since its last change
+    'TTL': 60 * 60 * 24 * 7,
+    'MAX_LINES': 100,
+    # Seconds a change may hold the cart lock before another one can take it
+    'LOCK_TIMEOUT': 10,
+    # Seconds a change wait for the lock before giving up
+    'LOCK_WAIT': 5,
+}
+
+GUEST_CART_TOKEN_HEADER = 'HTTP_X_CART_TOKEN'
+
+signer = signing.Signer(salt='cart.guest')
+
+class GuestCartBusy(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The guest cart is being changed by another request, try again.'
+
+def get_guest_cart_setting(name):
+    return getattr(settings, 'GUEST_CART', {}).get(name, GUEST_CART_DEFAULTS[name])
+
+def get_guest_cart_cache():
+    return caches[get_guest_cart_setting('CACHE')]
+
+def create_guest_cart_token():
+    return signer.sign(uuid.uuid4().hex)
+
+def get_guest_cart_key(token):
+    try:
+        return f'cart:guest:{signer.unsign(token)}'
+    except signing.BadSignature:
+        raise ParseError('Invalid guest cart token')
+
+def get_guest_cart_token(request, create=False):
+    # Sent back by the client in the X-Cart-Token header, a new token is only made when something is added
+    token = request.META.get(GUEST_CART_TOKEN_HEADER)
+    if token:
+        get_guest_cart_key(token)
+        return token
+
+    return create_guest_cart_token() if create else None
+
+def get_guest_cart(token):
+    """
+    Return the lines of a guest cart as {'slug:size': {'slug', 'size', 'qty', 'selected'}}
+    in the order they were added, an expired or unknown cart is empty.
+    """
+
+    return get_guest_cart_cache().get(get_guest_cart_key(token)) or {}
+
+def save_guest_cart(token, lines):
+    if lines:
+        get_guest_cart_cache().set(get_guest_cart_key(token), lines, timeout=get_guest_cart_setting('TTL'))
+    else:
+        get_guest_cart_cache().delete(get_guest_cart_key(token))
+
+@contextlib.contextmanager
+def lock_guest_cart(token):
+    """
+    Serialise the read-modify-write of a guest cart, so two requests on the same token
+    (e.g. two tabs) never overwrite each other's change. The lock is a cache.add() key
+    holding a value unique to its owner, it expires if the owner never release it.
+    """
+
+    cache = get_guest_cart_cache()
+    key = f'{get_guest_cart_key(token)}:lock'
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + get_guest_cart_setting('LOCK_WAIT')
+
+    while not cache.add(key, owner, timeout=get_guest_cart_setting('LOCK_TIMEOUT')):
+        if time.monotonic() >= deadline:
+            raise GuestCartBusy()
+        time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        # An expired lock may have been taken by another request since
+        if cache.get(key) == owner:
+            cache.delete(key)
+
+def add_guest_cart_item(token, product, size, qty=1):
+    with lock_guest_cart(token):
+        lines = get_guest_cart(token)
+        line = lines.get(f'{product.slug}:{size}') or {'slug': product.slug, 'size': size, 'qty': 0, 'selected': True}
+
+        if line['qty'] == 0 and len(lines) >= get_guest_cart_setting('MAX_LINES'):
+            raise ParseError(f'A guest cart can hold at most {get_guest_cart_setting("MAX_LINES")} products')
+
+        # Stock is only read, the units are reserved once the cart is charged
+        available = Stock.objects.filter(product=product, size=size).values_list('quantity', flat=True).first()
+        if available is not None and available < line['qty'] + qty:
+            raise OutOfStock(f'Only {available} of {product.name} size {size} left in stock')
+
+        line['qty'] += qty
+        lines[f'{product.slug}:{size}'] = line
+        save_guest_cart(token, lines)
+        return lines
+
+def remove_guest_cart_item(token, slug, size, qty=1):
+    with lock_guest_cart(token):
+        lines = get_guest_cart(token)
+        line = lines.get(f'{slug}:{size}')
+        if line is None:
+            raise ProductCart.DoesNotExist(f'There is no {slug} size {size} on the guest cart')
+
+        line['qty'] -= qty
+        if line['qty'] <= 0:
+            del lines[f'{slug}:{size}']
+
+        save_guest_cart(token, lines)
+        return lines
+
+def toggle_guest_cart_item(token, slug, size):
+    with lock_guest_cart(token):
+        lines = get_guest_cart(token)
+        line = lines.get(f'{slug}:{size}')
+        if line is None:
+            raise ProductCart.DoesNotExist(f'There is no {slug} size {size} on the guest cart')
+
+        line['selected'] = not line['selected']
+        save_guest_cart(token, lines)
+        return lines
+
+def get_guest_cart_data(token, lines):
+    # Shaped like CartSerializer, products removed from the catalog since are left out
+    products = {product.slug: product for product in Product.objects.catalog().filter(slug__in={line['slug'] for line in lines.values()})}
+
+    items = []
+    for line in lines.values():
+        product = products.get(line['slug'])
+        if product is not None:
+            items.append({
+                'product': ProductSerializer(product).data,
+                'qty': line['qty'],
+                'size': line['size'],
+                'selected': line['selected'],
+                'subtotal': int(product.price or 0) * line['qty'],
+            })
+
+    return {
+        'token': token,
+        'products': items,
+        'total': sum(item['subtotal'] for item in items if item['selected']),
+    }
+
+def merge_guest_cart(user, token):
+    """
+    Add the guest cart lines into the user's active cart with one bulk update_cart_items(),
+    then forget the guest cart. Return the number of merged lines.
+    """
+
+    with lock_guest_cart(token):
+        lines = get_guest_cart(token)
+        if lines:
+            update_cart_items(user, list(lines.values()), merge=True)
+            save_guest_cart(token, {})
+
+    return len(lines)
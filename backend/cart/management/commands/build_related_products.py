@@ -0,0 +1,97 @@
+import heapq
+import time
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cart.models import OrderLine
+from product.cache import invalidate_catalog_cache
+from product.models import Product, RelatedProduct
+from Virtuele.db import insert_rows
+
+def group_carts(lines):
+    """
+    Turn (cart id, product id) rows ordered by cart into the set of product ids of each cart.
+    """
+
+    cart_id, product_ids = None, set()
+    for line_cart_id, product_id in lines:
+        if line_cart_id != cart_id:
+            if product_ids:
+                yield product_ids
+            cart_id, product_ids = line_cart_id, set()
+        product_ids.add(product_id)
+
+    if product_ids:
+        yield product_ids
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the frequently bought together products from the co-occurrence of products '
+        'in the order lines of checked out carts, keeping the top neighbours of every product.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='Neighbours kept per product')
+        parser.add_argument('--min-score', type=int, default=1, help='Carts two products should share to be related')
+        parser.add_argument('--max-cart-size', type=int, default=50, help='Bigger carts are skipped, they relate everything')
+        parser.add_argument('--shards', type=int, default=1, help='Count the products in this many passes to bound the memory')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        neighbours = {}
+        for shard in range(options['shards']):
+            for product_id, counts in self.count_pairs(shard, options).items():
+                # Ties are ranked by the oldest product first
+                top = heapq.nlargest(options['top'], counts.items(), key=lambda item: (item[1], -item[0]))
+                neighbours[product_id] = [(related_id, score) for related_id, score in top if score >= options['min_score']]
+
+            self.stdout.write(f'Counted shard {shard + 1}/{options["shards"]}, {len(neighbours)} products so far')
+
+        with transaction.atomic():
+            # Products deleted while counting can't be referenced anymore
+            product_ids = set(Product.objects.values_list('id', flat=True))
+            # Inserted in the order of the (product, rank) index, which is much faster than random order
+            related_products = [
+                (product_id, related_id, score, rank)
+                for product_id, related in sorted(neighbours.items()) if product_id in product_ids
+                for rank, (related_id, score) in enumerate([item for item in related if item[0] in product_ids])
+            ]
+
+            RelatedProduct.objects.all().delete()
+            for start in range(0, len(related_products), options['chunk_size']):
+                insert_rows(RelatedProduct, ['product_id', 'related_id', 'score', 'rank'], related_products[start:start + options['chunk_size']])
+            invalidate_catalog_cache()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {len(related_products)} related products of {len(neighbours)} products '
+            f'in {time.perf_counter() - started:.1f}s'
+        ))
+
+    def count_pairs(self, shard, options):
+        """
+        Return {product id: Counter({related product id: carts containing both})}
+        for the products of the shard, streaming every order line once.
+        Order lines are the purchase history, they outlive the cart lines of deleted products and compacted carts.
+        """
+
+        lines = OrderLine.objects.filter(cart__checked_out=True, product__isnull=False).order_by('cart_id')
+        lines = lines.values_list('cart_id', 'product_id').iterator(chunk_size=options['chunk_size'])
+
+        counts = defaultdict(Counter)
+        for product_ids in group_carts(lines):
+            if len(product_ids) < 2 or len(product_ids) > options['max_cart_size']:
+                continue
+
+            for product_id in product_ids:
+                if product_id % options['shards'] == shard:
+                    # Counter.update count the whole cart at C speed, the product itself is dropped below
+                    counts[product_id].update(product_ids)
+
+        for product_id, related in counts.items():
+            del related[product_id]
+
+        return counts
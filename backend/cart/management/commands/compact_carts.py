@@ -0,0 +1,95 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from cart.models import ArchivedCart, Cart, OrderLine, ProductCart, StockReservation, Transaction
+
+def in_chunks(queryset, chunk_size):
+    """
+    Yield the ids of the queryset by ascending chunks, each chunk is read with its own short query
+    so rows changed between two chunks are simply seen in their new state.
+    """
+
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return
+
+        yield ids
+        last_id = ids[-1]
+
+class Command(BaseCommand):
+    help = (
+        'Vacuum the cart lines without a cart, delete the empty carts and move the active carts '
+        'left unchanged for --days into the archived carts. Every chunk runs in its own short transaction, '
+        'run it as a periodic job.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Days since the last change of the active carts to archive')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        chunk_size = options['chunk_size']
+
+        orphans = self.vacuum_orphan_lines(chunk_size)
+        # A cart that was charged, is being charged or was checked out into order lines is never touched,
+        # its lines may be gone with their deleted products but it is still the order history
+        carts = Cart.objects.exclude(Exists(Transaction.objects.filter(cart=OuterRef('pk')))).exclude(
+            Exists(StockReservation.objects.filter(cart=OuterRef('pk')))
+        ).exclude(Exists(OrderLine.objects.filter(cart=OuterRef('pk'))))
+        deleted = self.delete_empty_carts(carts, chunk_size)
+        archived = self.archive_carts(carts, timezone.now() - timedelta(days=options['days']), chunk_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Vacuumed {orphans} cart lines, deleted {deleted} empty carts and archived {archived} carts '
+            f'in {time.perf_counter() - started:.1f}s'
+        ))
+
+    def vacuum_orphan_lines(self, chunk_size):
+        vacuumed = 0
+        for ids in in_chunks(ProductCart.objects.filter(cart__isnull=True), chunk_size):
+            vacuumed += ProductCart.objects.filter(id__in=ids, cart__isnull=True).delete()[0]
+
+        return vacuumed
+
+    def delete_empty_carts(self, carts, chunk_size):
+        empty = carts.exclude(Exists(ProductCart.objects.filter(cart=OuterRef('pk'))))
+
+        deleted = 0
+        for ids in in_chunks(empty, chunk_size):
+            with transaction.atomic():
+                # Cart mutations lock their cart first, so a line can't be added while the chunk is checked and deleted
+                ids = list(empty.select_for_update().filter(id__in=ids).values_list('id', flat=True))
+                Cart.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+
+        return deleted
+
+    def archive_carts(self, carts, before, chunk_size):
+        stale = carts.filter(checked_out=False, updated__lt=before)
+
+        archived = 0
+        for ids in in_chunks(stale, chunk_size):
+            with transaction.atomic():
+                locked = list(stale.select_for_update().filter(id__in=ids))
+
+                lines = {}
+                for line in ProductCart.objects.filter(cart__in=locked).order_by('id').values('cart_id', 'product_id', 'size', 'qty', 'selected', 'subtotal'):
+                    lines.setdefault(line.pop('cart_id'), []).append(line)
+
+                ArchivedCart.objects.bulk_create([
+                    ArchivedCart(cart_id=cart.id, user_id=cart.user_id, created=cart.created, total=cart.total or 0, lines=lines.get(cart.id, []))
+                    for cart in locked
+                ])
+                # Their lines and snapshot go with them
+                Cart.objects.filter(id__in=[cart.id for cart in locked]).delete()
+            archived += len(locked)
+
+        return archived
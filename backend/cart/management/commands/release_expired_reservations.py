@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from cart.models import (
+    FAILED_TRANSACTION_STATUSES, PAID_TRANSACTION_STATUSES, StockReservation,
+    confirm_stock_reservations, release_stock_reservations,
+)
+
+class Command(BaseCommand):
+    help = (
+        'Give back to stock the units reserved by carts whose payment failed or expired, '
+        'and confirm the ones of paid carts whose Midtrans notification never came.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        # Paid first, so a paid cart reservation that expired is not given back to stock
+        confirmed = confirm_stock_reservations(
+            StockReservation.objects.filter(cart__transaction__status__in=PAID_TRANSACTION_STATUSES)
+        )
+
+        stale = StockReservation.objects.filter(
+            Q(expires__lte=timezone.now()) | Q(cart__transaction__status__in=FAILED_TRANSACTION_STATUSES)
+        ).distinct().order_by('id')
+
+        released, last_id = 0, 0
+        while True:
+            ids = list(stale.filter(id__gt=last_id).values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+
+            released += release_stock_reservations(StockReservation.objects.filter(id__in=ids))
+            last_id = ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Confirmed {confirmed} and released {released} stock reservations in {time.perf_counter() - started:.1f}s'
+        ))
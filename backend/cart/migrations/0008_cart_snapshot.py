@@ -0,0 +1,28 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0007_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartSnapshot',
+            fields=[
+                ('cart', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='cart.cart')),
+                ('version', models.PositiveIntegerField()),
+                ('products_updated', models.DateTimeField(null=True)),
+                ('data', models.JSONField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cart', '0008_cart_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cart_id', models.PositiveIntegerField(unique=True)),
+                ('created', models.DateTimeField()),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('lines', models.JSONField(default=list)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
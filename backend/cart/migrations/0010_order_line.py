@@ -0,0 +1,44 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+def freeze_checked_out_carts(apps, schema_editor):
+    # Lines of checked out carts are no longer repriced, so their subtotal is the price they were sold at
+    ProductCart = apps.get_model('cart', 'ProductCart')
+    OrderLine = apps.get_model('cart', 'OrderLine')
+
+    lines = ProductCart.objects.filter(cart__checked_out=True, selected=True).order_by('id')
+    batch = []
+    for cart_id, product_id, name, size, qty, subtotal in lines.values_list('cart_id', 'product_id', 'product__name', 'size', 'qty', 'subtotal').iterator(chunk_size=5000):
+        batch.append(OrderLine(cart_id=cart_id, product_id=product_id, name=name, size=size, price=subtotal // max(qty, 1), qty=qty, subtotal=subtotal))
+        if len(batch) >= 5000:
+            OrderLine.objects.bulk_create(batch)
+            batch = []
+
+    OrderLine.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0021_stock'),
+        ('cart', '0009_archived_cart'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('size', models.CharField(choices=[('S', 'Small'), ('M', 'Medium'), ('L', 'Large')], max_length=1)),
+                ('price', models.PositiveIntegerField()),
+                ('qty', models.PositiveSmallIntegerField(verbose_name='Quantity')),
+                ('subtotal', models.PositiveIntegerField()),
+                ('cart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_line', to='cart.cart')),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='product.product')),
+            ],
+        ),
+        migrations.RunPython(freeze_checked_out_carts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def backfill_updated(apps, schema_editor):
+    # The last change of existing carts is unknown, their creation is the closest
+    Cart = apps.get_model('cart', 'Cart')
+    Cart.objects.update(updated=F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0010_order_line'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_updated, migrations.RunPython.noop),
+    ]
@@ -1,73 +1,78 @@
-from django.db import models
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 from django.dispatch import receiver
 from django.db.utils import IntegrityError
-from product.models import Product, SIZE_CHOICES
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from product.models import Product, Stock, SIZE_CHOICES
+
+STOCK_RESERVATION_DEFAULTS = {
+    # Seconds the units of a charged cart are held before the sweeper give them back,
+    # should be longer than the payment expiry of every Midtrans payment type
+    'TTL': 60 * 60 * 25,
+}
+
+# Midtrans transaction status that end a payment
+PAID_TRANSACTION_STATUSES = ['capture', 'settlement']
+FAILED_TRANSACTION_STATUSES = ['cancel', 'deny', 'expire']
+
+def get_stock_reservation_setting(name):
+    return getattr(settings, 'STOCK_RESERVATION', {}).get(name, STOCK_RESERVATION_DEFAULTS[name])
+
+class OutOfStock(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Not enough stock left'
+    default_code = 'out_of_stock'
 
 class Cart(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, related_name='cart')
     checked_out = models.BooleanField(default=False)
     created = models.DateTimeField(auto_now_add=True)
     total = models.PositiveIntegerField(null=True, blank=True, default=0)
+    # Bumped on every change of the cart or its lines, see CartSnapshot
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Last change of the cart or its lines by its user, compact_carts archives the carts left alone
+    updated = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self, *args, **kwargs):
         return f'{self.user}-{self.id}-{self.total}'
 
     def save(self, *args, **kwargs):
-        return super(Cart, self).save(*args, **kwargs)
+        if self._state.adding:
+            return super(Cart, self).save(*args, **kwargs)
+
+        # Bumped by the database, the version of this instance may be outdated
+        self.version = F('version') + 1
+        result = super(Cart, self).save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+        return result
 
     def toggle_checkout(self):
-        self.checked_out = not self.checked_out
+        if not self.checked_out:
+            return checkout_cart(self)
 
+        self.checked_out = False
         return self.save()
 
-    def get_selected_product(self):
-        selected_product = []
-
-        for product in ProductCart.objects.filter(cart__id=self.id, selected=True):
-            selected_product.append({
-                'name': product.product.name,
-                'description': product.product.description,
-                'size': product.size,
-                'price': product.product.price,
-                'quantity': product.qty,
-                'subtotal': product.subtotal,
-            })
-        
-        return selected_product
-
     def update_total(self):
-        product_list = self.get_selected_product()
-        total = 0
-
-        for product in product_list:
-            total += product['subtotal']
-
-        self.total = total
-        return self.save()
+        update_cart_totals(Cart.objects.filter(id=self.id))
+        self.refresh_from_db(fields=['total'])
 
 @receiver(models.signals.pre_save, sender=Cart)
 def cart_pre_save(sender, instance, **kwargs):
     # There can only be one active (uncheckedout) cart
     try:
-        cart = Cart.objects.filter(user=instance.user, checked_out=False)
+        cart = Cart.objects.filter(user_id=instance.user_id, checked_out=False)
         if cart.count() > 1: raise IntegrityError('This user already have an active cart')
     except Cart.DoesNotExist:
         pass
 
-@receiver(models.signals.post_save, sender=Cart)
-def cart_post_save(sender, instance, created, **kwargs):
-    # Create a new cart for each product that are not selected during checkout
-    if instance.checked_out and not created:
-        unselected_product = [product.id for product in instance.product_cart.all() if not product.selected]
-            
-        if unselected_product:
-            new_cart = Cart.objects.create(user=instance.user, checked_out=False)
-        
-        for product in unselected_product:
-            product.cart = new_cart
-            product.save()
-
 class ProductCart(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, related_name='product_cart')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='product_cart')
@@ -81,26 +86,310 @@ class ProductCart(models.Model):
         return f'{self.product} {self.size} {self.qty}'
     
     def save(self, *args, **kwargs):
-        self.subtotal = int(self.product.price) * int(self.qty)
-        return super(ProductCart, self).save(*args, **kwargs)
+        # Saving a line one by one (e.g. from the admin) recomputes its cart total,
+        # the views go through the cart mutations below which shift it instead
+        self.subtotal = int(self.product.price or 0) * int(self.qty)
+        if self.cart_id is None:
+            self.cart = get_active_cart(self.user)
+
+        result = super(ProductCart, self).save(*args, **kwargs)
+        self.cart.update_total()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(ProductCart, self).delete(*args, **kwargs)
+        update_cart_totals(Cart.objects.filter(id=self.cart_id))
+        return result
+
+def update_cart_totals(cart_qs, touch=True):
+    # Recompute the total of every cart in the queryset with a single UPDATE,
+    # a checked out cart keeps the total of its order lines.
+    # Catalog changes pass touch=False, they aren't an activity of the cart user
+    selected_subtotal = ProductCart.objects.filter(cart=OuterRef('pk'), selected=True).values('cart').annotate(total=Sum('subtotal')).values('total')
+    cart_qs.update(
+        total=Case(When(checked_out=True, then=F('total')), default=Coalesce(Subquery(selected_subtotal), 0)),
+        version=F('version') + 1,
+        **({'updated': timezone.now()} if touch else {}),
+    )
+
+def get_active_cart(user, lock=False):
+    """
+    Return the user's active cart, created if there is none.
+    With lock=True the cart row stays locked until the end of the transaction,
+    so the mutations of a cart run one after the other.
+    """
+
+    carts = Cart.objects.select_for_update() if lock else Cart.objects.all()
+    return carts.filter(user=user, checked_out=False).first() or Cart.objects.create(user=user, checked_out=False)
+
+def get_cart_line(cart, size, **product):
+    # product is either product=<Product> or product__slug=<slug>
+    return ProductCart.objects.select_related('product').filter(cart=cart, size=size, **product).first()
+
+def save_cart_line(cart, line, qty, selected):
+    """
+    Set the qty and selected status of a cart line, deleting it at 0 qty.
+
+    The line and the cart total are shifted by their difference with F() so a mutation
+    is a constant number of queries, whatever the number of lines in the cart.
+    """
+
+    subtotal = int(line.product.price or 0) * qty
+    # An unsaved line has 0 subtotal, so it never counted in the total
+    difference = (subtotal if selected else 0) - (line.subtotal if line.selected else 0)
+
+    if line.pk is None:
+        if qty:
+            line.qty, line.subtotal, line.selected = qty, subtotal, selected
+            # bulk_create skips ProductCart.save() which recomputes the whole total
+            ProductCart.objects.bulk_create([line])
+    elif qty:
+        ProductCart.objects.filter(id=line.id).update(
+            qty=F('qty') + (qty - line.qty),
+            subtotal=F('subtotal') + (subtotal - line.subtotal),
+            selected=selected,
+        )
+    else:
+        ProductCart.objects.filter(id=line.id).delete()
+
+    Cart.objects.filter(id=cart.id).update(total=F('total') + difference, version=F('version') + 1, updated=timezone.now())
+    cart.total += difference
+
+def add_cart_item(user, product, size, qty=1):
+    with transaction.atomic():
+        cart = get_active_cart(user, lock=True)
+        line = get_cart_line(cart, size, product=product)
+        if line is None:
+            line = ProductCart(user=user, cart=cart, product=product, size=size, qty=0, subtotal=0, selected=True)
+
+        check_stock(product, size, line.qty + qty)
+        save_cart_line(cart, line, line.qty + qty, line.selected)
+
+    return cart
+
+def remove_cart_item(user, slug, size, qty=1):
+    with transaction.atomic():
+        cart = get_active_cart(user, lock=True)
+        line = get_cart_line(cart, size, product__slug=slug)
+        if line is None:
+            raise ProductCart.DoesNotExist(f'There is no {slug} size {size} on {user.username} cart')
+
+        save_cart_line(cart, line, max(line.qty - qty, 0), line.selected)
+
+    return cart
+
+def toggle_cart_item(user, slug, size):
+    with transaction.atomic():
+        cart = get_active_cart(user, lock=True)
+        line = get_cart_line(cart, size, product__slug=slug)
+        if line is None:
+            raise ProductCart.DoesNotExist(f'There is no {slug} size {size} on {user.username} cart')
+
+        save_cart_line(cart, line, line.qty, not line.selected)
+
+    return cart
+
+def set_cart_item(user, product, size, qty=None, selected=None):
+    """
+    Set the qty and/or selected status of a product size in the user's active cart,
+    adding it when missing and removing it at 0 qty. None keeps the current value.
+    """
+
+    with transaction.atomic():
+        cart = get_active_cart(user, lock=True)
+        line = get_cart_line(cart, size, product=product)
+        if line is None:
+            line = ProductCart(user=user, cart=cart, product=product, size=size, qty=0, subtotal=0, selected=True)
+
+        qty = line.qty if qty is None else qty
+        selected = line.selected if selected is None else selected
+        if qty > line.qty:
+            check_stock(product, size, qty)
+
+        save_cart_line(cart, line, qty, selected)
+
+    return cart
+
+def freeze_order_lines(cart):
+    """
+    Copy the selected lines of the cart with their current product name and unit price into
+    order lines, replacing the previous ones, and return them.
+    Called when the cart is charged and again when it is checked out, order lines are never
+    changed once the cart is checked out.
+    """
+
+    lines = ProductCart.objects.filter(cart=cart, selected=True).order_by('id')
+    order_lines = [
+        OrderLine(cart_id=cart.id, product_id=product_id, name=name, size=size, price=int(price or 0), qty=qty, subtotal=int(price or 0) * qty)
+        for product_id, name, price, size, qty in lines.values_list('product_id', 'product__name', 'product__price', 'size', 'qty')
+    ]
+
+    with transaction.atomic():
+        OrderLine.objects.filter(cart=cart).delete()
+        OrderLine.objects.bulk_create(order_lines)
+
+    return order_lines
+
+def checkout_cart(cart):
+    """
+    Check out the cart, its unselected lines are moved into a new active cart of the user.
+
+    The selected lines are frozen into order lines, the unselected ones are moved with one UPDATE
+    and the new cart total is recomputed by one aggregate UPDATE, so a checkout is a constant
+    number of queries whatever the cart size.
+    Return the new active cart, or None when every line was selected.
+    """
+
+    with transaction.atomic():
+        # The total of a checked out cart is the one of its frozen order lines
+        order_lines = freeze_order_lines(cart)
+        Cart.objects.filter(id=cart.id).update(
+            checked_out=True, total=sum(line.subtotal for line in order_lines), version=F('version') + 1, updated=timezone.now()
+        )
+
+        new_cart = None
+        unselected = ProductCart.objects.filter(cart=cart, selected=False)
+        if unselected.exists():
+            new_cart = Cart.objects.create(user_id=cart.user_id, checked_out=False)
+            unselected.update(cart=new_cart)
+            update_cart_totals(Cart.objects.filter(id=new_cart.id))
+
+        cart.refresh_from_db(fields=['checked_out', 'total', 'version'])
 
-@receiver(models.signals.pre_save, sender=ProductCart)
-def product_cart_pre_save(sender, instance, **kwargs):
-    Cart.objects.get_or_create(user=instance.user, checked_out=False)
+    return new_cart
 
-@receiver(models.signals.post_save, sender=ProductCart)
-def product_cart_post_save(sender, instance, created, **kwargs):
-    # Automatically assign a created product cart to user's active cart
-    if created:
-        instance.cart = Cart.objects.get(user=instance.user, checked_out=False)
-        instance.save()
+def update_cart_items(user, operations, merge=False):
+    """
+    Apply a list of {'slug', 'size', 'qty', 'selected'} changes to the user's active cart in one transaction,
+    a left out qty or selected keeps its current value and 0 qty removes the line.
 
-    # Update cart total
-    instance.cart.update_total()
+    Every product, line and stock is read with one query each, the lines are written in bulk
+    and the total is recomputed once at the end, so the cost doesn't grow with the number of changes.
+    Raise Product.DoesNotExist for an unknown slug and OutOfStock when a qty is more than the stock left,
+    nothing is changed then.
 
-@receiver(models.signals.post_delete, sender=ProductCart)
+    With merge=True (a guest cart added at login) the qty is added to the line qty instead,
+    unknown products are skipped and a qty over the stock left is cut to the stock left.
+    """
+
+    with transaction.atomic():
+        cart = get_active_cart(user, lock=True)
+        products = {product.slug: product for product in Product.objects.filter(slug__in={operation['slug'] for operation in operations})}
+        missing = sorted({operation['slug'] for operation in operations} - set(products))
+        if missing and merge:
+            operations = [operation for operation in operations if operation['slug'] in products]
+        elif missing:
+            raise Product.DoesNotExist(f'Can\'t find product {", ".join(missing)}')
+
+        lines = {(line.product_id, line.size): line for line in ProductCart.objects.filter(cart=cart, product__in=products.values())}
+        stock = {
+            (product_id, size): quantity
+            for product_id, size, quantity in Stock.objects.filter(product__in=products.values()).values_list('product_id', 'size', 'quantity')
+        }
+
+        created, updated, deleted = [], [], []
+        for operation in operations:
+            product, size = products[operation['slug']], operation['size']
+            line = lines.get((product.id, size)) or ProductCart(user=user, cart=cart, product=product, size=size, qty=0, selected=True)
+            qty = line.qty + operation['qty'] if merge else operation.get('qty', line.qty)
+
+            if qty > line.qty and stock.get((product.id, size), qty) < qty:
+                if merge:
+                    qty = max(line.qty, stock[(product.id, size)])
+                else:
+                    raise OutOfStock(f'Only {stock[(product.id, size)]} of {product.name} size {size} left in stock')
+
+            line.qty, line.selected = qty, operation.get('selected', line.selected)
+            line.subtotal = int(product.price or 0) * qty
+            if line.pk is None:
+                if qty:
+                    created.append(line)
+            elif qty:
+                updated.append(line)
+            else:
+                deleted.append(line.id)
+
+        ProductCart.objects.bulk_create(created)
+        ProductCart.objects.bulk_update(updated, ['qty', 'selected', 'subtotal'])
+        ProductCart.objects.filter(id__in=deleted).delete()
+        update_cart_totals(Cart.objects.filter(id=cart.id))
+
+    return cart
+
+def propagate_product_price(product_id, price):
+    with transaction.atomic():
+        ProductCart.objects.filter(product_id=product_id, cart__checked_out=False).update(subtotal=F('qty') * int(price or 0))
+        update_cart_totals(Cart.objects.filter(checked_out=False, product_cart__product_id=product_id), touch=False)
+
+@receiver(models.signals.pre_save, sender=Product)
+def product_price_pre_save(sender, instance, **kwargs):
+    instance.previous_price = Product.objects.filter(pk=instance.pk).values_list('price', flat=True).first() if instance.pk else None
+
+@receiver(models.signals.post_save, sender=Product)
+def product_price_post_save(sender, instance, created, **kwargs):
+    # Only a price change affect the open carts, checked out carts keep their price
+    if created or instance.previous_price == instance.price:
+        return
+
+    product_id, price = instance.id, instance.price
+    transaction.on_commit(lambda: propagate_product_price(product_id, price))
+
+@receiver(models.signals.pre_delete, sender=Product)
+def product_cart_pre_delete(sender, instance, **kwargs):
+    # The lines of a deleted product go with it, the totals of their carts are fixed after the delete
+    instance.cart_ids = list(Cart.objects.filter(product_cart__product=instance).values_list('id', flat=True).distinct())
+
+@receiver(models.signals.post_delete, sender=Product)
 def product_cart_post_delete(sender, instance, **kwargs):
-    instance.cart.update_total()
+    cart_ids = getattr(instance, 'cart_ids', None)
+    if cart_ids:
+        update_cart_totals(Cart.objects.filter(id__in=cart_ids), touch=False)
+
+class CartSnapshot(models.Model):
+    """
+    The CartSerializer data of a cart, served as long as the cart version and the last update
+    of its products are the ones it was built from.
+    Like the product ETags, the category product counts shown are only refreshed when the product changes.
+    """
+
+    cart = models.OneToOneField(Cart, on_delete=models.CASCADE, primary_key=True, related_name='snapshot')
+    version = models.PositiveIntegerField()
+    products_updated = models.DateTimeField(null=True)
+    data = models.JSONField()
+
+class OrderLine(models.Model):
+    """
+    A product of a checked out cart as it was sold, read by the order history and the Midtrans
+    item details without joining the products, and never changed by later product changes.
+    """
+
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='order_line')
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, related_name='+')
+    name = models.CharField(max_length=255)
+    size = models.CharField(choices=SIZE_CHOICES, max_length=1)
+    # Unit price in rupiah
+    price = models.PositiveIntegerField()
+    qty = models.PositiveSmallIntegerField(verbose_name='Quantity')
+    subtotal = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f'{self.name} {self.size} {self.qty}'
+
+class ArchivedCart(models.Model):
+    """
+    Cold copy of an abandoned active cart, see the compact_carts command.
+    Lines are kept as [{'product_id', 'size', 'qty', 'selected', 'subtotal'}] so a deleted product doesn't cascade here.
+    """
+
+    cart_id = models.PositiveIntegerField(unique=True)
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, related_name='+')
+    created = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
+    total = models.PositiveIntegerField(default=0)
+    lines = models.JSONField(default=list)
+
+    def __str__(self):
+        return f'{self.user}-{self.cart_id}-{self.total}'
 
 class Transaction(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='transaction')
@@ -110,3 +399,83 @@ class Transaction(models.Model):
     
     def __str__(self):
         return f'{self.user.username}-{self.order_id}'
+
+class StockReservation(models.Model):
+    """
+    Units of a product size taken out of stock for a charged cart,
+    deleted once the payment is done or given back to stock when it failed or expired.
+    """
+
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='stock_reservation')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    size = models.CharField(choices=SIZE_CHOICES, max_length=1)
+    qty = models.PositiveIntegerField()
+    expires = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.cart_id} {self.product_id} {self.size} {self.qty}'
+
+def check_stock(product, size, qty):
+    # Only a soft check when adding into the cart, the units are reserved at charge time
+    available = Stock.objects.filter(product=product, size=size).values_list('quantity', flat=True).first()
+    if available is not None and available < qty:
+        raise OutOfStock(f'Only {available} of {product.name} size {size} left in stock')
+
+def reserve_cart_stock(cart):
+    """
+    Take the units of the selected cart lines out of stock, either every line is reserved or none.
+
+    Each size is decremented by one conditional UPDATE ... WHERE quantity >= qty instead of
+    being read then written, so there is no lost update. The updated rows stay locked until the
+    outermost transaction commits, PaymentAPI.charge() only freezes the order lines before then.
+    Every cart updates its stock rows in (product, size) order, so concurrent checkouts
+    sharing some sizes wait on each other instead of deadlocking.
+    """
+
+    expires = timezone.now() + timedelta(seconds=get_stock_reservation_setting('TTL'))
+
+    with transaction.atomic():
+        # Cart mutations lock their cart first, so the lines read here are the lines charged
+        # as long as the caller freeze them in the same transaction
+        Cart.objects.select_for_update().filter(id=cart.id).exists()
+        lines = ProductCart.objects.filter(cart=cart, selected=True).order_by('product_id', 'size')
+        lines = list(lines.values('product_id', 'size').annotate(total_qty=Sum('qty')))
+
+        tracked = set(Stock.objects.filter(product_id__in=[line['product_id'] for line in lines]).values_list('product_id', 'size'))
+
+        reservations = []
+        for line in lines:
+            product_id, size, qty = line['product_id'], line['size'], line['total_qty']
+            if (product_id, size) not in tracked:
+                continue
+
+            if not Stock.objects.filter(product_id=product_id, size=size, quantity__gte=qty).update(quantity=F('quantity') - qty):
+                # Leaving the atomic block rolls back the sizes already reserved
+                product = Product.objects.get(id=product_id)
+                raise OutOfStock(f'Not enough stock left of {product.name} size {size}')
+
+            reservations.append(StockReservation(cart=cart, product_id=product_id, size=size, qty=qty, expires=expires))
+
+        StockReservation.objects.bulk_create(reservations)
+
+    return reservations
+
+def release_stock_reservations(reservation_qs):
+    """
+    Give the reserved units back to stock and return the number of released reservations.
+    A reservation is deleted before its units are added back, so a reservation released
+    by the sweeper and a Midtrans notification at the same time is only given back once.
+    """
+
+    released = 0
+    for reservation in list(reservation_qs.order_by('product_id', 'size')):
+        with transaction.atomic():
+            if StockReservation.objects.filter(id=reservation.id).delete()[0]:
+                Stock.objects.filter(product_id=reservation.product_id, size=reservation.size).update(quantity=F('quantity') + reservation.qty)
+                released += 1
+
+    return released
+
+def confirm_stock_reservations(reservation_qs):
+    # The payment is done, the units are sold and stay out of stock
+    return reservation_qs.delete()[0]
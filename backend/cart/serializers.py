@@ -1,29 +1,75 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from drf_yasg.utils import swagger_serializer_method
-from cart.models import ProductCart, Cart
+from cart.models import OrderLine, ProductCart, Cart
 from product.serializers import ProductSerializer
 from product.models import Product
+from Virtuele.serializers import SparseFieldsMixin, get_nested_sparse_fields
 
-class ProductCartSerializer(serializers.ModelSerializer):
+class ProductCartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product = serializers.SerializerMethodField()
 
     @swagger_serializer_method(serializer_or_field=ProductSerializer())
     def get_product(self, product_cart):
-        qs = Product.objects.get(id=product_cart.product.id)
-        return ProductSerializer(instance=qs, read_only=True).data
+        return ProductSerializer(instance=product_cart.product, read_only=True, **self.get_nested_options('product')).data
+
+    @classmethod
+    def prepare_queryset(cls, queryset, fields=None, expand=None):
+        if 'product' not in cls.select_fields(fields, expand):
+            return queryset
+
+        products = ProductSerializer.prepare_queryset(Product.objects.all(), **get_nested_sparse_fields(fields, expand, 'product'))
+        return queryset.prefetch_related(Prefetch('product', queryset=products))
 
     class Meta:
         model = ProductCart
         fields = ('product', 'qty', 'size', 'selected', 'subtotal')
+        nested_fields = ('product',)
+
+class OrderLineSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OrderLine
+        fields = ('product', 'name', 'size', 'price', 'qty', 'subtotal')
 
-class CartSerializer(serializers.ModelSerializer):
+class OrderSerializer(serializers.ModelSerializer):
+    lines = OrderLineSerializer(source='order_line', many=True, read_only=True)
+
+    class Meta:
+        model = Cart
+        fields = ('id', 'created', 'total', 'lines')
+
+class CartItemUpdateSerializer(serializers.Serializer):
+    slug = serializers.SlugField()
+    size = serializers.CharField()
+    qty = serializers.IntegerField(min_value=0, required=False)
+    selected = serializers.BooleanField(required=False)
+
+    def validate_size(self, size):
+        if size.upper() not in ['S', 'M', 'L']:
+            raise serializers.ValidationError('Size only accept S, M, or L either uppercase or lowercase')
+        return size.upper()
+
+    def validate(self, data):
+        if 'qty' not in data and 'selected' not in data:
+            raise serializers.ValidationError('Set the qty, the selected status or both')
+        return data
+
+class CartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     products = serializers.SerializerMethodField()
 
     @swagger_serializer_method(serializer_or_field=ProductCartSerializer(many=True))
     def get_products(self, cart):
-        qs = ProductCart.objects.filter(cart=cart)
-        return ProductCartSerializer(instance=qs, read_only=True, many=True).data
+        return ProductCartSerializer(instance=cart.product_cart.all(), read_only=True, many=True, **self.get_nested_options('products')).data
+
+    @classmethod
+    def prepare_queryset(cls, queryset, fields=None, expand=None):
+        if 'products' not in cls.select_fields(fields, expand):
+            return queryset
+
+        product_carts = ProductCartSerializer.prepare_queryset(ProductCart.objects.all(), **get_nested_sparse_fields(fields, expand, 'products'))
+        return queryset.prefetch_related(Prefetch('product_cart', queryset=product_carts))
 
     class Meta:
         model = Cart
-        fields = ('id', 'user', 'products', 'checked_out', 'created', 'total')
+        fields = ('id', 'user', 'products', 'checked_out', 'created', 'total', 'version')
+        nested_fields = ('products',)
@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from cart.models import Cart, CartSnapshot, ProductCart
+from cart.serializers import CartSerializer
+
+def with_products_updated(cart_qs):
+    # The last change of any product in the cart, a snapshot built before it shows outdated products
+    latest = ProductCart.objects.filter(cart=OuterRef('pk')).order_by('-product__updated').values('product__updated')[:1]
+    return cart_qs.annotate(products_updated=Subquery(latest))
+
+def is_fresh(cart):
+    snapshot = getattr(cart, 'snapshot', None)
+    return snapshot is not None and snapshot.version == cart.version and snapshot.products_updated == cart.products_updated
+
+def build_cart_snapshots(cart_ids):
+    """
+    Serialize the carts and store their data, return {cart id: data}.
+    The version and products update are read along the data, so a change made
+    meanwhile leaves a snapshot that is already outdated instead of a wrong one.
+    """
+
+    if not cart_ids:
+        return {}
+
+    carts = CartSerializer.prepare_queryset(with_products_updated(Cart.objects.filter(id__in=cart_ids)))
+    snapshots = [
+        CartSnapshot(cart_id=cart.id, version=cart.version, products_updated=cart.products_updated, data=CartSerializer(cart).data)
+        for cart in carts
+    ]
+
+    with transaction.atomic():
+        CartSnapshot.objects.filter(cart_id__in=cart_ids).delete()
+        # A concurrent request may have stored the same snapshot since
+        CartSnapshot.objects.bulk_create(snapshots, ignore_conflicts=True)
+
+    return {snapshot.cart_id: snapshot.data for snapshot in snapshots}
+
+def get_cart_snapshots(cart_qs):
+    """
+    Return the CartSerializer data of the carts in the queryset order, read with one query
+    from their snapshot, only the carts changed since their snapshot are serialized again.
+    """
+
+    carts = list(with_products_updated(cart_qs).select_related('snapshot'))
+    rebuilt = build_cart_snapshots([cart.id for cart in carts if not is_fresh(cart)])
+
+    # A cart deleted meanwhile isn't rebuilt, it is left out
+    return [rebuilt[cart.id] if cart.id in rebuilt else cart.snapshot.data for cart in carts if cart.id in rebuilt or is_fresh(cart)]
@@ -1,7 +1,20 @@
-from product.models import Product
+import io
+import threading
+from unittest import mock
+from django.core.management import call_command
+from datetime import timedelta
+from django.utils import timezone
+from product.models import Product, RelatedProduct, Stock
+from product.serializers import ProductSerializer
+from cart import guest
 from cart.serializers import CartSerializer
 from django.contrib.auth import get_user_model
-from cart.models import Cart
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from cart.models import (
+    ArchivedCart, Cart, CartSnapshot, OrderLine, OutOfStock, ProductCart, StockReservation, Transaction,
+    add_cart_item, checkout_cart, freeze_order_lines, propagate_product_price, release_stock_reservations, remove_cart_item, reserve_cart_stock, set_cart_item, toggle_cart_item, update_cart_items,
+)
 from rest_framework.test import APIClient
 from rest_framework import status
 
@@ -85,3 +98,678 @@ class CartCRUD(VirtueleTestBase):
 
         response = self.client.post(f'/api/v1/carts/toggle/items/{product.slug}/S/', **self.account_jwt(1))
         self.assertEqual(response.data['products'][0]['selected'], True)
+
+
+class CartMutations(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=12)
+        self.account_factory(n=1)
+        self.user = get_user_model().objects.get(id=1)
+
+    def assertTotalIsSelectedSubtotal(self, cart):
+        lines = ProductCart.objects.filter(cart=cart).select_related('product')
+        for line in lines:
+            self.assertEqual(line.subtotal, int(line.product.price or 0) * line.qty)
+
+        self.assertEqual(Cart.objects.get(id=cart.id).total, sum(line.subtotal for line in lines if line.selected))
+
+    def count_queries(self, mutation, *args):
+        with CaptureQueriesContext(connection) as queries:
+            mutation(self.user, *args)
+        return len(queries)
+
+    def test_mutations_keep_total(self):
+        product, product_2 = Product.objects.get(id=1), Product.objects.get(id=2)
+
+        cart = add_cart_item(self.user, product, 'S')
+        add_cart_item(self.user, product, 'S', qty=2)
+        add_cart_item(self.user, product_2, 'M')
+        self.assertEqual(ProductCart.objects.get(cart=cart, product=product).qty, 3)
+        self.assertTotalIsSelectedSubtotal(cart)
+
+        toggle_cart_item(self.user, product.slug, 'S')
+        self.assertTotalIsSelectedSubtotal(cart)
+
+        remove_cart_item(self.user, product_2.slug, 'M')
+        self.assertFalse(ProductCart.objects.filter(cart=cart, product=product_2).exists())
+        self.assertTotalIsSelectedSubtotal(cart)
+
+        set_cart_item(self.user, product, 'S', qty=5, selected=True)
+        set_cart_item(self.user, product_2, 'L', qty=2)
+        self.assertTotalIsSelectedSubtotal(cart)
+
+        with self.assertRaises(ProductCart.DoesNotExist):
+            toggle_cart_item(self.user, product_2.slug, 'M')
+
+        # Lines saved one by one still recompute the total
+        line = ProductCart.objects.get(cart=cart, product=product_2)
+        line.qty = 4
+        line.save()
+        self.assertTotalIsSelectedSubtotal(cart)
+        line.delete()
+        self.assertTotalIsSelectedSubtotal(cart)
+
+    def test_mutation_cost_constant_queries(self):
+        products = list(Product.objects.order_by('id'))
+
+        def measure():
+            set_cart_item(self.user, products[0], 'S', qty=1, selected=True)
+            return [
+                self.count_queries(add_cart_item, products[0], 'S'),
+                self.count_queries(toggle_cart_item, products[0].slug, 'S'),
+                self.count_queries(toggle_cart_item, products[0].slug, 'S'),
+                self.count_queries(set_cart_item, products[0], 'S', 3),
+                self.count_queries(remove_cart_item, products[0].slug, 'S'),
+            ]
+
+        queries = measure()
+        for product in products[1:]:
+            add_cart_item(self.user, product, 'M')
+
+        self.assertEqual(measure(), queries)
+        # Savepoints, the locked cart, the line, the stock, the line and the total updates
+        self.assertLessEqual(max(queries), 7)
+
+class ActiveCartUpdate(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=12)
+        self.account_factory(n=1)
+        self.client = APIClient()
+        self.user = get_user_model().objects.get(id=1)
+        self.products = list(Product.objects.order_by('id'))
+
+    def patch(self, operations, query=''):
+        return self.client.patch(f'/api/v1/carts/active/{query}', operations, format='json', **self.account_jwt(1))
+
+    def test_apply_changes_at_once(self):
+        product, product_2, product_3 = self.products[:3]
+        add_cart_item(self.user, product, 'S')
+        add_cart_item(self.user, product_2, 'M')
+
+        response = self.client.patch('/api/v1/carts/active/', [], format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.patch([
+            {'slug': product.slug, 'size': 's', 'qty': 5},
+            {'slug': product_2.slug, 'size': 'M', 'selected': False},
+            {'slug': product_3.slug, 'size': 'L', 'qty': 2},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        cart = Cart.objects.get(user=self.user, checked_out=False)
+        self.assertEqual(response.data, CartSerializer(cart).data)
+        lines = {line.product_id: line for line in ProductCart.objects.filter(cart=cart)}
+        self.assertEqual((lines[product.id].qty, lines[product_2.id].selected, lines[product_3.id].qty), (5, False, 2))
+        self.assertEqual(cart.total, lines[product.id].subtotal + lines[product_3.id].subtotal)
+
+        response = self.patch([{'slug': product.slug, 'size': 'S', 'qty': 0}], query='?fields=total')
+        self.assertEqual(response.data, {'total': lines[product_3.id].subtotal})
+
+    def test_invalid_changes_change_nothing(self):
+        product, product_2 = self.products[:2]
+        add_cart_item(self.user, product, 'S')
+        Stock.objects.create(product=product_2, size='M', quantity=1)
+
+        for operations in [
+            {'slug': product.slug, 'size': 'S', 'qty': 2},
+            [{'slug': product.slug, 'size': 'XL', 'qty': 2}],
+            [{'slug': product.slug, 'size': 'S', 'qty': -1}],
+            [{'slug': product.slug, 'size': 'S'}],
+            [{'slug': product.slug, 'size': 'S', 'qty': 2}, {'slug': product.slug, 'size': 's', 'qty': 3}],
+            [{'slug': product.slug, 'size': 'S', 'qty': 2}] * 101,
+        ]:
+            self.assertEqual(self.patch(operations).status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.patch([{'slug': product.slug, 'size': 'S', 'qty': 2}, {'slug': 'invalidslug', 'size': 'S', 'qty': 1}])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.patch([{'slug': product.slug, 'size': 'S', 'qty': 2}, {'slug': product_2.slug, 'size': 'M', 'qty': 2}])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        self.assertEqual(list(ProductCart.objects.values_list('product_id', 'qty')), [(product.id, 1)])
+
+    def test_constant_queries(self):
+        def count_queries(products):
+            with CaptureQueriesContext(connection) as queries:
+                update_cart_items(self.user, [{'slug': product.slug, 'size': 'S', 'qty': 2} for product in products])
+            return len(queries)
+
+        add_cart_item(self.user, self.products[0], 'S')
+        add_cart_item(self.user, self.products[6], 'S')
+        queries = count_queries(self.products[:2])
+        self.assertEqual(count_queries(self.products[:12]), queries)
+
+class GuestCarts(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=3)
+        self.account_factory(n=1)
+        self.client = APIClient()
+        self.products = list(Product.objects.order_by('id'))
+
+    def guest(self, method, path, token=None):
+        headers = {'HTTP_X_CART_TOKEN': token} if token else {}
+        return getattr(self.client, method)(f'/api/v1/carts/guest/{path}', **headers)
+
+    def test_guest_cart_never_writes_the_database(self):
+        product, product_2 = self.products[:2]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.guest('post', f'items/{product.slug}/s/')
+            token = response.data['token']
+            self.guest('post', f'items/{product.slug}/S/', token)
+            self.guest('post', f'items/{product_2.slug}/M/', token)
+            response = self.guest('post', f'toggle/items/{product_2.slug}/M/', token)
+
+        self.assertFalse([query for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual([(item['product']['slug'], item['qty'], item['selected']) for item in response.data['products']],
+                         [(product.slug, 2, True), (product_2.slug, 1, False)])
+        self.assertEqual(response.data['total'], int(product.price) * 2)
+        self.assertEqual(self.guest('get', '', token).data, response.data)
+
+        self.guest('delete', f'items/{product.slug}/S/', token)
+        response = self.guest('delete', f'items/{product.slug}/S/', token)
+        self.assertEqual([item['product']['slug'] for item in response.data['products']], [product_2.slug])
+        self.assertEqual(self.guest('delete', f'items/{product.slug}/S/', token).status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(self.guest('get', '').status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.guest('get', '', token + 'x').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.guest('post', 'items/invalidslug/S/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.guest('post', f'items/{product.slug}/XL/').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_changes_are_serialised(self):
+        product, product_2 = self.products[:2]
+        token = self.guest('post', f'items/{product.slug}/S/').data['token']
+        self.guest('post', f'items/{product.slug}/S/', token)
+        self.guest('post', f'items/{product_2.slug}/M/', token)
+
+        # A toggle from another request starts after the removal read the cart, and before it saved it
+        get_guest_cart = guest.get_guest_cart
+        toggle = threading.Thread(target=guest.toggle_guest_cart_item, args=(token, product_2.slug, 'M'))
+
+        def interleave(token):
+            lines = get_guest_cart(token)
+            if not toggle.is_alive() and threading.current_thread() is not toggle:
+                toggle.start()
+                toggle.join(timeout=0.2)
+            return lines
+
+        with mock.patch('cart.guest.get_guest_cart', side_effect=interleave):
+            guest.remove_guest_cart_item(token, product.slug, 'S')
+            toggle.join()
+
+        response = self.guest('get', '', token)
+        self.assertEqual([(item['product']['slug'], item['qty'], item['selected']) for item in response.data['products']],
+                         [(product.slug, 1, True), (product_2.slug, 1, False)])
+
+        # A lock never released keep the other changes waiting until LOCK_WAIT
+        with self.settings(GUEST_CART={'LOCK_WAIT': 0}), guest.lock_guest_cart(token):
+            self.assertEqual(self.guest('post', f'toggle/items/{product_2.slug}/M/', token).status_code, status.HTTP_409_CONFLICT)
+
+    def test_merge_guest_cart_at_login(self):
+        product, product_2, product_3 = self.products
+        user = get_user_model().objects.get(id=1)
+        add_cart_item(user, product, 'S')
+        Stock.objects.create(product=product_3, size='L', quantity=1)
+
+        token = self.guest('post', f'items/{product.slug}/S/').data['token']
+        for path in [f'items/{product_2.slug}/M/', f'items/{product_3.slug}/L/']:
+            self.guest('post', path, token)
+        Stock.objects.filter(product=product_3).update(quantity=0)
+
+        response = self.client.post('/api/v1/jwt/create/', {'email': user.email, 'password': 'user1'}, HTTP_X_CART_TOKEN=token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        cart = Cart.objects.get(user=user, checked_out=False)
+        # The units left out of stock since are dropped
+        self.assertEqual(sorted(ProductCart.objects.filter(cart=cart).values_list('product_id', 'qty')), [(product.id, 2), (product_2.id, 1)])
+        self.assertEqual(cart.total, int(product.price) * 2 + int(product_2.price))
+        self.assertEqual(self.guest('get', '', token).status_code, status.HTTP_204_NO_CONTENT)
+
+        # A bad token doesn't prevent the login
+        response = self.client.post('/api/v1/jwt/create/', {'email': user.email, 'password': 'user1'}, HTTP_X_CART_TOKEN='invalid')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+class CartCheckout(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=30)
+        self.account_factory(n=1)
+        self.client = APIClient()
+        self.user = get_user_model().objects.get(id=1)
+
+    def fill_cart(self, products):
+        # Every other product is left unselected
+        return update_cart_items(self.user, [
+            {'slug': product.slug, 'size': 'S', 'qty': 2, 'selected': i % 2 == 0} for i, product in enumerate(products)
+        ])
+
+    def assertTotalIsSelectedSubtotal(self, cart):
+        lines = ProductCart.objects.filter(cart=cart)
+        self.assertEqual(Cart.objects.get(id=cart.id).total, sum(line.subtotal for line in lines if line.selected))
+
+    def test_unselected_lines_move_to_a_new_cart(self):
+        cart = self.fill_cart(Product.objects.order_by('id')[:5])
+
+        response = self.client.post('/api/v1/carts/checkout/', **self.account_jwt(1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, CartSerializer(Cart.objects.get(id=cart.id)).data)
+        self.assertTrue(response.data['checked_out'])
+
+        new_cart = Cart.objects.get(user=self.user, checked_out=False)
+        self.assertEqual(list(ProductCart.objects.filter(cart=cart).values_list('selected', flat=True).distinct()), [True])
+        self.assertEqual(list(ProductCart.objects.filter(cart=new_cart).values_list('selected', flat=True).distinct()), [False])
+        self.assertEqual(ProductCart.objects.filter(cart=cart).count(), 3)
+        self.assertEqual(ProductCart.objects.filter(cart=new_cart).count(), 2)
+        self.assertTotalIsSelectedSubtotal(cart)
+        self.assertTotalIsSelectedSubtotal(new_cart)
+
+        # No new cart when every product is selected
+        update_cart_items(self.user, [{'slug': line.product.slug, 'size': 'S', 'selected': True} for line in ProductCart.objects.filter(cart=new_cart)])
+        self.assertIsNone(checkout_cart(new_cart))
+        self.assertFalse(Cart.objects.filter(user=self.user, checked_out=False).exists())
+
+    def test_order_lines_are_frozen(self):
+        products = list(Product.objects.order_by('id')[:3])
+        cart = self.fill_cart(products)
+        checkout_cart(cart)
+
+        frozen = [(product.id, product.name, int(product.price), 2) for product in products[::2]]
+        self.assertEqual(list(OrderLine.objects.filter(cart=cart).order_by('id').values_list('product_id', 'name', 'price', 'qty')), frozen)
+
+        # Later product changes don't reach the order history
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            products[0].name, products[0].price = 'Renamed Product', 1
+            products[0].save()
+        products[2].delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/carts/orders/', **self.account_jwt(1))
+        self.assertFalse([query for query in queries if 'product_product' in query['sql']])
+
+        order = response.data[0]
+        self.assertEqual((order['id'], order['total']), (cart.id, sum(price * qty for id, name, price, qty in frozen)))
+        self.assertEqual([(line['name'], line['price'], line['qty']) for line in order['lines']], [line[1:] for line in frozen])
+        self.assertEqual(Cart.objects.get(id=cart.id).total, order['total'])
+
+    def test_checkout_cost_constant_queries(self):
+        def count_queries(products):
+            cart = self.fill_cart(products)
+            with CaptureQueriesContext(connection) as queries:
+                checkout_cart(cart)
+            return len(queries)
+
+        products = list(Product.objects.order_by('id'))
+        self.assertEqual(count_queries(products[:4]), count_queries(products[4:]))
+
+class ProductPricePropagation(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=2)
+        self.account_factory(n=4)
+        self.client = APIClient()
+
+    def fill_carts(self, user_ids):
+        products = Product.objects.all()
+
+        for user_id in user_ids:
+            for product in products:
+                self.client.post(f'/api/v1/carts/items/{product.slug}/S/', **self.account_jwt(user_id))
+            self.client.post(f'/api/v1/carts/items/{products[0].slug}/S/', **self.account_jwt(user_id))
+
+    def change_price(self, product, price):
+        product.price = price
+
+        # TestCase never commit, run the on commit callbacks right away instead
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            with CaptureQueriesContext(connection) as queries:
+                product.save()
+
+        return len(queries)
+
+    def test_price_change_update_open_carts(self):
+        self.fill_carts([1, 2, 3])
+        checked_out_cart = Cart.objects.get(user__id=3, checked_out=False)
+        checked_out_cart.toggle_checkout()
+        checked_out_total = Cart.objects.get(id=checked_out_cart.id).total
+
+        product = Product.objects.get(id=1)
+        self.change_price(product, 12345)
+
+        for product_cart in ProductCart.objects.filter(product=product, cart__checked_out=False):
+            self.assertEqual(product_cart.subtotal, 12345 * product_cart.qty)
+
+        for cart in Cart.objects.filter(checked_out=False):
+            self.assertEqual(cart.total, sum(product_cart.subtotal for product_cart in cart.product_cart.filter(selected=True)))
+
+        self.assertEqual(Cart.objects.get(id=checked_out_cart.id).total, checked_out_total)
+
+    def test_price_change_cost_constant_queries(self):
+        self.fill_carts([1])
+        queries = self.change_price(Product.objects.get(id=1), 1000)
+
+        self.fill_carts([2, 3, 4])
+        self.assertEqual(self.change_price(Product.objects.get(id=1), 2000), queries)
+
+        # Carts are left alone when the price didn't change
+        product = Product.objects.get(id=1)
+        product.name = 'New Name'
+        self.assertLess(self.change_price(product, 2000), queries)
+
+class CartSparseFields(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=4)
+        self.gallery_factory()
+        self.account_factory(n=1)
+        self.client = APIClient()
+
+        for product in Product.objects.all():
+            self.client.post(f'/api/v1/carts/items/{product.slug}/S/', **self.account_jwt(1))
+
+    def get_cart(self, query=''):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/v1/carts/?checked=false{query}', **self.account_jwt(1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return response.data[0], len(queries)
+
+    def test_default_cart_is_unchanged(self):
+        cart, full_queries = self.get_cart()
+        self.assertEqual(cart, CartSerializer(Cart.objects.get(user__id=1, checked_out=False)).data)
+
+        # Cart lines, their products, categories and galleries are loaded once for the whole cart
+        self.product_factory(n=4)
+        for product in Product.objects.filter(id__gt=4):
+            self.client.post(f'/api/v1/carts/items/{product.slug}/S/', **self.account_jwt(1))
+        self.assertEqual(self.get_cart()[1], full_queries)
+
+    def test_pick_nested_fields(self):
+        # Picking every default field serializes the cart like before snapshots
+        full_cart, full_queries = self.get_cart('&fields=id,user,products,checked_out,created,total,version')
+
+        cart, queries = self.get_cart('&fields=id,total,products.qty,products.product.name,products.product.price')
+        self.assertEqual(list(cart), ['id', 'products', 'total'])
+        self.assertEqual(list(cart['products'][0]), ['product', 'qty'])
+        self.assertEqual(list(cart['products'][0]['product']), ['name', 'price'])
+        self.assertEqual(queries, full_queries - 2)
+
+        cart, queries = self.get_cart('&fields=id,total')
+        self.assertEqual(cart, {'id': full_cart['id'], 'total': full_cart['total']})
+        self.assertEqual(queries, full_queries - 4)
+
+        cart, queries = self.get_cart('&fields=products.product.slug&expand=products.product.thumbnail')
+        self.assertEqual(list(cart['products'][0]['product']), ['slug', 'thumbnail'])
+        self.assertEqual(queries, full_queries - 1)
+
+    def test_invalid_fields(self):
+        for query in ['fields=id,unknown', 'fields=total.value', 'expand=products.product.price.amount']:
+            response = self.client.get(f'/api/v1/carts/?{query}', **self.account_jwt(1))
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class RelatedProducts(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=5)
+        self.account_factory(n=1)
+        self.client = APIClient()
+
+    def checkout_carts(self, carts, checked_out=True):
+        user = get_user_model().objects.get(id=1)
+        for product_ids in carts:
+            cart = Cart.objects.create(user=user, checked_out=checked_out)
+            ProductCart.objects.bulk_create([
+                ProductCart(user=user, cart=cart, product_id=product_id, size='S', selected=True) for product_id in product_ids
+            ])
+            if checked_out:
+                freeze_order_lines(cart)
+
+    def test_rank_products_bought_together(self):
+        self.checkout_carts([[1, 2, 3], [1, 2], [1, 3, 4], [2, 4], [1]])
+        # Carts that aren't checked out yet are ignored
+        self.checkout_carts([[1, 4, 5]], checked_out=False)
+        # Only the order lines are the purchase history, the cart lines may be gone since
+        ProductCart.objects.filter(cart__checked_out=True).delete()
+
+        call_command('build_related_products', top=2, shards=2, chunk_size=2, stdout=io.StringIO())
+
+        related = lambda product_id: list(RelatedProduct.objects.filter(product_id=product_id).order_by('rank').values_list('related_id', 'score'))
+        self.assertEqual(related(1), [(2, 2), (3, 2)])
+        self.assertEqual(related(4), [(1, 1), (2, 1)])
+        self.assertEqual(related(5), [])
+
+        product = Product.objects.get(id=1)
+        response = self.client.get(f'/api/v1/products/{product.slug}/related/?limit=1')
+        self.assertEqual(response.data, ProductSerializer([Product.objects.get(id=2)], many=True).data)
+
+        response = self.client.get(f'/api/v1/products/{Product.objects.get(id=5).slug}/related/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get('/api/v1/products/invalidslug/related/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rebuild_replace_previous_products(self):
+        self.checkout_carts([[1, 2]])
+        call_command('build_related_products', stdout=io.StringIO())
+        self.assertEqual(RelatedProduct.objects.count(), 2)
+
+        self.checkout_carts([[1, 3], [1, 3], [3, 4, 5]])
+        call_command('build_related_products', min_score=2, max_cart_size=2, stdout=io.StringIO())
+
+        self.assertEqual(list(RelatedProduct.objects.order_by('product_id').values_list('product_id', 'related_id', 'score')), [(1, 3, 2), (3, 1, 2)])
+
+class StockReservations(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=2)
+        self.account_factory(n=2)
+        self.client = APIClient()
+
+        self.product, self.product_2 = Product.objects.get(id=1), Product.objects.get(id=2)
+        Stock.objects.create(product=self.product, size='S', quantity=2)
+        Stock.objects.create(product=self.product_2, size='M', quantity=1)
+
+    def fill_cart(self, user_id, items):
+        for product, size in items:
+            response = self.client.post(f'/api/v1/carts/items/{product.slug}/{size}/', **self.account_jwt(user_id))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return Cart.objects.get(user__id=user_id, checked_out=False)
+
+    def quantity(self, product, size):
+        return Stock.objects.get(product=product, size=size).quantity
+
+    def test_add_item_beyond_stock(self):
+        self.fill_cart(1, [(self.product, 'S'), (self.product, 'S')])
+
+        response = self.client.post(f'/api/v1/carts/items/{self.product.slug}/S/', **self.account_jwt(1))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(ProductCart.objects.get(product=self.product, size='S').qty, 2)
+
+        # Sizes without stock are never limited
+        self.fill_cart(1, [(self.product, 'L')] * 3)
+
+    def test_reserve_all_or_nothing(self):
+        cart = self.fill_cart(1, [(self.product, 'S'), (self.product, 'L'), (self.product_2, 'M')])
+        cart_2 = self.fill_cart(2, [(self.product, 'S'), (self.product_2, 'M')])
+
+        reserve_cart_stock(cart)
+        self.assertEqual(self.quantity(self.product, 'S'), 1)
+        self.assertEqual(self.quantity(self.product_2, 'M'), 0)
+        self.assertEqual(StockReservation.objects.filter(cart=cart).count(), 2)
+
+        # The last unit of product 2 is taken, product 1 is rolled back
+        with self.assertRaises(OutOfStock):
+            reserve_cart_stock(cart_2)
+        self.assertEqual(self.quantity(self.product, 'S'), 1)
+        self.assertFalse(StockReservation.objects.filter(cart=cart_2).exists())
+
+        self.assertEqual(release_stock_reservations(StockReservation.objects.filter(cart=cart)), 2)
+        self.assertEqual(release_stock_reservations(StockReservation.objects.filter(cart=cart)), 0)
+        self.assertEqual(self.quantity(self.product, 'S'), 2)
+        self.assertEqual(self.quantity(self.product_2, 'M'), 1)
+
+        reserve_cart_stock(cart_2)
+        self.assertEqual(self.quantity(self.product_2, 'M'), 0)
+
+    def test_release_expired_reservations(self):
+        user = get_user_model().objects.get(id=1)
+        cart = self.fill_cart(1, [(self.product, 'S')])
+        reserve_cart_stock(cart)
+        Transaction.objects.create(user=user, cart=cart, order_id='paid', status='settlement')
+
+        carts = []
+        for order_id, status in [('failed', 'expire'), ('pending', 'pending'), ('expired', 'pending')]:
+            carts.append(Cart.objects.create(user=user, checked_out=True))
+            ProductCart.objects.bulk_create([ProductCart(user=user, cart=carts[-1], product=self.product_2, size='M', selected=True)])
+            Transaction.objects.create(user=user, cart=carts[-1], order_id=order_id, status=status)
+
+        Stock.objects.filter(product=self.product_2).update(quantity=3)
+        for cart_ in carts:
+            reserve_cart_stock(cart_)
+        StockReservation.objects.filter(cart=carts[2]).update(expires=timezone.now() - timedelta(seconds=1))
+        StockReservation.objects.filter(cart=cart).update(expires=timezone.now() - timedelta(seconds=1))
+
+        call_command('release_expired_reservations', chunk_size=1, stdout=io.StringIO())
+
+        # Paid units stay sold, failed and expired ones are back in stock
+        self.assertEqual(self.quantity(self.product, 'S'), 1)
+        self.assertEqual(self.quantity(self.product_2, 'M'), 2)
+        self.assertEqual(list(StockReservation.objects.values_list('cart_id', flat=True)), [carts[1].id])
+
+    def test_failed_charge_release_stock(self):
+        cart = self.fill_cart(1, [(self.product, 'S'), (self.product_2, 'M')])
+
+        # Any error after the reservation, not only a Midtrans API error, gives the units back
+        for path, error in [('payments.midtrans.midtrans.charge', ConnectionError), ('payments.midtrans.Transaction.objects.get_or_create', ValueError)]:
+            with mock.patch('payments.midtrans.midtrans.charge', return_value={'order_id': 'order', 'transaction_status': 'pending', 'status_code': '201'}), \
+                 mock.patch(path, side_effect=error):
+                with self.assertRaises(error):
+                    self.client.post('/api/v1/payments/gopay/charge/', **self.account_jwt(1))
+
+            self.assertEqual(self.quantity(self.product, 'S'), 2)
+            self.assertEqual(self.quantity(self.product_2, 'M'), 1)
+            self.assertFalse(StockReservation.objects.filter(cart=cart).exists())
+            self.assertFalse(Cart.objects.get(id=cart.id).checked_out)
+
+class CartSnapshots(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=4)
+        self.gallery_factory()
+        self.account_factory(n=1)
+        self.client = APIClient()
+        self.user = get_user_model().objects.get(id=1)
+
+        products = list(Product.objects.order_by('id'))
+        for i in range(10):
+            cart = add_cart_item(self.user, products[i % 4], 'S')
+            add_cart_item(self.user, products[(i + 1) % 4], 'M')
+            cart.toggle_checkout()
+        add_cart_item(self.user, products[0], 'L')
+
+    def get_carts(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/carts/', **self.account_jwt(1))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, CartSerializer(Cart.objects.filter(user=self.user), many=True).data)
+
+        return [query['sql'] for query in queries]
+
+    def test_serve_snapshots(self):
+        self.get_carts()
+        self.assertEqual(CartSnapshot.objects.count(), 11)
+
+        # Only the user (for the token and the authentication) and the carts with their snapshot are read
+        self.assertEqual(len(self.get_carts()), 3)
+
+    def test_rebuild_changed_carts_only(self):
+        def changed_snapshots():
+            before = snapshots.copy()
+            snapshots.update((cart_id, (version, updated)) for cart_id, version, updated in CartSnapshot.objects.values_list('cart_id', 'version', 'products_updated'))
+            return {cart_id for cart_id in snapshots if before.get(cart_id) != snapshots[cart_id]}
+
+        snapshots = {}
+        self.get_carts()
+        changed_snapshots()
+
+        active_cart = add_cart_item(self.user, Product.objects.get(id=3), 'L')
+        self.get_carts()
+        self.assertEqual(changed_snapshots(), {active_cart.id})
+
+        # Every cart holding a changed product is rebuilt
+        product = Product.objects.get(id=2)
+        product.name = 'Renamed Product'
+        product.save()
+        self.get_carts()
+        self.assertEqual(changed_snapshots(), set(Cart.objects.filter(product_cart__product=product).values_list('id', flat=True)))
+
+        # Lines of a deleted product are gone from every cart, the category product counts
+        # shown in the products of other carts are only refreshed when those products change
+        slug = product.slug
+        product.delete()
+        response = self.client.get('/api/v1/carts/', **self.account_jwt(1))
+        carts = {cart.id: cart for cart in Cart.objects.filter(user=self.user)}
+        for cart in response.data:
+            self.assertNotIn(slug, [line['product']['slug'] for line in cart['products']])
+            self.assertEqual((cart['version'], cart['total']), (carts[cart['id']].version, carts[cart['id']].total))
+
+class CompactCarts(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=3)
+        self.account_factory(n=4)
+
+    def test_compact_carts(self):
+        users = list(get_user_model().objects.order_by('id'))
+        products = list(Product.objects.order_by('id'))
+        old = timezone.now() - timedelta(days=40)
+
+        # An abandoned cart, an old cart changed recently and a checked out cart
+        abandoned = add_cart_item(users[0], products[0], 'S')
+        add_cart_item(users[0], products[1], 'M', qty=2)
+        Cart.objects.filter(id=abandoned.id).update(created=old, updated=old)
+        abandoned.refresh_from_db()
+        recent = add_cart_item(users[1], products[0], 'S')
+        Cart.objects.filter(id=recent.id).update(created=old)
+        checked_out = add_cart_item(users[2], products[2], 'L')
+        checked_out.toggle_checkout()
+        Cart.objects.filter(id=checked_out.id).update(created=old)
+
+        # Empty carts, one of them was charged and is kept
+        empty = [Cart.objects.create(user=users[3], checked_out=True) for i in range(3)]
+        Transaction.objects.create(user=users[3], cart=empty[0], order_id='charged', status='settlement')
+        ProductCart.objects.bulk_create([ProductCart(user=users[3], product=products[0], size='S') for i in range(3)])
+
+        call_command('compact_carts', days=30, chunk_size=2, stdout=io.StringIO())
+
+        self.assertFalse(ProductCart.objects.filter(cart__isnull=True).exists())
+        self.assertEqual(set(Cart.objects.values_list('id', flat=True)), {recent.id, checked_out.id, empty[0].id})
+
+        archived = ArchivedCart.objects.get()
+        self.assertEqual((archived.cart_id, archived.user_id, archived.total), (abandoned.id, users[0].id, abandoned.total))
+        self.assertEqual([(line['product_id'], line['size'], line['qty']) for line in archived.lines], [(products[0].id, 'S', 1), (products[1].id, 'M', 2)])
+
+    def test_keep_order_history_of_deleted_products(self):
+        product = Product.objects.get(id=1)
+        cart = add_cart_item(get_user_model().objects.get(id=1), product, 'S')
+        checkout_cart(cart)
+
+        # Checked out without a payment, then its only line goes with the deleted product
+        product.delete()
+        self.assertFalse(ProductCart.objects.filter(cart=cart).exists())
+
+        call_command('compact_carts', stdout=io.StringIO())
+        self.assertTrue(Cart.objects.filter(id=cart.id).exists())
+        self.assertEqual(list(OrderLine.objects.filter(cart=cart).values_list('name', flat=True)), [product.name])
+
+    def test_mutations_mark_cart_activity(self):
+        user = get_user_model().objects.get(id=1)
+        cart = add_cart_item(user, Product.objects.get(id=1), 'S')
+        old = timezone.now() - timedelta(days=40)
+
+        for change in [lambda: add_cart_item(user, Product.objects.get(id=2), 'M'), lambda: update_cart_items(user, [{'slug': Product.objects.get(id=1).slug, 'size': 'S', 'qty': 3}])]:
+            Cart.objects.filter(id=cart.id).update(updated=old)
+            change()
+            self.assertGreater(Cart.objects.get(id=cart.id).updated, old)
+
+        # A price change isn't an activity of the cart user
+        Cart.objects.filter(id=cart.id).update(updated=old)
+        product = Product.objects.get(id=1)
+        product.price += 1000
+        product.save()
+        propagate_product_price(product.id, product.price)
+        self.assertEqual(Cart.objects.get(id=cart.id).updated, old)
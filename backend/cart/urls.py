@@ -1,10 +1,15 @@
 from django.urls import path
-from cart.views import CartItem, Carts, Checkout, ToggleCartItem
+from cart.views import ActiveCart, CartItem, Carts, Checkout, Orders, GuestCart, GuestCartItem, ToggleCartItem, ToggleGuestCartItem
 app_name = 'cart'
 
 urlpatterns = [
     path('carts/', Carts.as_view(),name='cart-list'),
+    path('carts/orders/', Orders.as_view(), name='order-list'),
+    path('carts/active/', ActiveCart.as_view(), name='active-cart'),
     path('carts/items/<slug:slug>/<size>/', CartItem.as_view(), name='add-remove-cart-item'),
     path('carts/toggle/items/<slug:slug>/<size>/', ToggleCartItem.as_view(), name='toggle-cart-item'),
+    path('carts/guest/', GuestCart.as_view(), name='guest-cart'),
+    path('carts/guest/items/<slug:slug>/<size>/', GuestCartItem.as_view(), name='add-remove-guest-cart-item'),
+    path('carts/guest/toggle/items/<slug:slug>/<size>/', ToggleGuestCartItem.as_view(), name='toggle-guest-cart-item'),
     path('carts/checkout/', Checkout.as_view(), name='checkout'),
 ]
\ No newline at end of file
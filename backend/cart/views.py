@@ -1,14 +1,27 @@
 from django.shortcuts import render
 from rest_framework.views import APIView
+from rest_framework.permissions import AllowAny
 from drf_yasg.utils import swagger_auto_schema
 from user.permissions import IsActive
-from cart.serializers import CartSerializer
-from cart.models import Cart, ProductCart
+from cart.serializers import CartItemUpdateSerializer, CartSerializer, OrderSerializer
+from cart.snapshots import get_cart_snapshots
+from cart.guest import (
+    add_guest_cart_item, get_guest_cart, get_guest_cart_data, get_guest_cart_token,
+    remove_guest_cart_item, toggle_guest_cart_item,
+)
+from cart.models import Cart, ProductCart, add_cart_item, checkout_cart, remove_cart_item, toggle_cart_item, update_cart_items
 from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
 from rest_framework.exceptions import ParseError
 from product.models import Product
+from Virtuele.serializers import get_sparse_fields
+
+def get_active_cart_data(request):
+    # Only load what the picked ?fields= and ?expand= show
+    sparse_fields = get_sparse_fields(request)
+    cart = CartSerializer.prepare_queryset(Cart.objects.filter(user=request.user, checked_out=False), **sparse_fields).get()
+    return CartSerializer(cart, **sparse_fields).data
 
 class Carts(APIView):
     """
@@ -20,7 +33,13 @@ class Carts(APIView):
 
     GET parameter list:
     **checked**: If set to 'true' will return only checked out cart,
-    else if you set it to 'false' will return only non checked out cart (active cart)
+    else if you set it to 'false' will return only non checked out cart (active cart)<br>
+    **fields**: Comma separated fields to return, use a dot to pick the fields of
+    a nested object, e.g. 'id,total,products.qty,products.product.name'<br>
+    **expand**: Comma separated optional fields to add, e.g. 'products.product.thumbnail'<br>
+
+    Without fields and expand, each cart is served from a snapshot rebuilt only when
+    the cart (see its version) or one of its products changed.
     """
 
     permission_classes = [IsActive]
@@ -42,14 +61,91 @@ class Carts(APIView):
             cart_condition = False
 
         cart_qs = cart_qs.filter(checked_out=cart_condition) if not cart_condition == None else cart_qs
-        carts = [cart for cart in cart_qs]
 
-        if not carts:
+        if not request.GET.get('fields') and not request.GET.get('expand'):
+            # The whole carts are served from their snapshot
+            data = get_cart_snapshots(cart_qs)
+        else:
+            sparse_fields = get_sparse_fields(request)
+            data = CartSerializer(CartSerializer.prepare_queryset(cart_qs, **sparse_fields), many=True, **sparse_fields).data
+
+        if not data:
             # Return early with no content (204) if no queryset found
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        serializer = CartSerializer(carts, many=True)
-        return Response(serializer.data)
+        return Response(data)
+
+class Orders(APIView):
+    """
+    Order History
+
+    Return the checked out carts of the user with the products as they were sold,
+    their name, size, unit price and quantity are frozen at checkout
+    and don't follow later product changes.
+    """
+
+    permission_classes = [IsActive]
+
+    @swagger_auto_schema(
+        responses={
+            200: OrderSerializer(many=True),
+            204: 'No Result Found',
+            401: 'Invalid User\'s Credential'
+        }
+    )
+    def get(self, request):
+        orders = Cart.objects.filter(user=request.user, checked_out=True).order_by('-id').prefetch_related('order_line')
+
+        if not orders:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        return Response(OrderSerializer(orders, many=True).data)
+
+class ActiveCart(APIView):
+    permission_classes = [IsActive]
+    max_operations = 100
+
+    @swagger_auto_schema(
+        request_body=CartItemUpdateSerializer(many=True),
+        responses={
+            200: CartSerializer(),
+            400: 'Invalid Cart Item Changes',
+            404: 'Can\'t Find Product With That Slug',
+            409: 'Not Enough Stock Left'
+        }
+    )
+    def patch(self, request):
+        """
+        Update Active Cart Items
+
+        Apply a list of changes to user's active cart in one go and return the cart once,
+        e.g. [{"slug": "shirt", "size": "M", "qty": 5}, {"slug": "pants", "size": "L", "selected": false}].<br>
+        A left out qty or selected keeps its current value, a product size not on the cart is added
+        and a 0 qty removes it. Either every change is applied or none.<br>
+        Return 409 if a new quantity is more than the stock left of that size.<br>
+
+        ### Valid query parameter list:<br>
+        **fields**, **expand**: Pick the returned cart fields like on the cart list
+        """
+
+        if not isinstance(request.data, list):
+            raise ParseError('Send a list of cart item changes')
+        if len(request.data) > self.max_operations:
+            raise ParseError(f'Send at most {self.max_operations} cart item changes at once')
+
+        serializer = CartItemUpdateSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        keys = [(operation['slug'], operation['size']) for operation in serializer.validated_data]
+        if len(set(keys)) < len(keys):
+            raise ParseError('Each product size can only be changed once')
+
+        try:
+            update_cart_items(request.user, serializer.validated_data)
+        except Product.DoesNotExist as e:
+            return Response({'detail': str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(get_active_cart_data(request))
 
 class CartItem(APIView):
     permission_classes = [IsActive]
@@ -58,7 +154,8 @@ class CartItem(APIView):
         responses={
             200: CartSerializer(),
             400: 'Invalid Size Parameter',
-            404: 'Can\'t Find Product With That Slug'
+            404: 'Can\'t Find Product With That Slug',
+            409: 'Not Enough Stock Left'
         }
     )
     def post(self, request, slug, size):
@@ -69,6 +166,7 @@ class CartItem(APIView):
         will create a new cart if no active cart exists.
         Will increase the quantity if the product with that size
         already exists on the user's cart.
+        Return 409 if the new quantity is more than the stock left of that size.
         
         Allowed size parameters value are: 'S', 'M', 'L' either upper or lowercase
         """
@@ -82,18 +180,8 @@ class CartItem(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        product_cart, product_created = ProductCart.objects.get_or_create(
-            user=request.user,
-            product=product,
-            size=size.upper(),
-            defaults={'selected': True})
-
-        if not product_created:
-            product_cart.qty += 1
-            product_cart.save()
-
-        serializer = CartSerializer(Cart.objects.get(user=request.user, checked_out=False))
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        add_cart_item(request.user, product, size.upper())
+        return Response(get_active_cart_data(request), status=status.HTTP_200_OK)
 
     @swagger_auto_schema(
         responses={
@@ -117,12 +205,9 @@ class CartItem(APIView):
         user = request.user
 
         try:
-            cart = Cart.objects.get(user=user, checked_out=False)
             if size.upper() not in ['S', 'M', 'L']: raise ValueError
-            product_cart = ProductCart.objects.get(product__slug=slug, size=size, cart=cart)
-        except (Cart.DoesNotExist, ProductCart.DoesNotExist) as e:
-            if e == Cart.DoesNotExist:
-                Cart.objects.create(user=user)
+            remove_cart_item(user, slug, size.upper())
+        except ProductCart.DoesNotExist:
             return Response(
                 {
                     'detail': f'Trying to remove non existing product from {user.username} cart'
@@ -137,14 +222,7 @@ class CartItem(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        if product_cart.qty > 1:
-            product_cart.qty -= 1
-            product_cart.save()
-        else:
-            product_cart.delete()
-
-        serializer = CartSerializer(Cart.objects.get(user=user, checked_out=False))
-        return Response(serializer.data)
+        return Response(get_active_cart_data(request))
 
 class ToggleCartItem(APIView):
     permission_classes = [IsActive]
@@ -168,12 +246,9 @@ class ToggleCartItem(APIView):
         user = request.user
 
         try:
-            cart = Cart.objects.get(user=user, checked_out=False)
             if size.upper() not in ['S', 'M', 'L']: raise ValueError
-            product_cart = ProductCart.objects.get(product__slug=slug, size=size, cart=cart)
-        except (Cart.DoesNotExist, ProductCart.DoesNotExist) as e:
-            if e == Cart.DoesNotExist:
-                Cart.objects.create(user=user)
+            toggle_cart_item(user, slug, size.upper())
+        except ProductCart.DoesNotExist:
             return Response(
                 {
                     'detail': f'Trying to toggle selected status of non existing product from {user.username} cart'
@@ -188,11 +263,119 @@ class ToggleCartItem(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        product_cart.selected = not product_cart.selected
-        product_cart.save()
+        return Response(get_active_cart_data(request))
+
+class GuestCart(APIView):
+    """
+    Guest Cart
+
+    Return the cart of an anonymous visitor, kept in the cache and never in the database.<br>
+    Send the token returned when the first product is added in the X-Cart-Token header.
+    The cart expires after a week without changes, and is merged into the user's active cart
+    when the token is sent along the JWT create request.
+    """
+
+    permission_classes = [AllowAny]
+
+    @swagger_auto_schema(
+        responses={
+            200: 'Guest Cart',
+            204: 'No Result Found',
+            400: 'Invalid Cart Token'
+        }
+    )
+    def get(self, request):
+        token = get_guest_cart_token(request)
+        lines = get_guest_cart(token) if token else {}
+
+        if not lines:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        return Response(get_guest_cart_data(token, lines))
+
+class GuestCartItemAPI(APIView):
+    permission_classes = [AllowAny]
+
+    def validate_size(self, size):
+        if size.upper() not in ['S', 'M', 'L']:
+            raise ParseError('Size parameter only accept S, M, or L either uppercase or lowercase')
+        return size.upper()
+
+class GuestCartItem(GuestCartItemAPI):
+    @swagger_auto_schema(
+        responses={
+            200: 'Guest Cart',
+            400: 'Invalid Size Parameter Or Cart Token',
+            404: 'Can\'t Find Product With That Slug',
+            409: 'Not Enough Stock Left Or Guest Cart Busy'
+        }
+    )
+    def post(self, request, slug, size):
+        """
+        Add To Guest Cart
+
+        Same as add to cart for an anonymous visitor, a new guest cart
+        and its token are made when no X-Cart-Token header is sent.
+        """
 
-        serializer = CartSerializer(Cart.objects.get(user=user, checked_out=False))
-        return Response(serializer.data)
+        size = self.validate_size(size)
+        product = get_object_or_404(Product, slug=slug)
+        token = get_guest_cart_token(request, create=True)
+
+        return Response(get_guest_cart_data(token, add_guest_cart_item(token, product, size)))
+
+    @swagger_auto_schema(
+        responses={
+            200: 'Guest Cart',
+            400: 'Invalid Size Parameter Or Cart Token',
+            404: 'There Is No Product With That Slug On The Cart',
+            409: 'Guest Cart Busy'
+        }
+    )
+    def delete(self, request, slug, size):
+        """
+        Remove From Guest Cart
+
+        Same as remove from cart for an anonymous visitor.
+        """
+
+        size = self.validate_size(size)
+        token = get_guest_cart_token(request)
+
+        try:
+            if not token: raise ProductCart.DoesNotExist
+            lines = remove_guest_cart_item(token, slug, size)
+        except ProductCart.DoesNotExist:
+            return Response({'detail': 'Trying to remove non existing product from guest cart'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(get_guest_cart_data(token, lines))
+
+class ToggleGuestCartItem(GuestCartItemAPI):
+    @swagger_auto_schema(
+        responses={
+            200: 'Guest Cart',
+            400: 'Invalid Size Parameter Or Cart Token',
+            404: 'There Is No Product With That Slug On The Cart',
+            409: 'Guest Cart Busy'
+        }
+    )
+    def post(self, request, slug, size):
+        """
+        Toggle Item Selected Status From Guest Cart
+
+        Same as toggle item selected status for an anonymous visitor.
+        """
+
+        size = self.validate_size(size)
+        token = get_guest_cart_token(request)
+
+        try:
+            if not token: raise ProductCart.DoesNotExist
+            lines = toggle_guest_cart_item(token, slug, size)
+        except ProductCart.DoesNotExist:
+            return Response({'detail': 'Trying to toggle selected status of non existing product from guest cart'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(get_guest_cart_data(token, lines))
 
 class Checkout(APIView):
     """
@@ -213,12 +396,8 @@ class Checkout(APIView):
 
     def post(self, request):
         cart = self.get_cart(request)
-        cart.checked_out = True
-
-        for product in cart.products.all():
-            product.checked_out = True
-            product.save()
+        # The unselected products are left in a new active cart
+        checkout_cart(cart)
 
-        cart.save()
-        serialize = CartSerializer(cart)
+        serialize = CartSerializer(cart, **get_sparse_fields(request))
         return Response(serialize.data)
@@ -1,15 +1,14 @@
 from datetime import date
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 
 from midtransclient import CoreApi
 from midtransclient.error_midtrans import MidtransAPIError
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import status
 
-from cart.models import Cart, ProductCart, Transaction
+from cart.models import Cart, StockReservation, Transaction, freeze_order_lines, release_stock_reservations, reserve_cart_stock
 from user.permissions import IsActive
 
 midtrans = CoreApi(
@@ -69,8 +68,10 @@ class PaymentAPI(APIView):
                 'enable_callback': True
             }
 
+        # Midtrans expects the gross amount to be the sum of the item details
+        order_lines = freeze_order_lines(cart)
         transaction['transaction_details'] = {
-            'gross_amount': cart.total,
+            'gross_amount': sum(line.subtotal for line in order_lines),
             'order_id': payment_type.upper()+'-'+self.generate_order_id(request)
         }
         transaction['customer_details'] = {
@@ -78,10 +79,45 @@ class PaymentAPI(APIView):
             'last_name': request.user.last_name,
             'email': request.user.email,
         }
-        transaction['item_details'] = cart.get_selected_product()
+        transaction['item_details'] = [
+            {
+                'id': f'{line.product_id}-{line.size}',
+                'name': f'{line.name} ({line.size})'[:50],
+                'price': line.price,
+                'quantity': line.qty,
+            }
+            for line in order_lines
+        ]
 
         return transaction
 
+    def charge(self, request, payment_type: str, **kwargs):
+        """
+        Reserve the stock of the user's active cart, charge it on Midtrans then check it out.
+        The reservations are released whenever the charge doesn't go through, whatever the error.
+        """
+
+        cart = self.get_users_active_cart(request)
+        try:
+            # The cart stays locked from the reservation until its order lines are frozen
+            with transaction.atomic():
+                reserve_cart_stock(cart)
+                param = self.build_transaction_param(request, payment_type, cart, **kwargs)
+
+            response = midtrans.charge(param)
+            # A failed local save leaves the cart active as its reservations are released
+            with transaction.atomic():
+                cart.toggle_checkout()
+                self.save_transaction_to_local_database(request.user, cart, response)
+            return Response(response, status=response['status_code'])
+        except MidtransAPIError as e:
+            # Nothing will be paid, give the units back right away
+            release_stock_reservations(StockReservation.objects.filter(cart=cart))
+            return Response(e.api_response_dict, status=e.api_response_dict['status_code'])
+        except Exception:
+            release_stock_reservations(StockReservation.objects.filter(cart=cart))
+            raise
+
     def save_transaction_to_local_database(self, user, cart, midtrans_response):
         order = Transaction.objects.get_or_create(
             user=user,
@@ -117,6 +153,8 @@ class CancelTransaction(PaymentAPI):
                 return Response({'message': 'You do not have permission to view this transaction status'}, 403)
 
             response = midtrans.transactions.cancel(order_id)
+            if response.get('transaction_status') == 'cancel':
+                release_stock_reservations(StockReservation.objects.filter(cart=transaction.cart_id))
             return Response(response, status=response['status_code'])
         except MidtransAPIError as e:
             return Response(e.api_response_dict, status=e.api_response_dict['status_code'])
\ No newline at end of file
@@ -7,7 +7,7 @@ from Virtuele.settings import MIDTRANS
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 
-from cart.models import Transaction
+from cart.models import FAILED_TRANSACTION_STATUSES, PAID_TRANSACTION_STATUSES, StockReservation, Transaction, confirm_stock_reservations, release_stock_reservations
 from payments.midtrans import midtrans
 
 def valid_signature_key(notification):
@@ -35,6 +35,14 @@ def notification_webhooks(request):
         transaction_local = Transaction.objects.get(order_id=transaction['order_id'])
         transaction_local.status = transaction['transaction_status']
         transaction_local.save()
+
+        # The reserved units are sold once paid, and back in stock when the payment failed,
+        # release_expired_reservations catches up on notifications that never came
+        reservations = StockReservation.objects.filter(cart=transaction_local.cart_id)
+        if transaction['transaction_status'] in PAID_TRANSACTION_STATUSES and transaction.get('fraud_status') != 'challenge':
+            confirm_stock_reservations(reservations)
+        elif transaction['transaction_status'] in FAILED_TRANSACTION_STATUSES:
+            release_stock_reservations(reservations)
     except Transaction.DoesNotExist:
         pass
     # Important remove this on non testing environment
@@ -1,9 +1,12 @@
+from django.contrib.auth import get_user_model
 from product.models import Product
 from rest_framework.test import APIClient
 from rest_framework import status
 
 from Virtuele.helpers import VirtueleTestBase
-from cart.models import Transaction
+from cart.models import Cart, Transaction, add_cart_item
+from payments.midtrans import PaymentAPI
+from rest_framework.test import APIRequestFactory
 
 class GenericTransactionTest(VirtueleTestBase):
     def setUp(self):
@@ -134,3 +137,21 @@ class IndomaretTest(VirtueleTestBase):
         self.assertNotEqual(Transaction.objects.get(order_id=response.data['order_id']), None)
 
         return response.data['order_id']
+
+class TransactionParam(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=2)
+        self.user_admin_factory()
+
+    def test_item_details_from_order_lines(self):
+        user = get_user_model().objects.get(username='punyUser')
+        products = list(Product.objects.order_by('id'))
+        add_cart_item(user, products[0], 'S', qty=2)
+        cart = add_cart_item(user, products[1], 'M')
+
+        request = APIRequestFactory().post('/')
+        request.user = user
+        param = PaymentAPI().build_transaction_param(request, 'gopay', Cart.objects.get(id=cart.id))
+
+        self.assertEqual([(item['price'], item['quantity']) for item in param['item_details']], [(int(products[0].price), 2), (int(products[1].price), 1)])
+        self.assertEqual(param['transaction_details']['gross_amount'], sum(item['price'] * item['quantity'] for item in param['item_details']))
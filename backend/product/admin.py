@@ -1,9 +1,14 @@
 from django.contrib import admin
-from product.models import Gallery, Product, Review, Category
+from product.models import Gallery, Product, RelatedProduct, Review, Category, Stock
+
+class StockInline(admin.TabularInline):
+    model = Stock
+    extra = 0
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug', 'price', 'is_featured', 'rating')
+    inlines = [StockInline]
 
 @admin.register(Review)
 class ReviewAdmin(admin.ModelAdmin):
@@ -17,3 +22,8 @@ class GalleryAdmin(admin.ModelAdmin):
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     pass
+
+@admin.register(RelatedProduct)
+class RelatedProductAdmin(admin.ModelAdmin):
+    list_display = ('product', 'related', 'score', 'rank')
+    readonly_fields = ('product', 'related', 'score', 'rank')
@@ -0,0 +1,188 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.http import HttpRequest, QueryDict
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+CATALOG_CACHE_DEFAULTS = {
+    'ENABLED': True,
+    # Seconds a cached response is served as fresh
+    'TIMEOUT': 60,
+    # Seconds the last known response can still be served while it is being refreshed
+    'STALE_TIMEOUT': 60 * 60 * 24,
+    # Seconds before another worker may retry a refresh that never finished
+    'REFRESH_TIMEOUT': 30,
+    'BACKGROUND_REFRESH': True,
+}
+
+refresh_executor = ThreadPoolExecutor(max_workers=2)
+
+def get_catalog_cache_setting(name):
+    return getattr(settings, 'CATALOG_CACHE', {}).get(name, CATALOG_CACHE_DEFAULTS[name])
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+
+    if version is None:
+        # Start from the current time, so an evicted counter will never reuse an old version
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+
+    return version
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        get_catalog_version()
+
+def invalidate_catalog_cache():
+    bump_catalog_version()
+
+    # Bump again after commit, a request served between the first bump and the commit
+    # could have cached the old data under the new version
+    transaction.on_commit(bump_catalog_version)
+
+# Plain request values a refresh needs, never the credentials or cookies of the visitor
+REFRESH_META = ['HTTP_HOST', 'HTTP_ACCEPT', 'SERVER_NAME', 'SERVER_PORT', 'wsgi.url_scheme', 'PATH_INFO', 'QUERY_STRING']
+
+def build_refresh_request(meta):
+    request = HttpRequest()
+    request.method = 'GET'
+    request.META = dict(meta, REQUEST_METHOD='GET')
+    request.path = request.path_info = meta.get('PATH_INFO', '/')
+    request.GET = QueryDict(meta.get('QUERY_STRING', ''))
+    return request
+
+def refresh_in_background(refresh, view_class, meta, args, kwargs):
+    """
+    Rebuild a response from a new anonymous request and view instance, the request that started
+    the refresh has already been answered and its objects are not safe to share with this thread.
+    """
+
+    close_old_connections()
+    try:
+        view = view_class()
+        view.args, view.kwargs = args, kwargs
+        view.request = view.initialize_request(build_refresh_request(meta), *args, **kwargs)
+        view.format_kwarg = view.get_format_suffix(**kwargs)
+        view.initial(view.request, *args, **kwargs)
+        refresh(view, view.request)
+    finally:
+        connection.close()
+
+def cache_catalog_response(view_method):
+    """
+    Cache anonymous GET responses of a catalog view,
+    keyed by the full path (including query string) and the catalog version.
+    When the version changed or the response expired, the last known response
+    is served while a single worker refresh it.
+    """
+
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if not get_catalog_cache_setting('ENABLED') or request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+
+        version = get_catalog_version()
+        path_hash = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+        key = f'catalog:response:{version}:{path_hash}'
+        stale_key = f'catalog:response:stale:{path_hash}'
+
+        def refresh(view, request):
+            try:
+                response = view_method(view, request, *args, **kwargs)
+            except Exception:
+                # Stop serving a response that can't be built anymore (e.g. a deleted product)
+                cache.delete(stale_key)
+                raise
+
+            entry = (response.status_code, response.data)
+            cache.set(key, entry, timeout=get_catalog_cache_setting('TIMEOUT'))
+            cache.set(stale_key, entry, timeout=get_catalog_cache_setting('STALE_TIMEOUT'))
+            return response
+
+        entry = cache_hit = cache.get(key)
+        if entry is None:
+            entry = cache.get(stale_key)
+
+            if entry is None:
+                return refresh(self, request)
+
+            # Only the worker that get the refresh lock recompute the response
+            refresh_lock = f'catalog:refresh:{version}:{path_hash}'
+            if cache.add(refresh_lock, True, timeout=get_catalog_cache_setting('REFRESH_TIMEOUT')):
+                if not get_catalog_cache_setting('BACKGROUND_REFRESH'):
+                    return refresh(self, request)
+
+                # Only plain values of the request are handed to the worker
+                meta = {name: request.META[name] for name in REFRESH_META if name in request.META}
+                try:
+                    refresh_executor.submit(refresh_in_background, refresh, type(self), meta, args, kwargs)
+                except RuntimeError:
+                    # The executor is shut down, e.g. while the worker process exit
+                    return refresh(self, request)
+
+        status_code, data = entry
+        response = Response(data, status=status_code)
+        response.is_stale = entry is not cache_hit
+        return response
+
+    return wrapper
+
+def conditional_catalog_response(view_method):
+    """
+    Add a strong ETag and Last-Modified header into a catalog view response,
+    derived from view.get_catalog_state() which should return a (count, last modified) tuple
+    of the rows shown on the response, or None if the view will return 404.
+    A matching If-None-Match or If-Modified-Since is answered with 304 before the view is called.
+
+    A view listing rows that can be deleted or filtered out sets catalog_last_modified = False,
+    the latest change of the remaining rows doesn't move when a row leaves the list, so only
+    the ETag (which include the count) can validate it.
+    """
+
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        accept = request.META.get('HTTP_ACCEPT', '')
+        path_hash = hashlib.md5(f'{request.get_full_path()}:{accept}'.encode('utf-8')).hexdigest()
+
+        # Every change of the catalog bump its version, so the state can be kept until then
+        state_key = f'catalog:state:{get_catalog_version()}:{path_hash}' if get_catalog_cache_setting('ENABLED') else None
+        state = cache.get(state_key) if state_key else None
+
+        if state is None:
+            state = self.get_catalog_state(request, *args, **kwargs)
+            if state is None:
+                return view_method(self, request, *args, **kwargs)
+            if state_key:
+                cache.set(state_key, state, timeout=get_catalog_cache_setting('TIMEOUT'))
+
+        # The ETag use the full timestamp precision, Last-Modified only have seconds
+        count, updated = state
+        etag = '"%s"' % hashlib.md5(f'{path_hash}:{count}:{updated.isoformat() if updated else None}'.encode('utf-8')).hexdigest()
+        last_modified = int(updated.timestamp()) if updated and getattr(self, 'catalog_last_modified', True) else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view_method(self, request, *args, **kwargs)
+
+            # A stale cached response doesn't match the current state, so it can't be validated
+            if response.status_code == 200 and not getattr(response, 'is_stale', False):
+                response['ETag'] = etag
+                if last_modified:
+                    response['Last-Modified'] = http_date(last_modified)
+
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    return wrapper
@@ -0,0 +1,387 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from rest_framework.exceptions import ParseError
+
+FACET_SEQUENCE_KEY = 'catalog:facets:sequence'
+
+FACET_INDEX_DEFAULTS = {
+    # Whether the change log is on a cache every worker share, otherwise a worker only see its own changes
+    'SHARED_CHANGES': True,
+    # Seconds before an index is rebuilt to pick up the changes of other workers, when they are not shared
+    'REBUILD_INTERVAL': 60,
+    'BACKGROUND_REBUILD': True,
+}
+
+rebuild_executor = ThreadPoolExecutor(max_workers=1)
+
+# Number of filter combinations whose counts are kept until the index change
+FACET_COUNT_CACHE_SIZE = 1024
+
+# Seconds a change is kept for other processes to apply
+FACET_CHANGE_TIMEOUT = 60 * 60
+
+# A process that missed more changes (or changed products) than this rebuild its index instead
+FACET_MAX_CHANGES = 500
+
+# (minimum price, maximum price exclusive), a missing price is counted as 0
+PRICE_BUCKETS = (
+    (0, 100000),
+    (100000, 250000),
+    (250000, 500000),
+    (500000, None),
+)
+
+PRICE_BUCKET_VALUES = [f'{low}-{high or ""}' for low, high in PRICE_BUCKETS]
+
+# A product is in the band of its rating rounded down, 0 means not rated yet
+RATING_BANDS = (0, 1, 2, 3, 4, 5)
+
+def get_facet_index_setting(name):
+    return getattr(settings, 'FACET_INDEX', {}).get(name, FACET_INDEX_DEFAULTS[name])
+
+def count_bits(bitset):
+    return bin(bitset).count('1')
+
+# int.bit_count is only available from Python 3.10
+if hasattr(int, 'bit_count'):
+    count_bits = int.bit_count
+
+def get_price_bucket(price):
+    price = price or 0
+    for (low, high), value in zip(PRICE_BUCKETS, PRICE_BUCKET_VALUES):
+        if price >= low and (high is None or price < high):
+            return value
+
+def get_rating_band(rating):
+    return str(min(max(int(rating or 0), RATING_BANDS[0]), RATING_BANDS[-1]))
+
+class Facet:
+    """
+    A product attribute that can be filtered and counted,
+    with every value OR-ed and different facets AND-ed.
+    """
+
+    name = None
+
+    def get_values(self, product, categories):
+        raise NotImplementedError
+
+    def parse(self, value):
+        return value
+
+    def get_q(self, values):
+        raise NotImplementedError
+
+class CategoryFacet(Facet):
+    name = 'category'
+
+    def get_values(self, product, categories):
+        return categories
+
+    def parse(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ParseError('category parameter should be a number')
+
+    def get_q(self, values):
+        from product.models import Product
+
+        # A subquery won't duplicate products that are in more than one of the categories
+        return Q(id__in=Product.category.through.objects.filter(category_id__in=values).values('product_id'))
+
+class FeaturedFacet(Facet):
+    name = 'featured'
+
+    def get_values(self, product, categories):
+        return ['true' if product['is_featured'] else 'false']
+
+    def parse(self, value):
+        # Any other value is ignored, like the product list always did
+        return value if value in ['true', 'false'] else None
+
+    def get_q(self, values):
+        q = Q()
+        if 'true' in values:
+            q |= Q(is_featured=True)
+        if 'false' in values:
+            q |= Q(is_featured=False) | Q(is_featured__isnull=True)
+        return q
+
+class PriceFacet(Facet):
+    name = 'price'
+
+    def get_values(self, product, categories):
+        return [get_price_bucket(product['price'])]
+
+    def parse(self, value):
+        if value not in PRICE_BUCKET_VALUES:
+            raise ParseError(f'price parameter only accept {", ".join(PRICE_BUCKET_VALUES)}')
+        return value
+
+    def get_q(self, values):
+        q = Q()
+        for (low, high), value in zip(PRICE_BUCKETS, PRICE_BUCKET_VALUES):
+            if value in values:
+                q |= Q(price__gte=low, price__lt=high) if high else Q(price__gte=low)
+        return q
+
+class RatingFacet(Facet):
+    name = 'rating'
+
+    def get_values(self, product, categories):
+        return [get_rating_band(product['rating'])]
+
+    def parse(self, value):
+        if value not in [str(band) for band in RATING_BANDS]:
+            raise ParseError(f'rating parameter only accept {", ".join(str(band) for band in RATING_BANDS)}')
+        return value
+
+    def get_q(self, values):
+        q = Q()
+        for band in RATING_BANDS:
+            if str(band) in values:
+                q |= Q(rating__gte=band) if band == RATING_BANDS[-1] else Q(rating__gte=band, rating__lt=band + 1)
+        return q
+
+FACETS = [CategoryFacet(), FeaturedFacet(), PriceFacet(), RatingFacet()]
+
+def parse_facet_filters(query_params):
+    """
+    Read comma separated facet values from the query parameters,
+    e.g. ?category=1,2&price=0-100000 into {'category': [1, 2], 'price': ['0-100000']}.
+    """
+
+    filters = {}
+    for facet in FACETS:
+        values = [facet.parse(value) for value in query_params.get(facet.name, '').split(',') if value]
+        values = [value for value in values if value is not None]
+        if values:
+            filters[facet.name] = values
+
+    return filters
+
+def get_facet_q(filters):
+    q = Q()
+    for facet in FACETS:
+        if facet.name in filters:
+            q &= facet.get_q(filters[facet.name])
+
+    return q
+
+class FacetIndex:
+    """
+    In-process bitmap index, every facet value hold an int used as a bitset of product ids.
+    Filters are answered with bitwise AND/OR and counted with a popcount.
+
+    Changed product ids are published into the cache after commit, each process
+    apply the changes it hasn't seen before answering, and rebuild from scratch
+    when it missed too many of them. Without a shared cache the changes of other
+    processes are never seen, so the index is also rebuilt every REBUILD_INTERVAL.
+    Only the first build is done on the request, a later one runs in the background
+    while the current index is still answering.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.bitsets = None
+        self.products = 0
+        self.sequence = None
+        self.counts = {}
+        self.built = None
+        self.rebuilding = False
+
+    def rebuild(self):
+        from product.models import Product
+
+        # Read before the rows, a change committed meanwhile is applied again on the next sync
+        sequence = cache.get(FACET_SEQUENCE_KEY)
+        rows = list(Product.objects.values('id', 'is_featured', 'price', 'rating'))
+        size = max([row['id'] for row in rows], default=0) // 8 + 1
+
+        # Set the bits into a bytearray first, shifting a big int for each product is much slower
+        arrays = {facet.name: {} for facet in FACETS}
+        products = bytearray(size)
+        for product_id, product in self.load_products(rows):
+            products[product_id >> 3] |= 1 << (product_id & 7)
+            for facet in FACETS:
+                for value in product[facet.name]:
+                    array = arrays[facet.name].setdefault(value, bytearray(size))
+                    array[product_id >> 3] |= 1 << (product_id & 7)
+
+        bitsets = {
+            facet.name: {value: int.from_bytes(array, 'little') for value, array in arrays[facet.name].items()}
+            for facet in FACETS
+        }
+
+        with self.lock:
+            self.products, self.bitsets = int.from_bytes(products, 'little'), bitsets
+            self.sequence, self.counts, self.built = sequence, {}, time.monotonic()
+
+    def rebuild_in_background(self):
+        close_old_connections()
+        try:
+            self.rebuild()
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def schedule_rebuild(self):
+        if self.rebuilding:
+            return
+
+        if not get_facet_index_setting('BACKGROUND_REBUILD'):
+            return self.rebuild()
+
+        self.rebuilding = True
+        try:
+            rebuild_executor.submit(self.rebuild_in_background)
+        except RuntimeError:
+            # The executor is shut down, e.g. while the worker process exit
+            self.rebuilding = False
+            self.rebuild()
+
+    def load_products(self, rows, product_ids=None):
+        from product.models import Product
+
+        categories = {}
+        links = Product.category.through.objects.values_list('product_id', 'category_id')
+        if product_ids is not None:
+            links = links.filter(product_id__in=product_ids)
+
+        for product_id, category_id in links:
+            categories.setdefault(product_id, []).append(category_id)
+
+        for row in rows:
+            yield row['id'], {
+                facet.name: facet.get_values(row, categories.get(row['id'], []))
+                for facet in FACETS
+            }
+
+    def apply(self, product_ids):
+        from product.models import Product
+
+        rows = list(Product.objects.filter(id__in=product_ids).values('id', 'is_featured', 'price', 'rating'))
+
+        # Clear every bit of the changed products, then set the bits of those that still exist
+        mask = 0
+        for product_id in product_ids:
+            mask |= 1 << product_id
+        mask = ~mask
+
+        for values in self.bitsets.values():
+            for value in values:
+                values[value] &= mask
+        self.products &= mask
+
+        for product_id, product in self.load_products(rows, product_ids):
+            bit = 1 << product_id
+            for facet in FACETS:
+                for value in product[facet.name]:
+                    self.bitsets[facet.name][value] = self.bitsets[facet.name].get(value, 0) | bit
+            self.products |= bit
+
+    def sync(self):
+        with self.lock:
+            if self.bitsets is None:
+                # Nothing to answer with yet
+                return self.rebuild()
+
+            # The changes seen meanwhile are part of the rebuilt index
+            if self.rebuilding:
+                return
+
+            sequence = cache.get(FACET_SEQUENCE_KEY)
+            if sequence != self.sequence:
+                changes = None
+                if sequence is not None and self.sequence is not None and 0 < sequence - self.sequence <= FACET_MAX_CHANGES:
+                    keys = [f'catalog:facets:change:{number}' for number in range(self.sequence + 1, sequence + 1)]
+                    changes = cache.get_many(keys)
+                    changes = changes if len(changes) == len(keys) else None
+
+                product_ids = {product_id for product_ids in (changes or {}).values() for product_id in product_ids}
+                if changes is None or len(product_ids) > FACET_MAX_CHANGES:
+                    return self.schedule_rebuild()
+
+                self.apply(product_ids)
+                self.sequence = sequence
+                self.counts = {}
+
+            interval = get_facet_index_setting('REBUILD_INTERVAL')
+            if not get_facet_index_setting('SHARED_CHANGES') and interval is not None and time.monotonic() - self.built >= interval:
+                self.schedule_rebuild()
+
+    def reset(self):
+        with self.lock:
+            self.bitsets, self.products, self.sequence, self.counts = None, 0, None, {}
+            self.built, self.rebuilding = None, False
+
+    def filter(self, filters, exclude=None):
+        bitset = self.products
+        for facet in FACETS:
+            if facet.name in filters and facet.name != exclude:
+                facet_bitset = 0
+                for value in filters[facet.name]:
+                    facet_bitset |= self.bitsets[facet.name].get(value, 0)
+                bitset &= facet_bitset
+
+        return bitset
+
+    def count(self, filters):
+        """
+        Return the number of products matching the filters and the count of every facet value,
+        each facet is counted with the filters of the other facets only, so selecting a value
+        still show how many products the other values of the same facet would add.
+        """
+
+        key = tuple((name, tuple(sorted(set(values)))) for name, values in sorted(filters.items()))
+
+        with self.lock:
+            self.sync()
+
+            # Counting every value cost a popcount over all product ids, so repeated filters are kept
+            if key in self.counts:
+                return self.counts[key]
+
+            facets = {}
+            for facet in FACETS:
+                bitset = self.filter(filters, exclude=facet.name)
+                facets[facet.name] = {
+                    value: count_bits(bitset & value_bitset)
+                    for value, value_bitset in self.bitsets[facet.name].items()
+                }
+
+            if len(self.counts) >= FACET_COUNT_CACHE_SIZE:
+                self.counts = {}
+
+            self.counts[key] = count_bits(self.filter(filters)), facets
+            return self.counts[key]
+
+facet_index = FacetIndex()
+
+def publish_product_changes(product_ids):
+    """
+    Publish changed product ids for every process facet index once the transaction is committed.
+    """
+
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+
+    def publish():
+        try:
+            sequence = cache.incr(FACET_SEQUENCE_KEY)
+        except ValueError:
+            # Start from the current time, so an evicted counter is never mistaken for an older sequence
+            cache.add(FACET_SEQUENCE_KEY, int(time.time() * 1000), timeout=None)
+            sequence = cache.incr(FACET_SEQUENCE_KEY)
+
+        cache.set(f'catalog:facets:change:{sequence}', product_ids, timeout=FACET_CHANGE_TIMEOUT)
+
+    transaction.on_commit(publish)
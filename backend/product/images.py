@@ -0,0 +1,123 @@
+import base64
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Every variant fit inside a square of this size, smaller images are never upscaled
+IMAGE_VARIANTS = (
+    ('thumbnail', 160),
+    ('card', 480),
+    ('detail', 1080),
+)
+
+# (key, Pillow format, file extension, save options)
+VARIANT_FORMATS = (
+    ('webp', 'WEBP', 'webp', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+VARIANT_DIRECTORY = 'variants'
+
+# Placeholder shown while the image load, small enough to be inlined into the API response
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_OPTIONS = {'quality': 40}
+
+IMAGE_VARIANT_DEFAULTS = {
+    # Build variants in a process pool after the upload is committed
+    'BACKGROUND': True,
+    'WORKERS': 2,
+}
+
+variant_executor = None
+
+def get_image_variant_setting(name):
+    return getattr(settings, 'IMAGE_VARIANTS', {}).get(name, IMAGE_VARIANT_DEFAULTS[name])
+
+def get_variant_executor():
+    global variant_executor
+
+    if variant_executor is None:
+        variant_executor = ProcessPoolExecutor(max_workers=get_image_variant_setting('WORKERS'))
+
+    return variant_executor
+
+def get_variant_name(image_name, variant, extension):
+    return f'{VARIANT_DIRECTORY}/{os.path.splitext(image_name)[0]}-{variant}.{extension}'
+
+def flatten_image(image):
+    if image.mode in ['RGBA', 'LA', 'P']:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+
+    return image.convert('RGB')
+
+def get_placeholder(image):
+    placeholder = image.copy()
+    placeholder.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.LANCZOS)
+
+    content = io.BytesIO()
+    placeholder.save(content, 'WEBP', **PLACEHOLDER_OPTIONS)
+    return f'data:image/webp;base64,{base64.b64encode(content.getvalue()).decode("ascii")}'
+
+def get_dominant_color(image):
+    # The most used color of a reduced palette, so noise and gradients are merged into one color
+    palette_image = image.quantize(colors=5, method=Image.MEDIANCUT)
+    count, index = max(palette_image.getcolors())
+    red, green, blue = palette_image.getpalette()[index * 3:index * 3 + 3]
+    return f'#{red:02x}{green:02x}{blue:02x}'
+
+def build_variants(media_root, image_name):
+    """
+    Resize an image into every variant and format, then return
+    {'source': image_name, 'sizes': {variant: {'width', 'height', format key: file name}}, 'placeholder', 'color'}.
+    Only use the file system so it can run in a worker process without Django.
+    """
+
+    with Image.open(os.path.join(media_root, image_name)) as original:
+        # Apply the EXIF orientation before the metadata is dropped
+        image = flatten_image(ImageOps.exif_transpose(original))
+
+    # Variants are saved without the original metadata (EXIF, XMP, comments)
+    image.info = {}
+
+    sizes, thumbnail = {}, None
+    for variant, size in IMAGE_VARIANTS:
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        sizes[variant] = {'width': resized.width, 'height': resized.height}
+
+        # The placeholder and color are computed from the smallest variant
+        if thumbnail is None:
+            thumbnail = resized
+
+        for key, image_format, extension, options in VARIANT_FORMATS:
+            name = get_variant_name(image_name, variant, extension)
+            path = os.path.join(media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write beside the target then swap, so a half written file is never served,
+            # galleries sharing the same image may build the same variants concurrently
+            temporary_path = f'{path}.{os.getpid()}.tmp'
+            resized.save(temporary_path, image_format, **options)
+            os.replace(temporary_path, path)
+            sizes[variant][key] = name
+
+    return {
+        'source': image_name,
+        'sizes': sizes,
+        'placeholder': get_placeholder(thumbnail),
+        'color': get_dominant_color(thumbnail),
+    }
+
+def delete_image_variants(image_name):
+    for variant, size in IMAGE_VARIANTS:
+        for key, image_format, extension, options in VARIANT_FORMATS:
+            name = get_variant_name(image_name, variant, extension)
+            if default_storage.exists(name):
+                default_storage.delete(name)
@@ -0,0 +1,93 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from product.models import Category, Product
+from product.search import get_search_backend, search_products
+
+class Command(BaseCommand):
+    help = 'Benchmark the product search index on a synthetic catalog, the catalog is rolled back afterward'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if backend is None:
+            raise CommandError(f'Product search is not supported on {connection.vendor}')
+
+        self.random = random.Random(options['seed'])
+        self.vocabulary = self.build_vocabulary(5000)
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            self.build_catalog(backend, options['products'], options['batch_size'])
+            self.stdout.write(f'Indexed {options["products"]} products in {time.perf_counter() - started:.1f}s')
+
+            timings = self.run_queries(options['queries'])
+            transaction.set_rollback(True)
+
+        timings.sort()
+        percentile = lambda p: timings[min(int(len(timings) * p), len(timings) - 1)]
+        self.stdout.write(
+            f'{len(timings)} queries on {connection.vendor}: '
+            f'mean {statistics.mean(timings):.2f}ms, p50 {percentile(0.5):.2f}ms, '
+            f'p95 {percentile(0.95):.2f}ms, p99 {percentile(0.99):.2f}ms, max {timings[-1]:.2f}ms'
+        )
+
+        if percentile(0.95) < 10:
+            self.stdout.write(self.style.SUCCESS('p95 is under 10ms'))
+        else:
+            self.stdout.write(self.style.WARNING('p95 is over 10ms'))
+
+    def build_vocabulary(self, n):
+        syllables = ['ka', 'lo', 'mi', 'ru', 'sen', 'ta', 'vel', 'on', 'ir', 'dra', 'po', 'qu', 'shi', 'ne', 'bor', 'ax']
+        return list({''.join(self.random.choice(syllables) for i in range(self.random.randint(2, 4))) for i in range(n)})
+
+    def words(self, n):
+        return ' '.join(self.random.choice(self.vocabulary) for i in range(n))
+
+    def build_catalog(self, backend, n, batch_size):
+        categories = Category.objects.bulk_create([Category(name=self.words(1).title()) for i in range(30)])
+        category_ids = list(Category.objects.order_by('-id').values_list('id', flat=True)[:len(categories)])
+
+        for start in range(0, n, batch_size):
+            slugs = [f'search-benchmark-{i}' for i in range(start, min(start + batch_size, n))]
+            Product.objects.bulk_create([
+                Product(name=self.words(2).title(),
+                        slug=slug,
+                        description=self.words(20).capitalize(),
+                        material=self.words(2).upper(),
+                        price=self.random.randint(1000, 1000000))
+                for slug in slugs
+            ])
+
+            product_ids = list(Product.objects.filter(slug__in=slugs).values_list('id', flat=True))
+            Product.category.through.objects.bulk_create([
+                Product.category.through(product_id=product_id, category_id=self.random.choice(category_ids))
+                for product_id in product_ids
+            ])
+
+            with connection.cursor() as cursor:
+                backend.index(cursor, product_ids)
+
+    def run_queries(self, n):
+        timings = []
+
+        for i in range(n):
+            # Mix full words with a prefix, like someone typing in a search box
+            query = self.words(self.random.randint(1, 2))
+            if self.random.random() < 0.5:
+                query = query[:max(len(query) - 2, 2)]
+
+            started = time.perf_counter()
+            search_products(query)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        return timings
@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from product.cache import invalidate_catalog_cache
+from product.images import build_variants, get_image_variant_setting
+from product.models import Gallery, Product, touch_products, update_gallery_variants
+
+class Command(BaseCommand):
+    help = (
+        'Build the resized variants, placeholder and dominant color of gallery images '
+        'that are missing or outdated, using a pool of worker processes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=get_image_variant_setting('WORKERS'))
+        parser.add_argument('--batch-size', type=int, default=200, help='Images submitted to the pool at once')
+        parser.add_argument('--all', action='store_true', help='Rebuild the variants of every image')
+
+    def handle(self, *args, **options):
+        galleries = Gallery.objects.exclude(image='').order_by('id').values_list('id', 'image', 'variants', 'placeholder')
+        pending = [
+            (gallery_id, image) for gallery_id, image, variants, placeholder in galleries.iterator(chunk_size=2000)
+            if options['all'] or variants.get('source') != image or not placeholder
+        ]
+
+        started, built, failed = time.perf_counter(), 0, 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            for start in range(0, len(pending), options['batch_size']):
+                futures = {
+                    executor.submit(build_variants, settings.MEDIA_ROOT, image): gallery_id
+                    for gallery_id, image in pending[start:start + options['batch_size']]
+                }
+
+                built_ids = []
+                for future in as_completed(futures):
+                    gallery_id = futures[future]
+                    try:
+                        result = future.result()
+                    except OSError as e:
+                        failed += 1
+                        self.stderr.write(f'Failed to build variants of gallery {gallery_id}: {e}')
+                        continue
+
+                    if update_gallery_variants(gallery_id, result):
+                        built_ids.append(gallery_id)
+
+                touch_products(Product.objects.filter(gallery__id__in=built_ids))
+                built += len(built_ids)
+                self.stdout.write(f'Built variants of {built}/{len(pending)} images')
+
+        invalidate_catalog_cache()
+        self.stdout.write(self.style.SUCCESS(
+            f'Built variants of {built} images in {time.perf_counter() - started:.1f}s, {failed} failed'
+        ))
@@ -0,0 +1,209 @@
+import csv
+import io
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.files.images import get_image_dimensions
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from product.cache import invalidate_catalog_cache
+from product.facets import publish_product_changes
+from product.models import Category, Gallery, Product, IMAGE_TYPE_CHOICES, refresh_category_counts
+from product.search import index_products
+from Virtuele.db import insert_rows
+
+IMAGE_TYPES = [image_type for image_type, display in IMAGE_TYPE_CHOICES]
+
+def read_json(stream, chunk_size=1 << 16):
+    """
+    Yield every object of a JSON array without loading the whole file.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = stream.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError('JSON catalog should be an array of products')
+
+    buffer, position = buffer[1:], 0
+    while True:
+        # Skip whitespace and separator between objects
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            record, position = decoder.raw_decode(buffer, position)
+            yield record
+        except json.JSONDecodeError:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise CommandError('JSON catalog ended before the array is closed')
+            buffer, position = buffer[position:] + chunk, 0
+
+def read_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+def read_csv(stream):
+    """
+    CSV columns are the product fields, categories are separated by '|'
+    and gallery images are written as 'TYPE:image' separated by '|'.
+    """
+
+    for row in csv.DictReader(stream):
+        row['categories'] = [name for name in (row.get('categories') or '').split('|') if name]
+        row['gallery'] = [
+            dict(zip(('image_type', 'image'), image.split(':', 1))) if ':' in image else {'image': image}
+            for image in (row.get('gallery') or '').split('|') if image
+        ]
+        yield row
+
+READERS = {
+    'json': read_json,
+    'ndjson': read_ndjson,
+    'csv': read_csv,
+}
+
+FORMAT_EXTENSIONS = {
+    'json': 'json',
+    'ndjson': 'ndjson',
+    'jsonl': 'ndjson',
+    'csv': 'csv',
+}
+
+class Command(BaseCommand):
+    help = (
+        'Stream products from a JSON array, NDJSON or CSV file and bulk insert them with their categories and gallery. '
+        'Each record has name, description, price, material, is_featured, categories (names) '
+        'and gallery (objects with image, image_type, width and height).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Catalog file, or '-' to read from stdin")
+        parser.add_argument('--format', choices=list(READERS), help='Guessed from the file extension if not set')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or FORMAT_EXTENSIONS.get(options['path'].rsplit('.', 1)[-1].lower())
+        if not file_format:
+            raise CommandError('Unknown catalog format, set it with --format')
+
+        self.batch_size = options['batch_size']
+        # One lookup for every existing slug and category, then they are tracked in memory
+        self.slugs = set(Product.objects.values_list('slug', flat=True).iterator(chunk_size=10000))
+        self.categories = {name: id for id, name in Category.objects.order_by('-id').values_list('id', 'name')}
+
+        started, imported = time.perf_counter(), 0
+        stream = sys.stdin if options['path'] == '-' else io.open(options['path'], encoding='utf-8', newline='')
+
+        try:
+            batch = []
+            for number, record in enumerate(READERS[file_format](stream), start=1):
+                batch.append(self.clean_record(number, record))
+
+                if len(batch) >= self.batch_size:
+                    imported += self.import_batch(batch)
+                    batch = []
+                    self.stdout.write(f'Imported {imported} products')
+
+            if batch:
+                imported += self.import_batch(batch)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        # Signals are skipped by bulk_create, so the search index and facets are updated per batch
+        # and the catalog cache is invalidated once at the end
+        invalidate_catalog_cache()
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} products in {time.perf_counter() - started:.1f}s'))
+
+    def clean_record(self, number, record):
+        try:
+            if not record.get('name'):
+                raise ValueError('name is required')
+
+            gallery = []
+            for image in record.get('gallery') or []:
+                image_type = image.get('image_type') or IMAGE_TYPES[0]
+                if image_type not in IMAGE_TYPES:
+                    raise ValueError(f'image_type should be one of {", ".join(IMAGE_TYPES)}')
+
+                if image.get('width') and image.get('height'):
+                    width, height = int(image['width']), int(image['height'])
+                else:
+                    # Read the size from the stored file like the ImageField does on save
+                    with default_storage.open(image['image']) as file:
+                        width, height = get_image_dimensions(file)
+
+                gallery.append((image['image'], image_type, width, height))
+
+            return {
+                'name': record['name'],
+                'description': record.get('description') or 'This product does not have a description yet.',
+                'price': float(record.get('price') or 0),
+                'material': record.get('material') or '',
+                'is_featured': str(record.get('is_featured')).lower() in ['true', '1', 'yes'],
+                'categories': record.get('categories') or [],
+                'gallery': gallery,
+            }
+        except (AttributeError, KeyError, TypeError, ValueError, OSError) as e:
+            raise CommandError(f'Invalid product on record {number}: {e}')
+
+    def unique_slug(self, name):
+        slug = base = slugify(name)
+        suffix = 1
+
+        while slug in self.slugs:
+            suffix += 1
+            slug = f'{base}-{suffix}'
+
+        self.slugs.add(slug)
+        return slug
+
+    def import_batch(self, batch):
+        with transaction.atomic():
+            new_categories = {name for record in batch for name in record['categories'] if name not in self.categories}
+            if new_categories:
+                Category.objects.bulk_create([Category(name=name) for name in new_categories])
+                self.categories.update(Category.objects.filter(name__in=new_categories).values_list('name', 'id'))
+
+            products = [
+                Product(slug=self.unique_slug(record['name']),
+                        **{field: record[field] for field in ('name', 'description', 'price', 'material', 'is_featured')})
+                for record in batch
+            ]
+            Product.objects.bulk_create(products, batch_size=self.batch_size)
+
+            # Only some database backend set the primary key on bulk_create
+            if any(product.pk is None for product in products):
+                product_ids = dict(Product.objects.filter(slug__in=[product.slug for product in products]).values_list('slug', 'id'))
+                for product in products:
+                    product.pk = product_ids[product.slug]
+
+            links = [
+                (product.pk, self.categories[name])
+                for product, record in zip(products, batch) for name in set(record['categories'])
+            ]
+            insert_rows(Product.category.through, ['product_id', 'category_id'], links)
+            refresh_category_counts({category_id for product_id, category_id in links})
+
+            # Variants, placeholder and color are left empty for build_gallery_variants to fill
+            updated = connection.ops.adapt_datetimefield_value(timezone.now())
+            variants = Gallery._meta.get_field('variants').get_db_prep_save({}, connection)
+            insert_rows(Gallery, ['product_id', 'image', 'image_type', 'width', 'height', 'variants', 'placeholder', 'color', 'updated'], [
+                (product.pk, *image, variants, '', '', updated)
+                for product, record in zip(products, batch) for image in record['gallery']
+            ])
+
+            index_products([product.pk for product in products])
+            publish_product_changes([product.pk for product in products])
+
+        return len(products)
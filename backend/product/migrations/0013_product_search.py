@@ -0,0 +1,50 @@
+from django.db import migrations
+
+# The DDL is written as it was when the migration was made, later changes to product.search don't rewrite history
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_search "
+    "USING fts5(name, description, material, categories, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "INSERT INTO product_search (rowid, name, description, material, categories) "
+    "SELECT p.id, p.name, COALESCE(p.description, ''), COALESCE(p.material, ''), "
+    "COALESCE((SELECT group_concat(c.name, ' ') FROM product_product_category pc "
+    "JOIN product_category c ON c.id = pc.category_id WHERE pc.product_id = p.id), '') "
+    "FROM product_product p",
+]
+
+POSTGRESQL_CREATE = [
+    "CREATE TABLE IF NOT EXISTS product_search (product_id integer PRIMARY KEY, document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS product_search_document_idx ON product_search USING GIN (document)",
+    "INSERT INTO product_search (product_id, document) "
+    "SELECT p.id, "
+    "setweight(to_tsvector('simple', p.name), 'A') || "
+    "setweight(to_tsvector('simple', COALESCE((SELECT string_agg(c.name, ' ') FROM product_product_category pc "
+    "JOIN product_category c ON c.id = pc.category_id WHERE pc.product_id = p.id), '')), 'B') || "
+    "setweight(to_tsvector('simple', COALESCE(p.material, '')), 'C') || "
+    "setweight(to_tsvector('simple', COALESCE(p.description, '')), 'D') "
+    "FROM product_product p "
+    "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+]
+
+CREATE_SEARCH_INDEX = {
+    'sqlite': SQLITE_CREATE,
+    'postgresql': POSTGRESQL_CREATE,
+}
+
+def create_search_index(apps, schema_editor):
+    for statement in CREATE_SEARCH_INDEX.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in CREATE_SEARCH_INDEX:
+        schema_editor.execute('DROP TABLE IF EXISTS product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0012_auto_20261018_1035'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
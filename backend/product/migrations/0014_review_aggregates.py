@@ -0,0 +1,33 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:47
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+def fill_review_aggregates(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+
+    for product in Product.objects.annotate(count=Count('review'), sum=Sum('review__rating')).filter(count__gt=0):
+        Product.objects.filter(id=product.id).update(review_count=product.count,
+                                                     rating_sum=product.sum,
+                                                     rating=product.sum / product.count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0013_product_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_review_aggregates, migrations.RunPython.noop),
+    ]
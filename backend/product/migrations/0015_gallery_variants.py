@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0014_review_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallery',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
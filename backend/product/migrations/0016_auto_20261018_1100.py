@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0015_gallery_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='gallery',
+            name='image',
+            field=models.ImageField(db_index=True, height_field='height', upload_to='', width_field='width'),
+        ),
+    ]
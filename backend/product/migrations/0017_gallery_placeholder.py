@@ -0,0 +1,23 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0016_auto_20261018_1100'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallery',
+            name='color',
+            field=models.CharField(blank=True, default='', editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name='gallery',
+            name='placeholder',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:07
+
+from django.db import migrations, models
+from django.db.models import Count
+
+def fill_product_count(apps, schema_editor):
+    Category = apps.get_model('product', 'Category')
+
+    for category in Category.objects.annotate(count=Count('product')).filter(count__gt=0):
+        Category.objects.filter(id=category.id).update(product_count=category.count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0017_gallery_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_product_count, migrations.RunPython.noop),
+        # Products of a category read in id order straight from the index, for keyset pagination
+        migrations.RunSQL(
+            'CREATE INDEX product_product_category_category_product_idx '
+            'ON product_product_category (category_id, product_id)',
+            'DROP INDEX product_product_category_category_product_idx',
+        ),
+    ]
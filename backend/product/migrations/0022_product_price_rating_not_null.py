@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+def fill_null_price_rating(apps, schema_editor):
+    # A null price or rating was already shown and sorted as the lowest value
+    Product = apps.get_model('product', 'Product')
+    Product.objects.filter(price__isnull=True).update(price=0)
+    Product.objects.filter(rating__isnull=True).update(rating=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0021_stock'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_null_price_rating, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='price',
+            field=models.FloatField(blank=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='rating',
+            field=models.FloatField(blank=True, default=0),
+        ),
+    ]
@@ -1,10 +1,17 @@
 from rest_framework.exceptions import ValidationError as RESTValidationError
-from django.db import models
+from django.db import connection, models, transaction
+from django.utils import timezone
 from django.utils.text import slugify
 from django.contrib.auth import get_user_model
 from django.dispatch import receiver
-from django.db.models import Sum
-import os
+from django.db.models import Case, Count, ExpressionWrapper, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.conf import settings
+from Virtuele.storage import ContentAddressedStorage, file_deleted, release_files
+from product.cache import invalidate_catalog_cache
+from product.facets import publish_product_changes
+from product.images import build_variants, delete_image_variants, get_image_variant_setting, get_variant_executor
+from product.search import index_products, remove_products
 import random
 
 SIZE_CHOICES = (
@@ -30,19 +37,52 @@ RATING_CHOICES = (
 
 class Category(models.Model):
     name = models.CharField(max_length=255)
+    # Kept by refresh_category_counts() whenever products are added or removed
+    product_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self, *args, **kwargs):
         return self.name
 
+class ProductQuerySet(models.QuerySet):
+    def catalog(self, fields=None):
+        # Load categories and every gallery row in one query each,
+        # ProductSerializer will split model shots from product shots in memory.
+        # With the picked serializer fields, only load what those fields show
+        queryset = self
+        if fields is None or 'category' in fields:
+            queryset = queryset.prefetch_related('category')
+        if fields is None or {'model', 'gallery', 'thumbnail'} & set(fields):
+            queryset = queryset.prefetch_related('gallery')
+
+        # The long text columns aren't needed for pagination or ordering
+        deferred = [name for name in ['description', 'material'] if fields is not None and name not in fields]
+        return queryset.defer(*deferred) if deferred else queryset
+
+REVIEW_AGGREGATE_FIELDS = ('review_count', 'rating_sum', 'rating')
+
 class Product(models.Model):
     name = models.CharField(verbose_name='Product Name', max_length=255)
     slug = models.CharField(null=True, editable=False, max_length=255, unique=True)
     description = models.CharField(null=True, blank=True, max_length=1024)
-    price = models.FloatField(null=True, blank=True, default=0)
+    # Never null so keyset pages seek on the plain (price, id) and (rating, id) indexes
+    price = models.FloatField(blank=True, default=0)
     category = models.ManyToManyField(Category, related_name='product')
     material = models.TextField(null=True, blank=True, max_length=255, default='')
     is_featured = models.BooleanField(null=True, blank=True, default=False)
-    rating = models.FloatField(null=True, blank=True, default=0)
+    rating = models.FloatField(blank=True, default=0)
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    # Updated whenever anything shown on the product payload changed
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # Keyset pagination seeks on (sort field, id)
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['rating', 'id'], name='product_rating_id_idx'),
+        ]
 
     def __str__(self, *args, **kwargs):
         return self.name
@@ -50,14 +90,20 @@ class Product(models.Model):
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
         if not self.description: self.description = 'This product does not have a description yet.'
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # The review aggregates are only moved by update_review_aggregates() with F() increments,
+            # writing back the loaded values would undo a review posted since the product was loaded
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in REVIEW_AGGREGATE_FIELDS
+            ]
         return super(Product, self).save(*args, **kwargs)
 
 @receiver(models.signals.post_save, sender=Product)
 def product_post_save(sender, instance, created, **kwargs):
-    product_carts = instance.product_cart.filter(product=instance, cart__checked_out=False)
-    if product_carts.exists():
-        for product_cart in product_carts:
-            product_cart.save()
+    invalidate_catalog_cache()
+    index_products([instance.id])
+    publish_product_changes([instance.id])
 
 @receiver(models.signals.pre_save, sender=Product)
 def product_pre_save(sender, instance, **kwargs):
@@ -70,7 +116,14 @@ class Gallery(models.Model):
     image_type = models.TextField(choices=IMAGE_TYPE_CHOICES, default=IMAGE_TYPE_CHOICES[0][0], max_length=2)
     height = models.IntegerField(blank=True, null=True)
     width = models.IntegerField(blank=True, null=True)
-    image = models.ImageField(upload_to='', height_field='height', width_field='width')
+    # Indexed to count the references of a stored file before it is deleted
+    image = models.ImageField(upload_to='', height_field='height', width_field='width', db_index=True)
+    # Resized copies of the image, filled by build_gallery_variants()
+    variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Inline base64 image and hex color shown while the image load
+    placeholder = models.TextField(blank=True, default='', editable=False)
+    color = models.CharField(blank=True, default='', editable=False, max_length=7)
+    updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.image_type}-{self.product.slug}-{self.width}x{self.height}'
@@ -78,8 +131,7 @@ class Gallery(models.Model):
 @receiver(models.signals.post_delete, sender=Gallery)
 def auto_delete_gallery_image_on_delete(sender, instance, **kwargs):
     if instance.image:
-        if os.path.isfile(instance.image.path):
-            os.remove(instance.image.path)
+        release_files([instance.image.name])
 
 @receiver(models.signals.pre_save, sender=Gallery)
 def auto_delete_gallery_image_on_change(sender, instance, **kwargs):
@@ -91,8 +143,62 @@ def auto_delete_gallery_image_on_change(sender, instance, **kwargs):
         return False
     new_file = instance.image
     if not old_file == new_file:
-        if os.path.isfile(old_file.path):
-            os.remove(old_file.path)
+        instance.variants, instance.placeholder, instance.color = {}, '', ''
+        release_files([old_file.name])
+
+@receiver(file_deleted, sender=ContentAddressedStorage)
+def delete_gallery_variants(sender, name, **kwargs):
+    delete_image_variants(name)
+
+def update_gallery_variants(gallery_id, result):
+    """
+    Store the result of build_variants() and return whether the gallery was updated,
+    the variants are only kept if the image wasn't replaced while they were built.
+    """
+
+    placeholder, color = result.pop('placeholder'), result.pop('color')
+    updated = Gallery.objects.filter(id=gallery_id, image=result['source']).update(
+        variants=result,
+        placeholder=placeholder,
+        color=color,
+        updated=timezone.now()
+    )
+
+    if not updated:
+        release_files([result['source']])
+
+    return bool(updated)
+
+def save_gallery_variants(gallery_id, result):
+    if not update_gallery_variants(gallery_id, result):
+        return
+
+    invalidate_catalog_cache()
+    touch_products(Product.objects.filter(gallery__id=gallery_id))
+
+def save_gallery_variants_in_background(gallery_id, future):
+    try:
+        save_gallery_variants(gallery_id, future.result())
+    finally:
+        connection.close()
+
+def build_gallery_variants(gallery_id, image_name):
+    """
+    Build the resized variants of a gallery image in the process pool,
+    the worker only resize the file and the result is saved from this process.
+    """
+
+    if not get_image_variant_setting('BACKGROUND'):
+        return save_gallery_variants(gallery_id, build_variants(settings.MEDIA_ROOT, image_name))
+
+    future = get_variant_executor().submit(build_variants, settings.MEDIA_ROOT, image_name)
+    future.add_done_callback(lambda future: save_gallery_variants_in_background(gallery_id, future))
+
+@receiver(models.signals.post_save, sender=Gallery)
+def gallery_variants_post_save(sender, instance, **kwargs):
+    if instance.image and instance.variants.get('source') != instance.image.name:
+        # The worker read the stored file, so wait until the row is committed
+        transaction.on_commit(lambda: build_gallery_variants(instance.id, instance.image.name))
 
 class Review(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='review')
@@ -100,20 +206,170 @@ class Review(models.Model):
     rating = models.IntegerField(choices=RATING_CHOICES)
     review = models.CharField(null=True, blank=True, max_length=1024)
     date = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Review feeds of a product or an user seek on id
+        indexes = [
+            models.Index(fields=['product', 'id'], name='review_product_id_idx'),
+            models.Index(fields=['user', 'id'], name='review_user_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s Rating on {self.product.name}"
 
+class Stock(models.Model):
+    """
+    Units left of a product size, a size without stock row is never limited.
+    Checkouts only change the quantity by conditional UPDATE, see cart.models.reserve_cart_stock().
+    """
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock')
+    size = models.CharField(choices=SIZE_CHOICES, max_length=1)
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'size'], name='stock_product_size_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.product} {self.size} ({self.quantity})'
+
+class RelatedProduct(models.Model):
+    """
+    Products frequently bought together with a product, in rank order.
+    The whole table is rebuilt offline from the order lines of checked out carts by the build_related_products command.
+    """
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_product')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    # Number of checked out carts containing both products
+    score = models.PositiveIntegerField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        # Also the index used to read the neighbours of a product in order
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='related_product_rank_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.product} - {self.related} ({self.score})'
+
+def update_product_rating(product_id, count_delta, sum_delta):
+    # Every F() on the right hand side read the value before this update,
+    # so the average is computed from the new count and sum in the same statement
+    review_count = F('review_count') + count_delta
+    rating_sum = F('rating_sum') + sum_delta
+    rating = ExpressionWrapper(Cast(rating_sum, models.FloatField()) / review_count, output_field=models.FloatField())
+
+    # Use update() so a rating change won't fire the product signals (and re-save every cart)
+    Product.objects.filter(id=product_id).update(
+        review_count=review_count,
+        rating_sum=rating_sum,
+        rating=Case(When(review_count__gt=-count_delta, then=rating), default=Value(0.0)),
+        updated=timezone.now()
+    )
+    publish_product_changes([product_id])
+
 @receiver(models.signals.post_save, sender=Review)
+def set_product_rating_ps(sender, instance, created, **kwargs):
+    invalidate_catalog_cache()
+    previous = getattr(instance, 'previous_rating', None)
+
+    if not previous:
+        update_product_rating(instance.product_id, 1, instance.rating)
+    elif previous['product_id'] == instance.product_id:
+        update_product_rating(instance.product_id, 0, instance.rating - previous['rating'])
+    else:
+        update_product_rating(previous['product_id'], -1, -previous['rating'])
+        update_product_rating(instance.product_id, 1, instance.rating)
+
 @receiver(models.signals.post_delete, sender=Review)
-def set_product_rating_ps(sender, instance, **kwargs):
-    all_reviews = Review.objects.filter(product=instance.product)
-    review_count = all_reviews.count()
-    review_sum = all_reviews.aggregate(Sum('rating'))
+def unset_product_rating_pd(sender, instance, **kwargs):
+    invalidate_catalog_cache()
+    update_product_rating(instance.product_id, -1, -instance.rating)
+
+def touch_products(product_qs):
+    # Use update() so changing a related row won't fire the product signals
+    product_qs.update(updated=timezone.now())
+
+@receiver(models.signals.post_delete, sender=Product)
+def product_post_delete(sender, instance, **kwargs):
+    invalidate_catalog_cache()
+    remove_products([instance.id])
+    publish_product_changes([instance.id])
+
+@receiver(models.signals.post_save, sender=Gallery)
+@receiver(models.signals.post_delete, sender=Gallery)
+def gallery_post_change(sender, instance, **kwargs):
+    invalidate_catalog_cache()
+    touch_products(Product.objects.filter(id=instance.product_id))
+
+@receiver(models.signals.post_save, sender=Category)
+def category_post_save(sender, instance, created, **kwargs):
+    invalidate_catalog_cache()
+
+    product_ids = list(Product.objects.filter(category=instance).values_list('id', flat=True))
+    touch_products(Product.objects.filter(id__in=product_ids))
+    index_products(product_ids)
 
-    product = Product.objects.get(id=instance.product.id)
-    product.rating = review_sum['rating__sum'] / review_count if review_count else 0
-    product.save()
+@receiver(models.signals.pre_delete, sender=Category)
+def category_pre_delete(sender, instance, **kwargs):
+    # Remember the products before they are detached from this category
+    instance.detached_product_ids = list(Product.objects.filter(category=instance).values_list('id', flat=True))
+    touch_products(Product.objects.filter(id__in=instance.detached_product_ids))
+
+@receiver(models.signals.post_delete, sender=Category)
+def category_post_delete(sender, instance, **kwargs):
+    invalidate_catalog_cache()
+    index_products(instance.detached_product_ids)
+    publish_product_changes(instance.detached_product_ids)
+
+def refresh_category_counts(category_ids):
+    """
+    Recount the products of the categories in one UPDATE, counting the links
+    is exact even when a removed product wasn't in the category to begin with.
+    """
+
+    links = Product.category.through.objects.filter(category_id=OuterRef('id')).order_by()
+    links = links.values('category_id').annotate(count=Count('id')).values('count')
+    Category.objects.filter(id__in=category_ids).update(product_count=Coalesce(Subquery(links), 0))
+
+@receiver(models.signals.pre_delete, sender=Product)
+def product_pre_delete(sender, instance, **kwargs):
+    # The links are deleted by cascade without any m2m_changed signal
+    instance.detached_category_ids = list(instance.category.values_list('id', flat=True))
+
+@receiver(models.signals.post_delete, sender=Product)
+def product_category_post_delete(sender, instance, **kwargs):
+    refresh_category_counts(instance.detached_category_ids)
+
+@receiver(models.signals.m2m_changed, sender=Product.category.through)
+def product_category_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance.detached_product_ids = list(Product.objects.filter(category=instance).values_list('id', flat=True))
+
+    if action == 'pre_clear' and not reverse:
+        instance.detached_category_ids = list(instance.category.values_list('id', flat=True))
+
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+
+    invalidate_catalog_cache()
+
+    if not reverse:
+        product_ids = [instance.id]
+        category_ids = instance.detached_category_ids if action == 'post_clear' else list(pk_set)
+    else:
+        product_ids = instance.detached_product_ids if action == 'post_clear' else list(pk_set)
+        category_ids = [instance.id]
+
+    refresh_category_counts(category_ids)
+    touch_products(Product.objects.filter(id__in=product_ids))
+    index_products(product_ids)
+    publish_product_changes(product_ids)
 
 @receiver(models.signals.pre_save, sender=Review)
 def review_pre_save(sender, instance, **kwargs):
@@ -127,3 +383,6 @@ def review_pre_save(sender, instance, **kwargs):
     
     if instance.rating > 5 or instance.rating < 1:
         raise RESTValidationError('Rating should be between 1-5', code=400)
+
+    # Remember the stored rating so only the difference is applied to the product
+    instance.previous_rating = Review.objects.filter(pk=instance.pk).values('product_id', 'rating').first() if instance.pk else None
@@ -0,0 +1,163 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Keyset (cursor) pagination
+
+    Order the queryset by one field with the primary key as a tie breaker,
+    then seek past the last seen (value, id) pair instead of using OFFSET,
+    so a deep page cost the same as the first one.
+    The sort field should never be null, the (field, id) index then serve both directions.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering_query_param = 'ordering'
+    page_size = 24
+    max_page_size = 100
+
+    # Map an ordering parameter value into (field, descending)
+    orderings = {
+        'oldest': ('id', False),
+        'newest': ('id', True),
+    }
+    default_ordering = 'oldest'
+
+    def is_requested(self, request):
+        return self.cursor_query_param in request.GET or self.page_size_query_param in request.GET
+
+    def get_ordering(self, request):
+        ordering = request.GET.get(self.ordering_query_param) or self.default_ordering
+
+        if ordering not in self.orderings:
+            raise ParseError(f'Ordering parameter only accept {", ".join(self.orderings)}')
+
+        return self.orderings[ordering]
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.GET.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+
+        return min(max(page_size, 1), self.max_page_size)
+
+    def order_queryset(self, queryset, request, reverse=False):
+        field, descending = self.get_ordering(request)
+        descending = not descending if reverse else descending
+
+        if field == 'id':
+            return queryset.order_by('-id' if descending else 'id')
+
+        return queryset.order_by(f'-{field}', '-id') if descending else queryset.order_by(field, 'id')
+
+    def get_keyset_filter(self, field, descending, value, pk):
+        lookup = 'lt' if descending else 'gt'
+
+        if field == 'id':
+            return Q(**{f'id__{lookup}': pk})
+
+        # The inclusive bound is the index range start, the rest only skips the ties already seen
+        return Q(**{f'{field}__{lookup}e': value}) & (Q(**{f'{field}__{lookup}': value}) | Q(**{f'id__{lookup}': pk}))
+
+    def encode_cursor(self, instance, reverse):
+        cursor = {'v': getattr(instance, self.field), 'id': instance.id, 'r': reverse}
+        return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.GET.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            return cursor['v'], int(cursor['id']), bool(cursor['r'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, descending = self.get_ordering(request)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor[2] if cursor else False
+        queryset = self.order_queryset(queryset, request, reverse=reverse)
+
+        if cursor:
+            descending = not descending if reverse else descending
+            queryset = queryset.filter(self.get_keyset_filter(self.field, descending, cursor[0], cursor[1]))
+
+        # Fetch one extra row to know whether there is another page
+        page = list(queryset[:self.page_size + 1])
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+
+        if reverse:
+            page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = page
+        return page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1], False))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[0], True))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def paginate_if_requested(self, queryset, request, view=None):
+        # Without cursor and page_size every row is returned, only ordered
+        self.request = request
+        if self.is_requested(request):
+            return self.paginate_queryset(queryset, request, view=view)
+
+        return list(self.order_queryset(queryset, request))
+
+    def get_optional_paginated_response(self, data):
+        if self.is_requested(self.request):
+            return self.get_paginated_response(data)
+
+        return Response(data)
+
+class ProductCursorPagination(KeysetCursorPagination):
+    orderings = {
+        'oldest': ('id', False),
+        'newest': ('id', True),
+        'price': ('price', False),
+        '-price': ('price', True),
+        'rating': ('rating', False),
+        '-rating': ('rating', True),
+    }
+
+class ReviewCursorPagination(KeysetCursorPagination):
+    orderings = {
+        'oldest': ('id', False),
+        'newest': ('id', True),
+        'rating': ('rating', False),
+        '-rating': ('rating', True),
+    }
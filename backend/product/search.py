@@ -0,0 +1,190 @@
+import re
+
+from django.db import connection
+
+SEARCH_TABLE = 'product_search'
+
+# Only this many completions of the last term are ranked, so a short prefix cost the same as a rare word
+SEARCH_CANDIDATES = 1000
+
+# Keep the number of query parameters under SQLite limit
+INDEX_BATCH_SIZE = 500
+
+# Search terms are reduced into words, so user input never reach the query syntax
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# A shorter last term is only matched as a whole word, its completions would match most of the catalog
+MIN_PREFIX_LENGTH = 3
+
+def get_search_terms(query):
+    return TERM_PATTERN.findall(query.lower())[:10]
+
+def is_prefix(term):
+    return len(term) >= MIN_PREFIX_LENGTH
+
+class SQLiteSearchBackend:
+    """
+    SQLite FTS5 index, the virtual table rowid is the product id.
+    """
+
+    def create_index(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+            "USING fts5(name, description, material, categories, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+
+    def drop_index(self, cursor):
+        cursor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+    def remove(self, cursor, product_ids):
+        placeholder = ', '.join(['%s'] * len(product_ids))
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholder})', product_ids)
+
+    def index(self, cursor, product_ids=None):
+        if product_ids is None:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+            where, params = '', []
+        else:
+            self.remove(cursor, product_ids)
+            where, params = f"WHERE p.id IN ({', '.join(['%s'] * len(product_ids))})", product_ids
+
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, description, material, categories) '
+            "SELECT p.id, p.name, COALESCE(p.description, ''), COALESCE(p.material, ''), "
+            "COALESCE((SELECT group_concat(c.name, ' ') FROM product_product_category pc "
+            "JOIN product_category c ON c.id = pc.category_id WHERE pc.product_id = p.id), '') "
+            f'FROM product_product p {where}',
+            params
+        )
+
+    def search(self, cursor, terms, limit):
+        match = ' '.join(f'"{term}"' for term in terms)
+        # Every match is ranked, FTS5 optimize ORDER BY rank LIMIT into a top-N scan
+        cursor.execute(
+            f'SELECT rowid FROM {SEARCH_TABLE} '
+            f"WHERE {SEARCH_TABLE} MATCH %s AND rank MATCH 'bm25(10.0, 2.0, 3.0, 5.0)' ORDER BY rank LIMIT %s",
+            [match, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def search_prefix(self, cursor, terms, limit):
+        # Words starting with the last term but not equal to it, those are already ranked by search()
+        match = ' AND '.join([f'"{term}"' for term in terms[:-1]] + [f'("{terms[-1]}"* NOT "{terms[-1]}")'])
+        cursor.execute(
+            f'SELECT id FROM (SELECT rowid AS id, bm25({SEARCH_TABLE}, 10.0, 2.0, 3.0, 5.0) AS rank '
+            f'FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s LIMIT %s) ORDER BY rank LIMIT %s',
+            [match, SEARCH_CANDIDATES, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+class PostgreSQLSearchBackend:
+    """
+    PostgreSQL tsvector column with a GIN index, weighted as
+    name (A), category names (B), material (C) and description (D).
+    """
+
+    DOCUMENT = (
+        "setweight(to_tsvector('simple', p.name), 'A') || "
+        "setweight(to_tsvector('simple', COALESCE((SELECT string_agg(c.name, ' ') FROM product_product_category pc "
+        "JOIN product_category c ON c.id = pc.category_id WHERE pc.product_id = p.id), '')), 'B') || "
+        "setweight(to_tsvector('simple', COALESCE(p.material, '')), 'C') || "
+        "setweight(to_tsvector('simple', COALESCE(p.description, '')), 'D')"
+    )
+
+    def create_index(self, cursor):
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ('
+            'product_id integer PRIMARY KEY, '
+            'document tsvector NOT NULL)'
+        )
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING GIN (document)')
+
+    def drop_index(self, cursor):
+        cursor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+    def remove(self, cursor, product_ids):
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def index(self, cursor, product_ids=None):
+        where, params = ('', []) if product_ids is None else ('WHERE p.id = ANY(%s)', [list(product_ids)])
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (product_id, document) '
+            f'SELECT p.id, {self.DOCUMENT} FROM product_product p {where} '
+            'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+            params
+        )
+
+    def search(self, cursor, terms, limit):
+        # Every row matched through the GIN index is ranked before the top ones are kept
+        cursor.execute(
+            f'SELECT s.product_id FROM {SEARCH_TABLE} s, to_tsquery(%s, %s) query '
+            'WHERE s.document @@ query ORDER BY ts_rank(s.document, query) DESC, s.product_id LIMIT %s',
+            ['simple', ' & '.join(terms), limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def search_prefix(self, cursor, terms, limit):
+        # Words starting with the last term but not equal to it, those are already ranked by search()
+        query = ' & '.join(terms[:-1] + [f'{terms[-1]}:*', f'!{terms[-1]}'])
+        cursor.execute(
+            'SELECT product_id FROM ('
+            f'SELECT s.product_id, ts_rank(s.document, query) AS rank FROM {SEARCH_TABLE} s, to_tsquery(%s, %s) query '
+            'WHERE s.document @@ query LIMIT %s) candidates ORDER BY rank DESC, product_id LIMIT %s',
+            ['simple', query, SEARCH_CANDIDATES, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+def get_search_backend(db_connection=None):
+    backend = SEARCH_BACKENDS.get((db_connection or connection).vendor)
+    return backend() if backend else None
+
+def index_products(product_ids=None):
+    """
+    Rebuild the search document of products with mentioned ids,
+    or every product if no ids are passed.
+    """
+
+    backend = get_search_backend()
+    if backend is None:
+        return
+
+    with connection.cursor() as cursor:
+        if product_ids is None:
+            return backend.index(cursor)
+
+        product_ids = list(product_ids)
+        for start in range(0, len(product_ids), INDEX_BATCH_SIZE):
+            backend.index(cursor, product_ids[start:start + INDEX_BATCH_SIZE])
+
+def remove_products(product_ids):
+    backend = get_search_backend()
+    if backend is None or not product_ids:
+        return
+
+    product_ids = list(product_ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(product_ids), INDEX_BATCH_SIZE):
+            backend.remove(cursor, product_ids[start:start + INDEX_BATCH_SIZE])
+
+def search_products(query, limit=24):
+    """
+    Return matching product ids ordered by relevance.
+    """
+
+    backend = get_search_backend()
+    terms = get_search_terms(query)
+    if backend is None or not terms:
+        return []
+
+    with connection.cursor() as cursor:
+        # Matches of the whole words come first, then the last term is completed since the user may still be typing
+        product_ids = backend.search(cursor, terms, limit)
+        if len(product_ids) < limit and is_prefix(terms[-1]):
+            product_ids += backend.search_prefix(cursor, terms, limit - len(product_ids))
+
+        return product_ids
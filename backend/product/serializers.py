@@ -1,23 +1,41 @@
 from user.serializers import SimpleUserSerializer
-from django.contrib.auth import get_user_model
-from django.db.models.query_utils import Q
+from django.db.models import Prefetch
 from rest_framework import serializers
+from Virtuele.serializers import SparseFieldsMixin, get_nested_sparse_fields
 from product.models import Gallery, Product, Review, SIZE_CHOICES, Category
 from drf_yasg.utils import swagger_serializer_method
+from django.core.files.storage import default_storage
+from product.images import VARIANT_FORMATS
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
-        fields = ('name', 'id')
+        fields = ('name', 'id', 'product_count')
 
 class GallerySerializer(serializers.ModelSerializer):
     product_slug = serializers.CharField(source='product__slug', allow_blank=True, required=False)
     type = serializers.CharField(source='get_image_type_display', allow_blank=True, required=False)
     type_code = serializers.CharField(source='image_type', allow_blank=True, required=False)
-    
+    srcset = serializers.SerializerMethodField()
+
+    @swagger_serializer_method(serializer_or_field=serializers.DictField(child=serializers.DictField()))
+    def get_srcset(self, gallery):
+        # Empty until the variants of the current image are built, use the original image meanwhile
+        if gallery.variants.get('source') != gallery.image.name:
+            return {}
+
+        return {
+            variant: {
+                'width': sizes['width'],
+                'height': sizes['height'],
+                **{key: default_storage.url(sizes[key]) for key, image_format, extension, options in VARIANT_FORMATS},
+            }
+            for variant, sizes in gallery.variants['sizes'].items()
+        }
+
     class Meta:
         model = Gallery
-        fields = ('image', 'width', 'height', 'product_slug', 'type', 'type_code')
+        fields = ('image', 'width', 'height', 'product_slug', 'type', 'type_code', 'srcset', 'placeholder', 'color')
 
 class CreateProductSerializer(serializers.ModelSerializer):
     class Meta:
@@ -30,24 +48,36 @@ class CreateProductSerializer(serializers.ModelSerializer):
         product.category.add(*categories)
         return product
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True, many=True)
     gallery = serializers.SerializerMethodField()
     model = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
 
     @swagger_serializer_method(serializer_or_field=GallerySerializer(many=True))
     def get_gallery(self, product):
-        qs = Gallery.objects.filter(product=product).exclude(image_type='M')
+        qs = [gallery for gallery in product.gallery.all() if not gallery.image_type == 'M']
         return GallerySerializer(instance=qs, many=True).data
 
     @swagger_serializer_method(serializer_or_field=GallerySerializer(many=True))
     def get_model(self, product):
-        qs = Gallery.objects.filter(image_type='M', product=product)
+        qs = [gallery for gallery in product.gallery.all() if gallery.image_type == 'M']
         return GallerySerializer(instance=qs, many=True).data
 
+    @swagger_serializer_method(serializer_or_field=GallerySerializer())
+    def get_thumbnail(self, product):
+        # Only the first product shot, enough for a listing card
+        gallery = next((gallery for gallery in product.gallery.all() if not gallery.image_type == 'M'), None)
+        return GallerySerializer(instance=gallery).data if gallery else None
+
+    @classmethod
+    def prepare_queryset(cls, queryset, fields=None, expand=None):
+        return queryset.catalog(cls.select_fields(fields, expand))
+
     class Meta:
         model = Product
-        fields = ('name', 'slug', 'description', 'price', 'material', 'rating', 'is_featured', 'category', 'model', 'gallery')
+        fields = ('name', 'slug', 'description', 'price', 'material', 'rating', 'is_featured', 'category', 'model', 'gallery', 'thumbnail')
+        expandable_fields = ('thumbnail',)
 
 class SimpleProductSerializer(ProductSerializer):
     class Meta:
@@ -58,23 +88,27 @@ class CreateReviewSerializer(serializers.ModelSerializer):
         model = Review
         fields = ('rating', 'review')
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     user = serializers.SerializerMethodField()
     product = serializers.SerializerMethodField()
 
     @swagger_serializer_method(serializer_or_field=SimpleUserSerializer)
     def get_user(self, review):
-        user = get_user_model().objects.get(id=review.user.id)
-        return {'username': user.username, 'email': user.email}
+        return {'username': review.user.username, 'email': review.user.email}
 
     @swagger_serializer_method(serializer_or_field=SimpleProductSerializer)
     def get_product(self, review):
-        product = Product.objects.get(id=review.product.id)
-        return SimpleProductSerializer(instance=product).data
+        return SimpleProductSerializer(instance=review.product, **self.get_nested_options('product')).data
+
+    @classmethod
+    def prepare_queryset(cls, queryset, fields=None, expand=None):
+        related = [name for name in ['user', 'product'] if name in cls.select_fields(fields, expand)]
+        return queryset.select_related(*related) if related else queryset
 
     class Meta:
         model = Review
         fields = ('user', 'product', 'rating', 'review')
+        nested_fields = ('product',)
 
 class SimpleReviewSerializer(ReviewSerializer):
     class Meta:
@@ -86,9 +120,19 @@ class ProductReviewSerializer(ProductSerializer):
 
     @swagger_serializer_method(serializer_or_field=SimpleReviewSerializer(many=True))
     def get_review(self, product):
-        qs = Review.objects.filter(product=product)
-        return SimpleReviewSerializer(instance=qs, many=True).data
+        return SimpleReviewSerializer(instance=product.review.all(), many=True, **self.get_nested_options('review')).data
+
+    @classmethod
+    def prepare_queryset(cls, queryset, fields=None, expand=None):
+        queryset = super().prepare_queryset(queryset, fields, expand)
+        if 'review' not in cls.select_fields(fields, expand):
+            return queryset
+
+        reviews = SimpleReviewSerializer.prepare_queryset(Review.objects.all(), **get_nested_sparse_fields(fields, expand, 'review'))
+        return queryset.prefetch_related(Prefetch('review', queryset=reviews))
 
     class Meta:
         model = Product
-        fields = ('name', 'slug', 'description', 'price', 'material', 'rating', 'is_featured', 'category', 'model', 'gallery', 'review')
+        fields = ('name', 'slug', 'description', 'price', 'material', 'rating', 'is_featured', 'category', 'model', 'gallery', 'thumbnail', 'review')
+        expandable_fields = ('thumbnail',)
+        nested_fields = ('review',)
@@ -1,11 +1,35 @@
+import base64
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from unittest import mock
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
 from django.db.models.query_utils import Q
+from django.http import QueryDict
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.test import APIClient
+from PIL import Image
 
-from product.models import Category, Product, Review
+from product.cache import get_catalog_version, refresh_executor
+from product.facets import facet_index, rebuild_executor
+from product.models import Category, Gallery, Product, Review
+from product.search import index_products
 from product.serializers import CategorySerializer, ProductSerializer, ReviewSerializer
+from product.views import ProductDetail
 from Virtuele.helpers import VirtueleTestBase
+from Virtuele.storage import delete_unreferenced_files
 
 class ProductCRUD(VirtueleTestBase):
     def setUp(self):
@@ -129,6 +153,902 @@ class ProductCRUD(VirtueleTestBase):
         response = self.client.delete(f'/api/v1/products/{product.slug}/', **self.admin_jwt)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+class ProductCatalogQuery(VirtueleTestBase):
+    def setUp(self):
+        self.category_factory(n=3)
+        self.client = APIClient()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return len(queries)
+
+    def test_product_list_query_count_is_constant(self):
+        self.product_factory(n=5, category=[1, 2, 3])
+        Product.objects.get(id=1).category.add(1)
+        self.gallery_factory()
+        urls = ['/api/v1/products/', '/api/v1/categories/1/products/']
+        queries = [self.count_queries(url) for url in urls]
+
+        self.product_factory(n=20, category=[1, 2, 3])
+        self.gallery_factory(product=[product for product in Product.objects.filter(gallery=None)])
+        self.assertEqual([self.count_queries(url) for url in urls], queries)
+
+    def test_product_list_split_model_and_gallery(self):
+        self.product_factory(n=3, category=[1, 2, 3])
+        self.gallery_factory(n=6)
+
+        response = self.client.get('/api/v1/products/')
+        self.assertEqual(response.data, ProductSerializer(Product.objects.all(), many=True).data)
+
+        for product in response.data:
+            self.assertTrue(all(image['type_code'] == 'M' for image in product['model']))
+            self.assertTrue(all(image['type_code'] != 'M' for image in product['gallery']))
+            self.assertEqual(len(product['model']) + len(product['gallery']), 6)
+
+class ProductSparseFields(VirtueleTestBase):
+    def setUp(self):
+        self.category_factory(n=3)
+        self.product_factory(n=5, category=[1, 2, 3])
+        self.gallery_factory()
+        self.client = APIClient()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return response.data, queries
+
+    def test_default_fields_are_unchanged(self):
+        data, queries = self.get('/api/v1/products/')
+        self.assertEqual(data, ProductSerializer(Product.objects.all(), many=True).data)
+        self.assertNotIn('thumbnail', data[0])
+
+    def test_pick_listing_fields(self):
+        full_data, full_queries = self.get('/api/v1/products/')
+
+        data, queries = self.get('/api/v1/products/?fields=name,slug,price&expand=thumbnail')
+        self.assertEqual([list(product) for product in data], [['name', 'slug', 'price', 'thumbnail']] * 5)
+        self.assertEqual(len(queries), len(full_queries) - 1)
+        self.assertNotIn('description', queries.captured_queries[0]['sql'])
+
+        for product, full_product in zip(data, full_data):
+            self.assertEqual(product['price'], full_product['price'])
+            self.assertEqual(product['thumbnail'], full_product['gallery'][0] if full_product['gallery'] else None)
+
+        data, queries = self.get('/api/v1/products/?fields=slug&page_size=2')
+        self.assertEqual(data['results'], [{'slug': product['slug']} for product in full_data[:2]])
+        self.assertEqual(len(queries), len(full_queries) - 2)
+
+        # Products are put in a random category, use one that has products
+        category = Product.objects.first().category.first()
+        data, queries = self.get(f'/api/v1/categories/{category.id}/products/?fields=name,category')
+        self.assertEqual(list(data['results'][0]), ['name', 'category'])
+
+    def test_pick_nested_review_fields(self):
+        self.review_factory(product=list(Product.objects.all()))
+        product = Product.objects.get(id=1)
+
+        data, queries = self.get(f'/api/v1/products/{product.slug}/?fields=name,review.rating')
+        self.assertEqual(data, {'name': product.name, 'review': [{'rating': review.rating} for review in product.review.all()]})
+
+        data, queries = self.get(f'/api/v1/products/{product.slug}/reviews/?fields=rating,product.name')
+        self.assertEqual(data, [{'product': {'name': product.name}, 'rating': review.rating} for review in product.review.all()])
+
+        # Users and products of every review are joined into the review query
+        self.assertEqual(len(queries), 3)
+
+    def test_invalid_fields(self):
+        for url in ['/api/v1/products/?fields=name,unknown', '/api/v1/products/?expand=price.amount',
+                    '/api/v1/products/search/?q=doze&fields=review']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class ProductBatchLookup(VirtueleTestBase):
+    def setUp(self):
+        self.category_factory(n=3)
+        self.product_factory(n=5, category=[1, 2, 3])
+        self.gallery_factory()
+        self.client = APIClient()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return response.data, len(queries)
+
+    def test_lookup_by_slugs_in_requested_order(self):
+        products = [Product.objects.get(id=id) for id in [4, 1, 3]]
+        slugs = [product.slug for product in products]
+
+        data, queries = self.get(f'/api/v1/products/?slugs={",".join(slugs[:1] + ["missing"] + slugs[1:] + slugs[:1])}&featured=true')
+        self.assertEqual(data['results'], ProductSerializer(products, many=True).data)
+        self.assertEqual(data['missing'], ['missing'])
+
+        # Products, categories and galleries are loaded once whatever the number of slugs
+        self.product_factory(n=20, category=[1, 2, 3])
+        self.gallery_factory(product=[product for product in Product.objects.filter(gallery=None)])
+        data, more_queries = self.get(f'/api/v1/products/?slugs={",".join(Product.objects.values_list("slug", flat=True))}')
+        self.assertEqual(len(data['results']), 25)
+        self.assertEqual(more_queries, queries)
+
+    def test_lookup_by_ids(self):
+        data, queries = self.get('/api/v1/products/?ids=5,2,100&fields=slug')
+        self.assertEqual(data['results'], [{'slug': Product.objects.get(id=id).slug} for id in [5, 2]])
+        self.assertEqual(data['missing'], [100])
+
+    def test_invalid_lookup(self):
+        for query in ['ids=1,a', 'ids=1&slugs=a', f'ids={",".join(str(id) for id in range(1, 202))}']:
+            response = self.client.get(f'/api/v1/products/?{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class ProductListPagination(VirtueleTestBase):
+    def setUp(self):
+        self.category_factory(n=3)
+        self.product_factory(n=30, category=[1, 2, 3])
+        # Force some ties so the id tie breaker is exercised
+        Product.objects.filter(id__in=[2, 4, 6, 8]).update(price=5000)
+        Product.objects.filter(id__in=[3, 5]).update(price=0)
+        self.client = APIClient()
+
+    def walk(self, url):
+        slugs = []
+        response = self.client.get(url)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            slugs += [product['slug'] for product in response.data['results']]
+            if not response.data['next']:
+                return slugs, response
+            response = self.client.get(response.data['next'])
+
+    def test_walk_every_ordering(self):
+        expected = {
+            'oldest': Product.objects.order_by('id'),
+            'newest': Product.objects.order_by('-id'),
+            'price': Product.objects.order_by('price', 'id'),
+            '-price': Product.objects.order_by('-price', '-id'),
+            'rating': Product.objects.order_by('rating', 'id'),
+            '-rating': Product.objects.order_by('-rating', '-id'),
+        }
+
+        for ordering, product_qs in expected.items():
+            slugs, last_page = self.walk(f'/api/v1/products/?ordering={ordering}&page_size=7')
+            self.assertEqual(slugs, [product.slug for product in product_qs])
+
+            # Walking back from the last page should return the previous page
+            response = self.client.get(last_page.data['previous'])
+            self.assertEqual([product['slug'] for product in response.data['results']], slugs[-9:-2])
+
+    def test_filter_by_category_and_price(self):
+        product_qs = Product.objects.filter(category=2, price__gte=100000, price__lte=800000).order_by('id')
+
+        slugs, _ = self.walk('/api/v1/products/?category=2&min_price=100000&max_price=800000&page_size=5')
+        self.assertEqual(slugs, [product.slug for product in product_qs])
+
+        response = self.client.get('/api/v1/products/?category=2&min_price=100000&max_price=800000')
+        self.assertEqual(response.data, ProductSerializer(product_qs, many=True).data)
+
+    def test_invalid_parameter(self):
+        response = self.client.get('/api/v1/products/?category=abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get('/api/v1/products/?ordering=popularity')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get('/api/v1/products/?cursor=invalidcursor')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+@override_settings(CATALOG_CACHE={'ENABLED': True, 'BACKGROUND_REFRESH': False})
+class CatalogResponseCache(VirtueleTestBase):
+    def setUp(self):
+        cache.clear()
+        self.user_admin_factory()
+        self.product_factory(n=3)
+        self.client = APIClient()
+
+    def test_anonymous_response_is_cached(self):
+        product = Product.objects.get(id=1)
+        urls = ['/api/v1/products/', '/api/v1/products/?featured=true', f'/api/v1/products/{product.slug}/',
+                '/api/v1/gallery/', '/api/v1/categories/', '/api/v1/categories/1/products/']
+
+        for url in urls:
+            response = self.client.get(url)
+
+            with self.assertNumQueries(0):
+                cached_response = self.client.get(url)
+            self.assertEqual(cached_response.status_code, response.status_code)
+            self.assertEqual(cached_response.data, response.data)
+
+    def test_authenticated_response_is_not_cached(self):
+        self.client.get('/api/v1/products/')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/v1/products/', **self.user_jwt)
+        self.assertNotEqual(len(queries), 0)
+
+    def test_stale_response_is_served_while_refreshing(self):
+        product = Product.objects.get(id=1)
+        self.client.get(f'/api/v1/products/{product.slug}/')
+
+        product.description = 'Updated description'
+        product.save()
+
+        # Refreshed in the request itself, the rebuilt response is served right away
+        response = self.client.get(f'/api/v1/products/{product.slug}/')
+        self.assertEqual(response.data['description'], 'Updated description')
+        self.assertTrue(response.has_header('ETag'))
+
+    @override_settings(CATALOG_CACHE={'ENABLED': True, 'BACKGROUND_REFRESH': True})
+    def test_background_refresh_build_a_new_request(self):
+        product = Product.objects.get(id=1)
+        self.client.get(f'/api/v1/products/{product.slug}/?fields=slug,description')
+
+        product.description = 'Updated description'
+        product.save()
+
+        with mock.patch.object(refresh_executor, 'submit') as submit:
+            response = self.client.get(f'/api/v1/products/{product.slug}/?fields=slug,description')
+        # The last known response is served once, while it is refreshed
+        self.assertNotEqual(response.data['description'], 'Updated description')
+        self.assertFalse(response.has_header('ETag'))
+
+        # The worker only get plain values, the answered request is never reused
+        refresh, *arguments = submit.call_args[0]
+        self.assertEqual((arguments[2]['PATH_INFO'], arguments[2]['QUERY_STRING']), (f'/api/v1/products/{product.slug}/', 'fields=slug,description'))
+        with mock.patch('product.cache.connection'), mock.patch('product.cache.close_old_connections'):
+            refresh(*arguments)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/api/v1/products/{product.slug}/?fields=slug,description')
+        self.assertEqual(response.data, {'slug': product.slug, 'description': 'Updated description'})
+
+    def test_catalog_change_bump_version(self):
+        product = Product.objects.get(id=1)
+        changes = [
+            lambda: Category.objects.create(name='New Category'),
+            lambda: Category.objects.get(name='New Category').delete(),
+            lambda: Gallery.objects.create(product=product, image='new.jpg', width=1, height=1),
+            lambda: Gallery.objects.get(image='new.jpg').delete(),
+            lambda: product.category.add(Category.objects.create(name='Another Category')),
+            lambda: self.review_factory(product=[product], user=[get_user_model().objects.get(id=1)]),
+            lambda: Product.objects.get(id=2).delete(),
+        ]
+
+        for change in changes:
+            version = get_catalog_version()
+            change()
+            self.assertGreater(get_catalog_version(), version)
+
+class ConditionalRequest(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=3, with_reviews=True)
+        self.gallery_factory(n=2)
+        self.client = APIClient()
+
+    def test_not_modified_response(self):
+        product = Product.objects.get(id=1)
+        urls = ['/api/v1/products/', '/api/v1/products/?featured=true', f'/api/v1/products/{product.slug}/',
+                '/api/v1/gallery/', f'/api/v1/products/{product.slug}/reviews/']
+
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # Lists are only validated by their ETag
+            self.assertEqual(response.has_header('Last-Modified'), url in urls[2:3] + urls[4:])
+
+            # Only the state query runs, the view is never called
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='"outdated"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_deleted_row_is_modified_since(self):
+        product = Product.objects.get(id=1)
+        response = self.client.get(f'/api/v1/products/{product.slug}/')
+        response = self.client.get(f'/api/v1/products/{product.slug}/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # A client that saw the lists before the delete should get them again
+        since = http_date(time.time() + 60)
+        deletes = [('/api/v1/products/', lambda: Product.objects.get(id=3).delete()), ('/api/v1/gallery/', lambda: Gallery.objects.first().delete())]
+        for url, delete in deletes:
+            self.client.get(url)
+            delete()
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def assertChangeETag(self, url, change):
+        etag = self.client.get(url)['ETag']
+        change()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_change_tracking(self):
+        product = Product.objects.get(id=1)
+        product_url = f'/api/v1/products/{product.slug}/'
+        review_url = f'/api/v1/products/{product.slug}/reviews/'
+
+        self.assertChangeETag(product_url, lambda: Product.objects.get(id=1).save())
+        self.assertChangeETag(product_url, lambda: self.gallery_factory(product=[product], n=1))
+        self.assertChangeETag(product_url, lambda: Gallery.objects.filter(product=product).first().delete())
+        self.assertChangeETag(product_url, lambda: Category.objects.filter(id=1).first().save())
+        self.assertChangeETag(product_url, lambda: product.category.add(Category.objects.create(name='New Category')))
+        self.assertChangeETag(product_url, lambda: product.category.clear())
+        self.account_factory(n=1)
+        self.assertChangeETag(review_url, lambda: self.review_factory(product=[product], user=[get_user_model().objects.get(id=3)]))
+        self.assertChangeETag(review_url, lambda: Review.objects.filter(product=product).delete())
+        self.assertChangeETag('/api/v1/products/', lambda: Product.objects.get(id=3).delete())
+        self.assertChangeETag('/api/v1/gallery/', lambda: self.gallery_factory(product=[product], n=1))
+
+class ProductSearch(VirtueleTestBase):
+    def setUp(self):
+        self.outerwear = Category.objects.create(name='Outerwear')
+        self.jacket = Product.objects.create(name='Denim Jacket', description='Washed blue denim', material='COTTON')
+        self.shirt = Product.objects.create(name='Oxford Shirt', description='Goes well with a denim jacket', material='COTTON')
+        self.hoodie = Product.objects.create(name='Heavy Hoodie', description='Fleece lined', material='FLEECE')
+        self.jacket.category.add(self.outerwear)
+        self.client = APIClient()
+
+    def search(self, query):
+        response = self.client.get(f'/api/v1/products/search/?q={query}')
+        return [product['slug'] for product in response.data] if response.status_code == status.HTTP_200_OK else []
+
+    def test_search_product(self):
+        # Name matches are ranked above description matches
+        self.assertEqual(self.search('denim jacket'), [self.jacket.slug, self.shirt.slug])
+        self.assertEqual(self.search('cotton'), [self.jacket.slug, self.shirt.slug])
+        self.assertEqual(self.search('outerwear'), [self.jacket.slug])
+        self.assertEqual(self.search('hood'), [self.hoodie.slug])
+
+        response = self.client.get('/api/v1/products/search/?q=denim')
+        self.assertEqual(response.data[0], ProductSerializer(self.jacket).data)
+
+        response = self.client.get('/api/v1/products/search/?q=tuxedo')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get('/api/v1/products/search/?q=%20*')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_best_match_among_many(self):
+        # A common word is ranked over every match, the best one being the last row indexed
+        Product.objects.bulk_create([
+            Product(name=f'Plain Tee {i}', slug=f'plain-tee-{i}', description='Soft denim trim') for i in range(1500)
+        ])
+        best = Product.objects.create(name='Denim Overshirt', description='Denim', material='DENIM')
+        index_products()
+
+        self.assertEqual(self.search('denim')[:1], [best.slug])
+
+    def test_whole_word_before_completion(self):
+        # Completions of a common prefix are only ranked among a bounded candidate set, after the whole words
+        Product.objects.bulk_create([
+            Product(name=f'Hoodlum Tee {i}', slug=f'hoodlum-tee-{i}', description='Hoodlum print') for i in range(1500)
+        ])
+        plain = Product.objects.create(name='Plain Tee', description='Comes with a hood')
+        index_products()
+
+        results = self.search('hood')
+        self.assertEqual(results[0], plain.slug)
+        self.assertEqual(len(results), 24)
+
+        # A last term shorter than 3 characters is not completed
+        self.assertEqual(self.search('ho'), [])
+        self.assertEqual(self.search('denim ja'), [])
+
+    def test_index_is_updated_incrementally(self):
+        self.hoodie.name = 'Zip Hoodie'
+        self.hoodie.save()
+        self.assertEqual(self.search('zip'), [self.hoodie.slug])
+
+        self.hoodie.category.add(self.outerwear)
+        self.assertCountEqual(self.search('outerwear'), [self.jacket.slug, self.hoodie.slug])
+
+        self.outerwear.name = 'Layering'
+        self.outerwear.save()
+        self.assertEqual(self.search('outerwear'), [])
+        self.assertCountEqual(self.search('layering'), [self.jacket.slug, self.hoodie.slug])
+
+        self.outerwear.product.clear()
+        self.assertEqual(self.search('layering'), [])
+
+        self.jacket.category.add(self.outerwear)
+        self.outerwear.delete()
+        self.assertEqual(self.search('layering'), [])
+
+        self.jacket.delete()
+        self.assertEqual(self.search('denim'), [self.shirt.slug])
+
+class ReviewAggregate(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=2)
+        self.account_factory(n=6)
+        self.client = APIClient()
+
+    def assertRating(self, product):
+        product.refresh_from_db()
+        ratings = list(Review.objects.filter(product=product).values_list('rating', flat=True))
+
+        self.assertEqual(product.review_count, len(ratings))
+        self.assertEqual(product.rating_sum, sum(ratings))
+        self.assertAlmostEqual(product.rating, sum(ratings) / len(ratings) if ratings else 0)
+
+    def test_rating_follow_review_changes(self):
+        product, other_product = Product.objects.get(id=1), Product.objects.get(id=2)
+        users = get_user_model().objects.all()
+        reviews = [Review.objects.create(user=user, product=product, rating=rating) for user, rating in zip(users, [5, 4, 1])]
+        self.assertRating(product)
+
+        reviews[0].rating = 2
+        reviews[0].save()
+        self.assertRating(product)
+
+        reviews[1].product = other_product
+        reviews[1].save()
+        self.assertRating(product)
+        self.assertRating(other_product)
+
+        for review in reviews:
+            review.delete()
+            self.assertRating(product)
+            self.assertRating(other_product)
+
+    def test_product_update_keep_concurrent_review(self):
+        self.user_admin_factory()
+        product = Product.objects.get(id=1)
+        Review.objects.create(user=get_user_model().objects.get(id=1), product=product, rating=5)
+
+        def get_object(view, slug):
+            # A review is posted between the product load and its save
+            loaded = Product.objects.get(slug=slug)
+            Review.objects.create(user=get_user_model().objects.get(id=2), product=loaded, rating=2)
+            return loaded
+
+        with mock.patch.object(ProductDetail, 'get_object', get_object):
+            response = self.client.put(f'/api/v1/products/{product.slug}/',
+                                       {'name': 'Renamed Product', 'category': [1]},
+                                       format='json',
+                                       **self.admin_jwt)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        product.refresh_from_db()
+        self.assertEqual(product.name, 'Renamed Product')
+        self.assertRating(product)
+        self.assertEqual(product.review_count, 2)
+
+    def count_review_queries(self, user_id):
+        product = Product.objects.get(id=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(f'/api/v1/products/{product.slug}/reviews/',
+                                        {'rating': 4, 'review': 'Nice!'},
+                                        format='json',
+                                        **self.account_jwt(user_id))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        return len(queries)
+
+    def test_review_cost_constant_queries(self):
+        product = Product.objects.get(id=1)
+        queries = self.count_review_queries(1)
+
+        # Neither existing reviews nor carts holding the product should add any query
+        for user_id in range(2, 6):
+            self.client.post(f'/api/v1/carts/items/{product.slug}/S/', **self.account_jwt(user_id))
+            self.review_factory(product=[product], user=[get_user_model().objects.get(id=user_id)])
+
+        self.assertEqual(self.count_review_queries(6), queries)
+        self.assertRating(product)
+
+class ReviewFeed(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=2)
+        self.account_factory(n=8)
+        self.client = APIClient()
+
+        self.product = Product.objects.get(id=1)
+        for user, rating in zip(get_user_model().objects.order_by('id'), [5, 4, 4, 1, 5, 5, 2]):
+            Review.objects.create(user=user, product=self.product, rating=rating)
+
+    def read_feed(self, url):
+        reviews, queries = [], []
+        while url:
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            reviews += response.data['results']
+            queries.append(len(captured))
+            url = response.data['next']
+
+        return reviews, queries
+
+    def test_paginate_reviews_with_constant_queries(self):
+        reviews, queries = self.read_feed(f'/api/v1/products/{self.product.slug}/reviews/?page_size=3&ordering=-rating')
+
+        expected = Review.objects.filter(product=self.product).order_by('-rating', '-id')
+        self.assertEqual(reviews, ReviewSerializer(expected, many=True).data)
+        self.assertEqual(len(set(queries)), 1)
+
+        response = self.client.get(f'/api/v1/products/{self.product.slug}/reviews/')
+        self.assertEqual(response.data, ReviewSerializer(Review.objects.filter(product=self.product).order_by('id'), many=True).data)
+
+    def test_review_summary(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/v1/products/{self.product.slug}/reviews/summary/')
+
+        self.assertEqual(response.data, {
+            'count': 7,
+            'average': 26 / 7,
+            'distribution': {'1': 1, '2': 1, '3': 0, '4': 2, '5': 3},
+        })
+        self.assertEqual(len([query for query in queries if 'GROUP BY' in query['sql']]), 1)
+
+        response = self.client.get(f'/api/v1/products/{Product.objects.get(id=2).slug}/reviews/summary/')
+        self.assertEqual(response.data, {'count': 0, 'average': 0, 'distribution': {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0}})
+
+        response = self.client.get('/api/v1/products/invalidslug/reviews/summary/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+@override_settings(FACET_INDEX={'SHARED_CHANGES': True, 'BACKGROUND_REBUILD': False})
+class ProductFacetIndex(VirtueleTestBase):
+    def setUp(self):
+        cache.clear()
+        facet_index.reset()
+        self.on_commit = mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+        self.on_commit.start()
+
+        self.category_factory(n=3)
+        self.account_factory(n=2)
+        prices = [50000, 150000, 150000, 300000, 750000, 0]
+        for i, price in enumerate(prices):
+            product = Product.objects.create(name=f'Product {i}', price=price, is_featured=i % 2 == 0)
+            product.category.add(*Category.objects.all()[:i % 3 + 1])
+
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.on_commit.stop()
+
+    def get_facets(self, query=''):
+        response = self.client.get(f'/api/v1/products/facets/?{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def assertMatchProductList(self, query):
+        facets = self.get_facets(query)
+        response = self.client.get(f'/api/v1/products/?{query}')
+        listed = len(response.data) if response.status_code == status.HTTP_200_OK else 0
+        self.assertEqual(facets['count'], listed, query)
+
+        # A facet value count is the list size with that value replacing the facet filter
+        for facet, values in facets['facets'].items():
+            for value in values:
+                params = {key: item for key, item in QueryDict(query).items() if key != facet}
+                params[facet] = value['value']
+                response = self.client.get('/api/v1/products/', params)
+                listed = len(response.data) if response.status_code == status.HTTP_200_OK else 0
+                self.assertEqual(value['count'], listed, f'{query} {facet}={value["value"]}')
+
+    def test_facet_counts(self):
+        facets = self.get_facets()
+        self.assertEqual(facets['count'], 6)
+        self.assertEqual(facets['facets']['price'], [
+            {'value': '0-100000', 'count': 2},
+            {'value': '100000-250000', 'count': 2},
+            {'value': '250000-500000', 'count': 1},
+            {'value': '500000-', 'count': 1},
+        ])
+        self.assertEqual([value['count'] for value in facets['facets']['category']], [6, 4, 2])
+        self.assertEqual(facets['facets']['featured'], [{'value': 'true', 'count': 3}, {'value': 'false', 'count': 3}])
+
+        for query in ['', 'featured=true', 'category=2,3', 'category=3&price=0-100000,500000-',
+                      'price=100000-250000&featured=false&rating=0', 'rating=4,5']:
+            self.assertMatchProductList(query)
+
+        response = self.client.get('/api/v1/products/facets/?price=1-2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_index_is_updated_incrementally(self):
+        self.get_facets()
+
+        with mock.patch.object(facet_index, 'rebuild') as rebuild:
+            product = Product.objects.get(name='Product 0')
+            product.price = 900000
+            product.save()
+            product.category.add(Category.objects.get(id=3))
+            Review.objects.create(user=get_user_model().objects.get(id=1), product=product, rating=4)
+            Review.objects.create(user=get_user_model().objects.get(id=2), product=product, rating=5)
+            Product.objects.get(name='Product 5').delete()
+            Category.objects.get(id=2).delete()
+
+            for query in ['', 'price=500000-', 'rating=4', 'category=3', 'featured=true&category=2']:
+                self.assertMatchProductList(query)
+            self.assertEqual(self.get_facets()['count'], 5)
+
+        rebuild.assert_not_called()
+
+    def test_rebuild_after_missed_changes(self):
+        self.get_facets()
+
+        product = Product.objects.get(name='Product 1')
+        product.price = 600000
+        product.save()
+
+        # Another process change evicted before this process applied it
+        cache.delete(f'catalog:facets:change:{cache.get("catalog:facets:sequence")}')
+
+        with mock.patch.object(facet_index, 'rebuild', wraps=facet_index.rebuild) as rebuild:
+            self.assertMatchProductList('price=500000-')
+        rebuild.assert_called_once()
+
+    @override_settings(FACET_INDEX={'SHARED_CHANGES': True, 'BACKGROUND_REBUILD': True})
+    def test_rebuild_in_background(self):
+        self.get_facets()
+
+        product = Product.objects.get(name='Product 1')
+        product.price = 600000
+        product.save()
+        cache.delete(f'catalog:facets:change:{cache.get("catalog:facets:sequence")}')
+
+        # The current index keep answering while it is rebuilt
+        with mock.patch.object(rebuild_executor, 'submit') as submit:
+            self.assertEqual(self.get_facets('price=500000-')['count'], 1)
+            self.assertEqual(self.get_facets('price=500000-')['count'], 1)
+        submit.assert_called_once()
+
+        with mock.patch('product.facets.connection'), mock.patch('product.facets.close_old_connections'):
+            submit.call_args[0][0]()
+        self.assertMatchProductList('price=500000-')
+
+    @override_settings(FACET_INDEX={'SHARED_CHANGES': False, 'REBUILD_INTERVAL': 60, 'BACKGROUND_REBUILD': False})
+    def test_periodic_rebuild_without_shared_changes(self):
+        self.get_facets()
+
+        # A change published by another worker never reach this worker cache
+        Product.objects.filter(name='Product 1').update(price=600000)
+
+        self.assertEqual(self.get_facets('price=500000-')['count'], 1)
+
+        built = facet_index.built
+        with mock.patch('time.monotonic', return_value=built + 60):
+            self.assertMatchProductList('price=500000-')
+
+class ImportCatalog(VirtueleTestBase):
+    def setUp(self):
+        self.category_factory()
+        self.product_factory(n=1)
+        self.directory = tempfile.TemporaryDirectory()
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as catalog:
+            catalog.write(content)
+        return path
+
+    def test_import_every_format(self):
+        existing = Product.objects.get(id=1)
+        records = [
+            {'name': existing.name, 'price': 150000, 'categories': ['Outerwear', 'Outerwear'],
+             'gallery': [{'image': 'front.jpg', 'image_type': 'PF', 'width': 800, 'height': 1000}]},
+            {'name': existing.name, 'description': 'Fleece lined', 'categories': [Category.objects.get(id=1).name],
+             'is_featured': True},
+        ]
+
+        call_command('import_catalog', self.write('catalog.json', json.dumps(records, indent=2)), batch_size=1, stdout=io.StringIO())
+        call_command('import_catalog', self.write('catalog.ndjson', '\n'.join(json.dumps(record) for record in records)), stdout=io.StringIO())
+        call_command('import_catalog', self.write('catalog.csv', (
+            'name,price,categories,gallery,is_featured\n'
+            f'{existing.name},99000,Outerwear|Basics,\n'
+        )), stdout=io.StringIO())
+
+        imported = Product.objects.exclude(id=existing.id).order_by('id')
+        self.assertEqual(imported.count(), 5)
+        self.assertEqual([product.slug for product in imported], [f'{existing.slug}-{i}' for i in range(2, 7)])
+        self.assertEqual(Category.objects.filter(name='Outerwear').count(), 1)
+        self.assertEqual(Category.objects.get(name='Outerwear').product_count, 3)
+
+        product = imported[0]
+        self.assertEqual(product.price, 150000)
+        self.assertEqual(product.description, 'This product does not have a description yet.')
+        self.assertEqual([category.name for category in product.category.all()], ['Outerwear'])
+        self.assertEqual(list(product.gallery.values_list('image', 'image_type', 'width', 'height')), [('front.jpg', 'PF', 800, 1000)])
+        self.assertTrue(imported[1].is_featured)
+        self.assertEqual(sorted(imported[4].category.values_list('name', flat=True)), ['Basics', 'Outerwear'])
+
+        # Imported products are searchable and listed right away
+        response = self.client.get('/api/v1/products/search/?q=fleece')
+        self.assertEqual([product['slug'] for product in response.data], [imported[1].slug, imported[3].slug])
+        response = self.client.get('/api/v1/products/')
+        self.assertEqual(len(response.data), 6)
+
+    def test_invalid_record(self):
+        path = self.write('catalog.ndjson', '{"name": "Hoodie"}\n{"price": 1000}\n')
+        with self.assertRaisesMessage(CommandError, 'record 2'):
+            call_command('import_catalog', path, stdout=io.StringIO())
+
+        with self.assertRaises(CommandError):
+            call_command('import_catalog', self.write('catalog.txt', ''), stdout=io.StringIO())
+
+@override_settings(IMAGE_VARIANTS={'BACKGROUND': False})
+class GalleryVariants(VirtueleTestBase):
+    def setUp(self):
+        self.product_factory(n=1)
+        self.media_root = tempfile.TemporaryDirectory()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.media_settings.enable()
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        self.media_root.cleanup()
+
+    def image_file(self, name, size=(2000, 1500), color=(200, 30, 30)):
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera Maker'
+        content = io.BytesIO()
+        Image.new('RGB', size, color).save(content, 'JPEG', exif=exif)
+        return SimpleUploadedFile(name, content.getvalue(), content_type='image/jpeg')
+
+    @contextlib.contextmanager
+    def commit(self):
+        # Run the on_commit callbacks at the end of the block, like a committed transaction
+        callbacks = []
+        with mock.patch('django.db.transaction.on_commit', side_effect=callbacks.append):
+            yield
+
+        for callback in callbacks:
+            callback()
+
+    def create_gallery(self, name, **kwargs):
+        with self.commit():
+            gallery = Gallery.objects.create(product=Product.objects.get(id=1), image=self.image_file(name, **kwargs), image_type='PF')
+
+        gallery.refresh_from_db()
+        return gallery
+
+    def stored_files(self, gallery):
+        return [os.path.join(self.media_root.name, gallery.image.name)] + [
+            os.path.join(self.media_root.name, sizes[key]) for sizes in gallery.variants['sizes'].values() for key in ['webp', 'jpeg']
+        ]
+
+    def test_build_variants_on_upload(self):
+        gallery = self.create_gallery('hoodie.jpg')
+        gallery.refresh_from_db()
+
+        sizes = gallery.variants['sizes']
+        self.assertEqual([(sizes[variant]['width'], sizes[variant]['height']) for variant in ['thumbnail', 'card', 'detail']],
+                         [(160, 120), (480, 360), (1080, 810)])
+
+        for variant in sizes.values():
+            with Image.open(os.path.join(self.media_root.name, variant['jpeg'])) as image:
+                self.assertEqual((image.format, image.size), ('JPEG', (variant['width'], variant['height'])))
+                self.assertTrue(image.info.get('progressive'))
+                self.assertNotIn('exif', image.info)
+            with Image.open(os.path.join(self.media_root.name, variant['webp'])) as image:
+                self.assertEqual((image.format, image.size), ('WEBP', (variant['width'], variant['height'])))
+                self.assertNotIn('exif', image.info)
+
+        response = self.client.get('/api/v1/gallery/')
+        self.assertEqual(response.data[0]['srcset']['card'], {
+            'width': 480,
+            'height': 360,
+            'webp': f'/media/{sizes["card"]["webp"]}',
+            'jpeg': f'/media/{sizes["card"]["jpeg"]}',
+        })
+
+        # The placeholder is a tiny inline image and the color is close to the image color
+        placeholder = response.data[0]['placeholder']
+        self.assertTrue(placeholder.startswith('data:image/webp;base64,'))
+        with Image.open(io.BytesIO(base64.b64decode(placeholder.split(',', 1)[1]))) as image:
+            self.assertEqual(image.size, (16, 12))
+
+        color = response.data[0]['color']
+        self.assertRegex(color, r'^#[0-9a-f]{6}$')
+        for channel, expected in zip([color[1:3], color[3:5], color[5:7]], [200, 30, 30]):
+            self.assertAlmostEqual(int(channel, 16), expected, delta=8)
+
+        # Small images are never upscaled
+        small = self.create_gallery('small.jpg', size=(300, 200))
+        small.refresh_from_db()
+        self.assertEqual((small.variants['sizes']['detail']['width'], small.variants['sizes']['detail']['height']), (300, 200))
+
+    def test_replaced_image_drop_old_files(self):
+        gallery = self.create_gallery('hoodie.jpg')
+        old_files = self.stored_files(gallery)
+
+        with self.commit():
+            gallery.image = self.image_file('jacket.jpg', color=(30, 30, 200))
+            gallery.save()
+        gallery.refresh_from_db()
+
+        self.assertEqual(gallery.variants['source'], gallery.image.name)
+        self.assertFalse(any(os.path.exists(path) for path in old_files))
+
+        new_files = self.stored_files(gallery)
+        with self.commit():
+            gallery.delete()
+        self.assertFalse(any(os.path.exists(path) for path in new_files))
+
+    def test_identical_upload_share_stored_files(self):
+        gallery = self.create_gallery('hoodie.jpg')
+        duplicate = self.create_gallery('hoodie-copy.jpg')
+
+        # Named by the content hash, sharded by its first 4 characters
+        digest = os.path.splitext(os.path.basename(gallery.image.name))[0]
+        self.assertEqual(gallery.image.name, f'{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertEqual(duplicate.image.name, gallery.image.name)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root.name, digest[:2], digest[2:4]))), 1)
+
+        # Files are only deleted once the last gallery referring to them is gone
+        files = self.stored_files(gallery)
+        with self.commit():
+            gallery.delete()
+        self.assertTrue(all(os.path.exists(path) for path in files))
+
+        with self.commit():
+            duplicate.delete()
+        self.assertFalse(any(os.path.exists(path) for path in files))
+
+    @override_settings(MEDIA_CLEANUP={'BACKGROUND': False, 'GRACE_PERIOD': 60})
+    def test_recently_saved_file_outlive_cleanup(self):
+        gallery = self.create_gallery('hoodie.jpg')
+        path = os.path.join(self.media_root.name, gallery.image.name)
+        os.utime(path, (time.time() - 120, time.time() - 120))
+
+        # Saving the same content renew the file, like an upload whose row isn't committed yet
+        self.assertEqual(default_storage.save('hoodie-copy.jpg', self.image_file('hoodie-copy.jpg')), gallery.image.name)
+        with self.commit():
+            gallery.delete()
+        self.assertTrue(os.path.exists(path))
+
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        self.assertEqual(delete_unreferenced_files([gallery.image.name]), [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_upload_to_is_kept_as_prefix(self):
+        name = default_storage.save('media/avatar/me.PNG', self.image_file('me.PNG'))
+        digest = os.path.splitext(os.path.basename(name))[0]
+        self.assertEqual(name, f'media/avatar/{digest[:2]}/{digest[2:4]}/{digest}.png')
+
+    def test_file_kept_when_transaction_roll_back(self):
+        gallery = self.create_gallery('hoodie.jpg')
+        files = self.stored_files(gallery)
+
+        # Nothing is deleted until commit, which never happen for this rolled back delete
+        with transaction.atomic():
+            gallery.delete()
+            transaction.set_rollback(True)
+        self.assertTrue(all(os.path.exists(path) for path in files))
+
+    def test_backfill_command(self):
+        galleries = [self.create_gallery(f'image-{i}.jpg', size=(600, 600), color=(i, i, i)) for i in range(3)]
+
+        Gallery.objects.filter(id=galleries[0].id).update(placeholder='', color='')
+        Gallery.objects.exclude(id=galleries[0].id).update(variants={})
+
+        response = self.client.get('/api/v1/gallery/')
+        self.assertEqual(sorted(gallery['placeholder'] == '' for gallery in response.data), [False, False, True])
+        self.assertEqual(sorted(gallery['srcset'] == {} for gallery in response.data), [False, True, True])
+
+        call_command('build_gallery_variants', workers=2, batch_size=2, stdout=io.StringIO())
+
+        for gallery in galleries:
+            gallery.refresh_from_db()
+            self.assertEqual(gallery.variants['source'], gallery.image.name)
+            self.assertEqual(gallery.variants['sizes']['card']['width'], 480)
+            self.assertTrue(gallery.placeholder)
+
 class CategoryCRUD(VirtueleTestBase):
     def setUp(self):
         self.user_admin_factory()
@@ -206,13 +1126,17 @@ class ProductCategoryCRUD(VirtueleTestBase):
 
     def test_get_product_filter_by_category(self):
         for i in range(1, 5):
-            products = ProductSerializer(Product.objects.filter(Q(category__id__icontains=i)), many=True)
+            products = ProductSerializer(Product.objects.filter(category__id=i).order_by('id'), many=True)
             response = self.client.get(f'/api/v1/categories/{i}/products/')
 
             if products.data == []:
                 self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
             else:
-                self.assertEqual(response.data, products.data)
+                self.assertEqual(response.data['results'], products.data)
+                self.assertEqual(response.data['count'], len(products.data))
+
+        response = self.client.get('/api/v1/categories/100/products/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_add_category_into_a_product(self):
         product = Product.objects.get(id=1)
@@ -285,6 +1209,80 @@ class ProductCategoryCRUD(VirtueleTestBase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, ProductSerializer(Product.objects.get(id=1)).data)
 
+class CategoryIndex(VirtueleTestBase):
+    def setUp(self):
+        self.category_factory(n=10)
+        self.client = APIClient()
+
+    def assertCounts(self, counts):
+        self.assertEqual(
+            {category.id: category.product_count for category in Category.objects.filter(id__in=counts)},
+            counts
+        )
+
+    def test_counts_follow_category_changes(self):
+        self.product_factory(n=3, category=[1])
+        product = Product.objects.get(id=1)
+        self.assertCounts({1: 3, 2: 0})
+
+        product.category.add(2, 3)
+        self.assertCounts({1: 3, 2: 1, 3: 1})
+
+        product.category.remove(1)
+        self.assertCounts({1: 2, 2: 1, 3: 1})
+
+        product.category.clear()
+        self.assertCounts({1: 2, 2: 0, 3: 0})
+
+        Category.objects.get(id=1).product.add(product)
+        self.assertCounts({1: 3})
+
+        Category.objects.get(id=1).product.clear()
+        self.assertCounts({1: 0})
+
+        product.category.set([2, 3])
+        Product.objects.get(id=2).category.add(2)
+        product.delete()
+        self.assertCounts({2: 1, 3: 0})
+
+    def test_category_product_match_exact_id(self):
+        self.product_factory(n=5, category=[1])
+        for product in Product.objects.filter(id__gt=2):
+            product.category.set([10])
+
+        response = self.client.get('/api/v1/categories/1/products/')
+        self.assertEqual(
+            [product['slug'] for product in response.data['results']],
+            [product.slug for product in Product.objects.filter(id__in=[1, 2]).order_by('id')]
+        )
+        self.assertEqual(response.data['count'], 2)
+
+        response = self.client.get('/api/v1/categories/2/products/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_category_product_pagination(self):
+        self.product_factory(n=5, category=[1])
+
+        response = self.client.get('/api/v1/categories/1/products/?page_size=2')
+        slugs = [product['slug'] for product in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            slugs += [product['slug'] for product in response.data['results']]
+
+        self.assertEqual(slugs, list(Product.objects.order_by('id').values_list('slug', flat=True)))
+        self.assertEqual(response.data['count'], 5)
+
+    def test_categories_include_counts_in_one_query(self):
+        self.product_factory(n=4, category=[1, 2])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/categories/')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(
+            {category['id']: category['product_count'] for category in response.data},
+            {category.id: category.product.count() for category in Category.objects.all()}
+        )
+
 class ProductReviewCRUD(VirtueleTestBase):
     def setUp(self):
         self.product_factory(with_reviews=True)
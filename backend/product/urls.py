@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import  Categories, CategoryDetail, CategoryProduct, GalleryList, ProductCategories, ProductDetail, Products, ProductReviews
+from .views import  Categories, CategoryDetail, CategoryProduct, GalleryList, ProductCategories, ProductDetail, ProductFacets, ProductRelated, Products, ProductReviews, ProductReviewSummary, ProductSearch
 app_name = 'product'
 
 urlpatterns = [
@@ -8,7 +8,11 @@ urlpatterns = [
     path('categories/<int:pk>/', CategoryDetail.as_view(), name='category-detail'),
     path('categories/<int:pk>/products/', CategoryProduct.as_view(), name='categorys-product'),
     path('products/', Products.as_view(), name='product-list'),
+    path('products/search/', ProductSearch.as_view(), name='product-search'),
+    path('products/facets/', ProductFacets.as_view(), name='product-facets'),
     path('products/<slug:slug>/', ProductDetail.as_view(), name='product-detail'),
     path('products/<slug:slug>/reviews/', ProductReviews.as_view(), name='product-detail'),
+    path('products/<slug:slug>/reviews/summary/', ProductReviewSummary.as_view(), name='product-review-summary'),
+    path('products/<slug:slug>/related/', ProductRelated.as_view(), name='product-related'),
     path('products/<slug:slug>/categories/<int:pk>/', ProductCategories.as_view(), name='product-categories')
 ]
\ No newline at end of file
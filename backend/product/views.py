@@ -1,14 +1,19 @@
-from django.db.models.query_utils import Q
-from product.models import Category, Gallery, Product, Review
+from django.db.models import Count, Max
+from product.models import Category, Gallery, Product, RelatedProduct, Review, RATING_CHOICES
+from product.cache import cache_catalog_response, conditional_catalog_response
+from product.facets import PRICE_BUCKET_VALUES, RATING_BANDS, facet_index, get_facet_q, parse_facet_filters
+from product.pagination import ProductCursorPagination, ReviewCursorPagination
+from product.search import get_search_terms, search_products
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import ParseError, ValidationError
 from product.serializers import CategorySerializer, CreateProductSerializer, CreateReviewSerializer, GallerySerializer, ProductReviewSerializer, ProductSerializer, ReviewSerializer
 from rest_framework import status
 from django.shortcuts import get_object_or_404
 from user.permissions import IsActiveOrReadOnly, IsStaffOrReadOnly
 from django.http import Http404
 from drf_yasg.utils import swagger_auto_schema
+from Virtuele.serializers import get_sparse_fields
 from rest_framework.permissions import AllowAny
 from drf_yasg import openapi
 from rest_framework.mixins import RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin, ListModelMixin, CreateModelMixin
@@ -28,6 +33,7 @@ class Categories(ListModelMixin,
             204: 'No Content'
         }
     )
+    @cache_catalog_response
     def get(self, request, *args, **kwargs):
         """
         Category List
@@ -134,14 +140,46 @@ class CategoryDetail(RetrieveModelMixin,
 
 class CategoryProduct(APIView):
     permission_classes = [AllowAny]
+
+    @swagger_auto_schema(
+        responses={
+            200: ProductSerializer(many=True),
+            204: 'No Product In This Category',
+            404: 'No Category With That ID Found'
+        }
+    )
+    @cache_catalog_response
     def get(self, request, pk):
-        products = Product.objects.filter(Q(category__id__icontains=pk))
-        serializer = ProductSerializer(products, many=True)
+        """
+        Category Product List
+
+        Return a page of products in the category with mentioned id, with the total count of products in it.<br>
+        Return 404 if no category with that id is found.
+
+        ### Valid query parameter list:<br>
+        **ordering**: Either 'oldest' (default), 'newest', 'price', '-price', 'rating' or '-rating'.<br>
+        **page_size**: Number of product per page, default to 24 and at most 100.<br>
+        **cursor**: Follow the returned next and previous link to move between pages.<br>
+        **fields**: Comma separated fields to return, e.g. 'name,slug,price'.<br>
+        **expand**: Comma separated optional fields to add, e.g. 'thumbnail' for the first product shot.<br>
+        """
+
+        category = get_object_or_404(Category, pk=pk)
+        if not category.product_count:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        sparse_fields = get_sparse_fields(request)
+        product_qs = ProductSerializer.prepare_queryset(Product.objects.filter(category__id=pk), **sparse_fields)
+
+        paginator = ProductCursorPagination()
+        products = paginator.paginate_queryset(product_qs, request, view=self)
 
         if not products:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        return Response(serializer.data, status.HTTP_200_OK)
+        response = paginator.get_paginated_response(ProductSerializer(products, many=True, **sparse_fields).data)
+        response.data['count'] = category.product_count
+        return response
 
     def post(self, request, slug, pk):
         pass
@@ -149,6 +187,9 @@ class CategoryProduct(APIView):
 class Products(APIView):
 
     permission_classes = [IsStaffOrReadOnly]
+    # Rows leave the list when deleted or filtered out, so it is only validated by its ETag
+    catalog_last_modified = False
+    max_batch = 200
 
     @swagger_auto_schema(
         responses={
@@ -156,6 +197,8 @@ class Products(APIView):
             204: 'No Content'
         }
     )
+    @conditional_catalog_response
+    @cache_catalog_response
     def get(self, request):
         """
         Product List
@@ -164,37 +207,111 @@ class Products(APIView):
 
         ### Valid query parameter list:<br>
         **featured**: If set to 'true' will only return featured products, if set to 'false' will do the opposite.<br>
-        **category**: Expected a category's ID, 
-        if properly set will only return product that contain category with mentioned ID.<br>
+        **category**: Expected a category's ID, or comma separated IDs,
+        if properly set will only return product that contain any category with mentioned ID.<br>
+        **price**: Comma separated price buckets, see the facets endpoint.<br>
+        **rating**: Comma separated rating bands, see the facets endpoint.<br>
+        **min_price**, **max_price**: Will only return product within the price range (inclusive).<br>
+        **ordering**: Either 'oldest' (default), 'newest', 'price', '-price', 'rating' or '-rating'.<br>
+        **page_size**, **cursor**: If either one is set the result will be paginated,
+        follow the returned next and previous link to move between pages.<br>
+        **fields**: Comma separated fields to return, e.g. 'name,slug,price'.<br>
+        **expand**: Comma separated optional fields to add, e.g. 'thumbnail' for the first product shot.<br>
+        **slugs**, **ids**: Comma separated slugs or IDs (at most 200) of products to return in the same order,
+        every other filter, ordering and pagination is ignored.
+        Return {"results": [products], "missing": [slugs or IDs that doesn't exist]}.<br>
 
         ### Example request:<br>
         ```
-        /api/v1/products/?category=1&featured=true
+        /api/v1/products/?category=1&featured=true&ordering=-price&page_size=24
+        /api/v1/products/?fields=name,slug,price&expand=thumbnail
+        /api/v1/products/?slugs=cotton-shirt,linen-pants&fields=name,slug,price
         ```
         """
 
-        product_qs = Product.objects.all()
+        sparse_fields = get_sparse_fields(request)
+        product_qs = ProductSerializer.prepare_queryset(self.get_queryset(request), **sparse_fields)
+
+        batch = self.get_batch(request)
+        if batch:
+            # Every product is loaded at once, then put back into the requested order
+            field, keys = batch
+            products = {getattr(product, field): product for product in product_qs}
 
-        # If featured parameter is set to either true or false,
-        # filter the queryset first to the desired featured value
-        if request.GET.get('featured') in ['true', 'false']:
-            featured = True if request.GET.get('featured') == 'true' else False
-            product_qs = product_qs.filter(is_featured=featured)
+            return Response({
+                'results': ProductSerializer([products[key] for key in keys if key in products], many=True, **sparse_fields).data,
+                'missing': [key for key in keys if key not in products],
+            })
 
-        # If category parameter is set,
-        # check if the product have that category first before appending them to the list
-        if request.GET.get('category'):
-            products = [product for product in product_qs if product.category.filter(id=request.GET.get('category'))]
+        paginator = ProductCursorPagination()
+        if paginator.is_requested(request):
+            products = paginator.paginate_queryset(product_qs, request, view=self)
         else:
-            products = [product for product in product_qs]
+            products = [product for product in paginator.order_queryset(product_qs, request)]
 
         # Return early with no content (204) if queryset is empty
         if not products:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        serializer = ProductSerializer(products, many=True)
+        serializer = ProductSerializer(products, many=True, **sparse_fields)
+
+        if paginator.is_requested(request):
+            return paginator.get_paginated_response(serializer.data)
+
         return Response(serializer.data)
 
+    def get_queryset(self, request):
+        batch = self.get_batch(request)
+        if batch:
+            field, keys = batch
+            return Product.objects.filter(**{f'{field}__in': keys})
+
+        # Featured, category, price bucket and rating band filters are shared with the facet counts
+        product_qs = Product.objects.filter(get_facet_q(parse_facet_filters(request.GET)))
+
+        if request.GET.get('min_price'):
+            product_qs = product_qs.filter(price__gte=self.get_query_param(request, 'min_price', float))
+
+        if request.GET.get('max_price'):
+            product_qs = product_qs.filter(price__lte=self.get_query_param(request, 'max_price', float))
+
+        return product_qs
+
+    def get_batch(self, request):
+        """
+        Return ('slug', slugs) or ('id', ids) requested with the slugs or ids parameter,
+        without duplicate and in the requested order, or None if neither is set.
+        """
+
+        if request.GET.get('slugs') and request.GET.get('ids'):
+            raise ParseError('slugs and ids parameter can\'t be used together')
+
+        if request.GET.get('slugs'):
+            field, keys = 'slug', [slug.strip() for slug in request.GET.get('slugs').split(',') if slug.strip()]
+        elif request.GET.get('ids'):
+            try:
+                field, keys = 'id', [int(id) for id in request.GET.get('ids').split(',') if id.strip()]
+            except ValueError:
+                raise ParseError('ids parameter should be comma separated numbers')
+        else:
+            return None
+
+        keys = list(dict.fromkeys(keys))
+        if len(keys) > self.max_batch:
+            raise ParseError(f'At most {self.max_batch} products can be requested at once')
+
+        return field, keys
+
+    def get_query_param(self, request, name, cast):
+        try:
+            return cast(request.GET.get(name))
+        except ValueError:
+            raise ParseError(f'{name} parameter should be a number')
+
+    def get_catalog_state(self, request):
+        state = self.get_queryset(request).aggregate(count=Count('id'), updated=Max('updated'))
+        return state['count'], state['updated']
+
     @swagger_auto_schema(
         request_body=CreateProductSerializer(),
         responses={
@@ -225,32 +342,139 @@ class Products(APIView):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class ProductFacets(APIView):
+    permission_classes = [AllowAny]
+
+    @swagger_auto_schema(
+        responses={
+            200: 'Matching Product Count And Count Per Facet Value',
+            400: 'Invalid Facet Value'
+        }
+    )
+    def get(self, request):
+        """
+        Product Facets
+
+        Return the number of products matching the filters, and how many products each facet value has.<br>
+        Values of a facet are OR-ed and different facets are AND-ed,
+        a facet is counted with the filters of the other facets only.<br>
+
+        ### Valid query parameter list:<br>
+        **category**: Comma separated category IDs.<br>
+        **featured**: Either 'true', 'false' or both.<br>
+        **price**: Comma separated price buckets, one of '0-100000', '100000-250000', '250000-500000' or '500000-'.<br>
+        **rating**: Comma separated rating bands from 0 (not rated) to 5, a product is in the band of its rating rounded down.<br>
+
+        ### Example request:<br>
+        ```
+        /api/v1/products/facets/?category=1,2&rating=4,5
+        ```
+        """
+
+        count, facets = facet_index.count(parse_facet_filters(request.GET))
+        categories = Category.objects.order_by('id').values_list('id', 'name')
+
+        # Only list the values that still exist, in a stable order
+        return Response({
+            'count': count,
+            'facets': {
+                'category': [{'value': id, 'name': name, 'count': facets['category'].get(id, 0)} for id, name in categories],
+                'featured': [{'value': value, 'count': facets['featured'].get(value, 0)} for value in ['true', 'false']],
+                'price': [{'value': value, 'count': facets['price'].get(value, 0)} for value in PRICE_BUCKET_VALUES],
+                'rating': [{'value': str(band), 'count': facets['rating'].get(str(band), 0)} for band in RATING_BANDS],
+            }
+        })
+
+class ProductSearch(APIView):
+    permission_classes = [AllowAny]
+    max_limit = 100
+
+    @swagger_auto_schema(
+        responses={
+            200: ProductSerializer(many=True),
+            204: 'No Product Matched',
+            400: 'No Word In The Search Query'
+        }
+    )
+    @cache_catalog_response
+    def get(self, request):
+        """
+        Product Search
+
+        Return products matching the search query, ordered by relevance.<br>
+        The query is matched against product name, category names, material and description,
+        every word should match and the last word is also matched as a prefix.<br>
+
+        ### Valid query parameter list:<br>
+        **q**: The search query, required.<br>
+        **limit**: Maximum number of returned product, default to 24 and at most 100.<br>
+        **fields**: Comma separated fields to return, e.g. 'name,slug,price'.<br>
+        **expand**: Comma separated optional fields to add, e.g. 'thumbnail' for the first product shot.<br>
+
+        ### Example request:<br>
+        ```
+        /api/v1/products/search/?q=cotton+shirt&limit=10
+        ```
+        """
+
+        query = request.GET.get('q', '')
+        if not get_search_terms(query):
+            raise ParseError('q parameter should contain at least one word')
+
+        try:
+            limit = min(max(int(request.GET.get('limit', 24)), 1), self.max_limit)
+        except ValueError:
+            raise ParseError('limit parameter should be a number')
+
+        sparse_fields = get_sparse_fields(request)
+        product_ids = search_products(query, limit=limit)
+        products = ProductSerializer.prepare_queryset(Product.objects.all(), **sparse_fields).in_bulk(product_ids)
+        products = [products[product_id] for product_id in product_ids if product_id in products]
+
+        if not products:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        serializer = ProductSerializer(products, many=True, **sparse_fields)
+        return Response(serializer.data)
+
 class ProductDetail(APIView):
 
     permission_classes = [IsStaffOrReadOnly]
 
     def get_object(self, slug):
         try:
-            return Product.objects.get(slug=slug)
+            return Product.objects.catalog().get(slug=slug)
         except Product.DoesNotExist:
             raise Http404
 
+    def get_catalog_state(self, request, slug):
+        updated = Product.objects.filter(slug=slug).values_list('updated', flat=True).first()
+        return (1, updated) if updated else None
+
     @swagger_auto_schema(
         responses={
             200: ProductReviewSerializer(),
             404: 'No Product With That Slug Found'
         }
     )
+    @conditional_catalog_response
+    @cache_catalog_response
     def get(self, request, slug):
         """
         Detail Product
 
         Return the detail of product that the slug mentioned.<br>
         Return 404 if no product with that slug is found.
+
+        ### Valid query parameter list:<br>
+        **fields**: Comma separated fields to return, use a dot to pick the fields of
+        a nested object, e.g. 'name,price,review.rating'.<br>
+        **expand**: Comma separated optional fields to add, e.g. 'thumbnail'.<br>
         """
 
-        product = self.get_object(slug)
-        serializer = ProductReviewSerializer(product)
+        sparse_fields = get_sparse_fields(request)
+        product = get_object_or_404(ProductReviewSerializer.prepare_queryset(Product.objects.all(), **sparse_fields), slug=slug)
+        serializer = ProductReviewSerializer(product, **sparse_fields)
         return Response(serializer.data)
 
     @swagger_auto_schema(
@@ -298,9 +522,55 @@ class ProductDetail(APIView):
         product.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+class ProductRelated(APIView):
+    permission_classes = [AllowAny]
+    max_limit = 20
+
+    @swagger_auto_schema(
+        responses={
+            200: ProductSerializer(many=True),
+            204: 'No Related Product Yet',
+            404: 'No Product With That Slug Found'
+        }
+    )
+    @cache_catalog_response
+    def get(self, request, slug):
+        """
+        Related Product List
+
+        Return the products frequently bought together with the product that the slug mentioned, most related first.<br>
+        Related products are computed from the order lines of checked out carts by the build_related_products command.<br>
+        Return 404 if no product with that slug is found.
+
+        ### Valid query parameter list:<br>
+        **limit**: Maximum number of returned product, default to 8 and at most 20.<br>
+        **fields**: Comma separated fields to return, e.g. 'name,slug,price'.<br>
+        **expand**: Comma separated optional fields to add, e.g. 'thumbnail' for the first product shot.<br>
+        """
+
+        try:
+            limit = min(max(int(request.GET.get('limit', 8)), 1), self.max_limit)
+        except ValueError:
+            raise ParseError('limit parameter should be a number')
+
+        product = get_object_or_404(Product, slug=slug)
+        related_ids = list(RelatedProduct.objects.filter(product=product).order_by('rank').values_list('related_id', flat=True)[:limit])
+
+        sparse_fields = get_sparse_fields(request)
+        products = ProductSerializer.prepare_queryset(Product.objects.all(), **sparse_fields).in_bulk(related_ids)
+        products = [products[product_id] for product_id in related_ids if product_id in products]
+
+        if not products:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        serializer = ProductSerializer(products, many=True, **sparse_fields)
+        return Response(serializer.data)
+
 class GalleryList(APIView):
 
     permission_classes = [AllowAny]
+    # Rows leave the list when deleted or filtered out, so it is only validated by its ETag
+    catalog_last_modified = False
 
     @swagger_auto_schema(
         responses={
@@ -308,6 +578,8 @@ class GalleryList(APIView):
             204: 'No Gallery Results Found'
         }
     )
+    @conditional_catalog_response
+    @cache_catalog_response
     def get(self, request):
         """
         Gallery
@@ -320,10 +592,8 @@ class GalleryList(APIView):
         **product_slug**: Will only return product's gallery with mentioned slug
         """
 
-        gallery = Gallery.objects.all().order_by('product')
-        gallery = gallery.filter(product__is_featured=True) if request.GET.get('featured') == 'true' else gallery
-        gallery = gallery.filter(product__slug=request.GET.get('product_slug')) if request.GET.get('product_slug') else gallery
-        
+        gallery = self.get_queryset(request).order_by('product')
+
         if not gallery:
             # Return early with no content (204) if no queryset found
             return Response(status=status.HTTP_204_NO_CONTENT)
@@ -331,9 +601,28 @@ class GalleryList(APIView):
         serialize = GallerySerializer(gallery, many=True)
         return Response(serialize.data, status=status.HTTP_200_OK)
 
+    def get_queryset(self, request):
+        gallery = Gallery.objects.all()
+        gallery = gallery.filter(product__is_featured=True) if request.GET.get('featured') == 'true' else gallery
+        gallery = gallery.filter(product__slug=request.GET.get('product_slug')) if request.GET.get('product_slug') else gallery
+
+        return gallery
+
+    def get_catalog_state(self, request):
+        state = self.get_queryset(request).aggregate(count=Count('id'), updated=Max('updated'))
+        return state['count'], state['updated']
+
 class ProductReviews(APIView):
     permission_classes = [IsActiveOrReadOnly]
 
+    def get_catalog_state(self, request, slug):
+        # Reviews are shown with their product name and rating
+        product = Product.objects.filter(slug=slug).annotate(review_updated=Max('review__updated')).first()
+        if not product:
+            return None
+
+        return product.review_count, max(product.updated, product.review_updated or product.updated)
+
     @swagger_auto_schema(
         responses={
             200: ReviewSerializer(many=True),
@@ -341,22 +630,34 @@ class ProductReviews(APIView):
             404: 'No Product With That Slug Found',
         }
     )
+    @conditional_catalog_response
     def get(self, request, slug):
         """
         Review List
         
         Return a list of reviews for product with mentioned slug.<br>
         Return 404 if no product with that slug is found.<br>
+
+        ### Valid query parameter list:<br>
+        **ordering**: Either 'oldest' (default), 'newest', 'rating' or '-rating'.<br>
+        **page_size**, **cursor**: If either one is set the result will be paginated,
+        follow the returned next and previous link to move between pages.<br>
+        **fields**: Comma separated fields to return, use a dot to pick the fields of
+        a nested object, e.g. 'rating,review,product.name'.<br>
         """
 
-        get_object_or_404(Product, slug=slug)
-        reviews = Review.objects.filter(product__slug=slug)
+        product = get_object_or_404(Product, slug=slug)
+        sparse_fields = get_sparse_fields(request)
+        reviews = ReviewSerializer.prepare_queryset(Review.objects.filter(product=product), **sparse_fields)
+
+        paginator = ReviewCursorPagination()
+        reviews = paginator.paginate_if_requested(reviews, request, view=self)
 
         if not reviews:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        serializer = ReviewSerializer(reviews, many=True)
-        return Response(serializer.data)
+        serializer = ReviewSerializer(reviews, many=True, **sparse_fields)
+        return paginator.get_optional_paginated_response(serializer.data)
 
     @swagger_auto_schema(
         request_body=CreateReviewSerializer(),
@@ -401,6 +702,42 @@ class ProductReviews(APIView):
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+class ProductReviewSummary(APIView):
+    permission_classes = [AllowAny]
+
+    @swagger_auto_schema(
+        responses={
+            200: openapi.Schema(type=openapi.TYPE_OBJECT, properties={
+                'count': 'Number of reviews',
+                'average': 'Average rating, 0 if not reviewed yet',
+                'distribution': 'Number of reviews of each rating, from "1" to "5"',
+            }),
+            404: 'No Product With That Slug Found',
+        }
+    )
+    @cache_catalog_response
+    def get(self, request, slug):
+        """
+        Review Summary
+
+        Return the number of reviews for each rating (1-5 stars) and the average rating of product with mentioned slug.<br>
+        Return 404 if no product with that slug is found.
+        """
+
+        product = get_object_or_404(Product, slug=slug)
+
+        # Every rating is counted by one GROUP BY, the total and average are derived from it
+        distribution = {str(rating): 0 for rating, display in RATING_CHOICES}
+        for rating, count in Review.objects.filter(product=product).order_by().values_list('rating').annotate(count=Count('id')):
+            distribution[str(rating)] = count
+
+        count = sum(distribution.values())
+        return Response({
+            'count': count,
+            'average': sum(int(rating) * ratings for rating, ratings in distribution.items()) / count if count else 0,
+            'distribution': distribution,
+        })
+
 class ProductCategories(APIView):
     permission_classes = [IsStaffOrReadOnly]
 
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0005_auto_20210501_0902'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='avatar',
+            field=models.ImageField(blank=True, db_index=True, height_field='height', null=True, upload_to='media/avatar/', width_field='width'),
+        ),
+    ]
@@ -1,7 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.dispatch import receiver
-import os
+from Virtuele.storage import release_files
 
 class UserManager(BaseUserManager):
     def create_user(self, email, username, first_name, last_name=None, password=None, **kwargs):
@@ -27,7 +27,8 @@ class User(AbstractBaseUser):
     last_name = models.CharField(max_length=255, null=True, blank=True)
     height = models.IntegerField(blank=True, null=True)
     width = models.IntegerField(blank=True, null=True)
-    avatar = models.ImageField(upload_to='media/avatar/', height_field='height', width_field='width', null=True, blank=True)
+    # Indexed to count the references of a stored file before it is deleted
+    avatar = models.ImageField(upload_to='media/avatar/', height_field='height', width_field='width', null=True, blank=True, db_index=True)
     is_active = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
 
@@ -57,8 +58,7 @@ class User(AbstractBaseUser):
 @receiver(models.signals.post_delete, sender=User)
 def auto_delete_user_avatar_on_delete(sender, instance, **kwargs):
     if instance.avatar:
-        if os.path.isfile(instance.avatar.path):
-            os.remove(instance.avatar.path)
+        release_files([instance.avatar.name])
 
 @receiver(models.signals.pre_save, sender=User)
 def auto_delete_user_avatar_on_change(sender, instance, **kwargs):
@@ -70,11 +70,7 @@ def auto_delete_user_avatar_on_change(sender, instance, **kwargs):
         return False
     new_file = instance.avatar
     if not old_file == new_file:
-        try:
-            if os.path.isfile(old_file.path):
-                os.remove(old_file.path)
-        except ValueError:
-            return False
+        release_files([old_file.name])
 
 @receiver(models.signals.post_save, sender=User)
 def auto_set_username(sender, instance, created, **kwargs):
@@ -2,6 +2,8 @@ from rest_framework import status
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
 from user.models import User
+from product.models import Product, Review
+from product.serializers import ReviewSerializer
 from Virtuele.helpers import VirtueleTestBase
 
 class UserAuthentication(VirtueleTestBase):
@@ -63,3 +65,34 @@ class UserAuthentication(VirtueleTestBase):
         logged_in_client.credentials()
         logged_out_user = logged_in_client.get('/api/v1/users/me/', format='json')
         self.assertEqual(logged_out_user.status_code, status.HTTP_401_UNAUTHORIZED)
+
+class UserReviewList(VirtueleTestBase):
+    def setUp(self):
+        self.account_factory(n=2)
+        self.product_factory(n=4)
+        self.client = APIClient()
+
+        self.user = get_user_model().objects.get(id=1)
+        for product in Product.objects.all():
+            Review.objects.create(user=self.user, product=product, rating=product.id)
+
+    def test_filter_by_product(self):
+        product = Product.objects.get(id=2)
+
+        for url, jwt in [(f'/api/v1/users/{self.user.id}/reviews/', {}), ('/api/v1/users/me/reviews/', self.account_jwt(1))]:
+            response = self.client.get(f'{url}?product={product.slug}', **jwt)
+            self.assertEqual(response.data, ReviewSerializer(Review.objects.filter(user=self.user, product=product), many=True).data)
+
+            response = self.client.get(f'{url}?product=invalidslug', **jwt)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_paginate_reviews(self):
+        response = self.client.get(f'/api/v1/users/{self.user.id}/reviews/?page_size=3&ordering=newest&fields=rating')
+        self.assertEqual(response.data['results'], [{'rating': rating} for rating in [4, 3, 2]])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'], [{'rating': 1}])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(f'/api/v1/users/{get_user_model().objects.get(id=2).id}/reviews/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
@@ -9,8 +9,12 @@ from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 from user.serializers import VirtueleTokenObtainPairSerializer
+from rest_framework.exceptions import ParseError
+from cart.guest import GuestCartBusy, get_guest_cart_token, merge_guest_cart
 from product.models import Review
+from product.pagination import ReviewCursorPagination
 from product.serializers import ReviewSerializer
+from Virtuele.serializers import get_sparse_fields
 
 class VirtueleTokenObtainPairView(TokenObtainPairView):
     """
@@ -18,7 +22,8 @@ class VirtueleTokenObtainPairView(TokenObtainPairView):
 
     Return two kinds of token if authentication is succesful.<br>
     The access token will valid for 30 minutes, while the refresh for 7 days.<br>
-    Use the access token as an authorization for any protected API.
+    Use the access token as an authorization for any protected API.<br>
+    Send the guest cart token in the X-Cart-Token header to add the guest cart into the user's active cart.
     """
 
     serializer_class = VirtueleTokenObtainPairSerializer
@@ -38,6 +43,19 @@ class VirtueleTokenObtainPairView(TokenObtainPairView):
         except TokenError as e:
             raise InvalidToken(e.args[0])
 
+        try:
+            guest_cart_token = get_guest_cart_token(request)
+        except ParseError:
+            # A bad cart token shouldn't prevent the login
+            guest_cart_token = None
+
+        if guest_cart_token:
+            try:
+                merge_guest_cart(serializer.user, guest_cart_token)
+            except GuestCartBusy:
+                # Neither should a guest cart being changed, it is kept for the next login
+                pass
+
         return Response(serializer.validated_data, status=status.HTTP_200_OK)
 
 class VirtueleTokenRefreshView(TokenRefreshView):
@@ -81,19 +99,30 @@ class UserReviews(APIView):
         Return a list of user's reviews with mentioned ID.
         Return 401 if the request are not authenticated (user aren't logged in).
         You can set a GET parameter list to filter the result.<br>
-        **product**: Returned review will be on product with mentioned slug only.
+        **product**: Returned review will be on product with mentioned slug only.<br>
+        **ordering**: Either 'oldest' (default), 'newest', 'rating' or '-rating'.<br>
+        **page_size**, **cursor**: If either one is set the result will be paginated,
+        follow the returned next and previous link to move between pages.<br>
+        **fields**: Comma separated fields to return, use a dot to pick the fields of
+        a nested object, e.g. 'rating,review,product.name'.
         """
         
         reviews = Review.objects.filter(user__id=id)
 
         if request.GET.get('product'):
-            reviews.filter(product__slug=request.GET.get('product'))
+            reviews = reviews.filter(product__slug=request.GET.get('product'))
+
+        sparse_fields = get_sparse_fields(request)
+        reviews = ReviewSerializer.prepare_queryset(reviews, **sparse_fields)
+
+        paginator = ReviewCursorPagination()
+        reviews = paginator.paginate_if_requested(reviews, request, view=self)
 
         if not reviews:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        serializer = ReviewSerializer(reviews, many=True)
-        return Response(serializer.data)
+        serializer = ReviewSerializer(reviews, many=True, **sparse_fields)
+        return paginator.get_optional_paginated_response(serializer.data)
 
 class MyReviews(APIView):
     permission_classes = [IsActive]
@@ -112,16 +141,27 @@ class MyReviews(APIView):
         Return a list of requesting user's review.
         Return 401 if the request are not authenticated (user aren't logged in).
         You can set a GET parameter list to filter the result.<br>
-        **product**: Returned review will be on product with mentioned slug only.
+        **product**: Returned review will be on product with mentioned slug only.<br>
+        **ordering**: Either 'oldest' (default), 'newest', 'rating' or '-rating'.<br>
+        **page_size**, **cursor**: If either one is set the result will be paginated,
+        follow the returned next and previous link to move between pages.<br>
+        **fields**: Comma separated fields to return, use a dot to pick the fields of
+        a nested object, e.g. 'rating,review,product.name'.
         """
 
         reviews = Review.objects.filter(user=request.user)
 
         if request.GET.get('product'):
-            reviews.filter(product__slug=request.GET.get('product'))
+            reviews = reviews.filter(product__slug=request.GET.get('product'))
+
+        sparse_fields = get_sparse_fields(request)
+        reviews = ReviewSerializer.prepare_queryset(reviews, **sparse_fields)
+
+        paginator = ReviewCursorPagination()
+        reviews = paginator.paginate_if_requested(reviews, request, view=self)
 
         if not reviews:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        serializer = ReviewSerializer(reviews, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        serializer = ReviewSerializer(reviews, many=True, **sparse_fields)
+        return paginator.get_optional_paginated_response(serializer.data)
\ No newline at end of file